@@ -0,0 +1,73 @@
+"""Compare cvxEDA solver backends: wall time and agreement with cvxopt
+
+Runs cvxEDA on fragments of increasing length taken from a decimated EDA
+recording (first subject container in out/raw_data, or a container given
+as argument) and prints, for each backend, the solve time and the largest
+difference from the cvxopt solution relative to the signal range.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cvxEDA  # noqa: E402
+from ecutils.container import SUFFIX, SubjectFile  # noqa: E402
+from ecutils.resample import downsample  # noqa: E402
+
+FS = 25
+PARAMS = {'tau0': 2., 'tau1': .7, 'delta_knot': 10., 'alpha': 8e-4,
+          'gamma': 1e-2}
+
+parser = argparse.ArgumentParser()
+parser.add_argument('data_file', nargs='?', help='subject container')
+parser.add_argument('--lengths', help='signal lengths in seconds', nargs='+',
+                    type=float, default=[60, 300, 600, 1200])
+parser.add_argument('--repeat', help='best of this many runs', type=int,
+                    default=3)
+args = parser.parse_args()
+
+data_file = args.data_file or sorted(glob.glob('out/raw_data/*' + SUFFIX))[0]
+subject = SubjectFile(data_file)
+eda, _ = downsample(subject.channel('eda'), None, subject.fs('eda'), FS)
+
+backends = {
+    'cvxopt': cvxEDA.CvxoptBackend(options={'reltol': 1e-9,
+                                            'show_progress': False}),
+    'scipy': cvxEDA.ScipyBackend(),
+    }
+
+print('{:>8} {:>8} {:>10} {:>9} {:>9} {:>9} {:>10}'.format(
+    'length', 'backend', 'time (s)', 'd(r)', 'd(t)', 'd(e)', 'd(obj)'))
+
+for seconds in args.lengths:
+    n = int(seconds * FS)
+    if n > len(eda):
+        print('{:>8} skipped, recording is shorter'.format(seconds))
+        continue
+    y = eda[:n]
+    rng = np.ptp(y)
+
+    results = {}
+    for name, backend in backends.items():
+        times = []
+        for _ in range(args.repeat):
+            cvxEDA.get_model.cache_clear()  # include model set-up
+            start = time.perf_counter()
+            res = list(cvxEDA.cvxEDA(y, 1 / FS, backend=backend, **PARAMS))
+            times.append(time.perf_counter() - start)
+        results[name] = res
+
+        r, p, t, l, d, e, obj = res
+        r0, p0, t0, l0, d0, e0, obj0 = results['cvxopt']
+        print('{:>8} {:>8} {:>10.3f} {:>9.1e} {:>9.1e} {:>9.1e} {:>10.1e}'
+              .format(seconds, name, min(times),
+                      np.abs(r - r0).max() / rng,
+                      np.abs(t - t0).max() / rng,
+                      np.abs(e - e0).max() / rng,
+                      np.ravel((obj - obj0) / abs(obj0))[0]))
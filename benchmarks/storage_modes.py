@@ -0,0 +1,95 @@
+"""Check that compact storage of raw data does not change scores
+
+Recodes the subject containers in out/raw_data with each storage mode (see
+ecutils/container.py), runs emg_master.py and eda_master.py on every copy in
+a temporary directory and compares the scores with those computed from
+float64 data. Prints file sizes, the largest differences in amplitudes
+(relative to the largest amplitude) and whether the same trials were scored
+(EDA amplitudes below threshold are missing). Exits with an error if a
+difference exceeds --rtol.
+
+Run from the directory containing out/raw_data.
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ecutils.container import SUFFIX, recode  # noqa: E402
+from ecutils.scores import ScoreStore  # noqa: E402
+
+MODES = [('float64', None, False), ('float64+zlib', None, True),
+         ('float32', 'float32', False), ('float32+zlib', 'float32', True),
+         ('int16', 'int16', False), ('int16+zlib', 'int16', True)]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--rtol', help='tolerance, relative to largest amplitude',
+                    type=float, default=1e-3)
+parser.add_argument('--keep', help='keep temporary directories',
+                    action='store_true')
+args = parser.parse_args()
+
+sources = sorted(glob.glob(os.path.join('out', 'raw_data', '*' + SUFFIX)))
+env = dict(os.environ, MPLBACKEND='Agg',
+           PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+
+
+def run_mode(storage, compress):
+    directory = tempfile.mkdtemp(prefix='storage_')
+    os.makedirs(os.path.join(directory, 'out', 'raw_data'))
+    size = 0
+    for src in sources:
+        dst = os.path.join(directory, 'out', 'raw_data', os.path.basename(src))
+        recode(src, dst, storage, compress)
+        size += os.path.getsize(dst)
+
+    for script in ['emg_master.py', 'eda_master.py']:
+        subprocess.run([sys.executable, os.path.join(ROOT, script)],
+                       cwd=directory, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+
+    scores = {}
+    for modality in ['emg', 'eda']:
+        store = ScoreStore(modality,
+                           directory=os.path.join(directory, 'out', 'scores'))
+        scores[modality] = store.read(columns=['amplitude'])
+    return directory, size, scores
+
+
+reference = None
+failed = False
+print('{:<14} {:>10} {:>10} {:>10} {:>12}'.format(
+    'storage', 'size (MB)', 'd(EMG)', 'd(EDA)', 'same trials'))
+
+for label, storage, compress in MODES:
+    directory, size, scores = run_mode(storage, compress)
+    if reference is None:
+        reference = scores
+
+    diffs, same = [], True
+    for modality in ['emg', 'eda']:
+        a = reference[modality].amplitude.values.astype(float)
+        b = scores[modality].amplitude.values.astype(float)
+        same &= bool(np.array_equal(np.isnan(a), np.isnan(b)))
+        both = ~np.isnan(a) & ~np.isnan(b)
+        diffs.append(np.abs(a - b)[both].max(initial=0)
+                     / np.nanmax(np.abs(a)))
+
+    failed |= not same or max(diffs) > args.rtol
+    print('{:<14} {:>10.1f} {:>10.1e} {:>10.1e} {:>12}'.format(
+        label, size / 1e6, diffs[0], diffs[1], str(same)))
+
+    if not args.keep:
+        shutil.rmtree(directory)
+
+if failed:
+    sys.exit('Scores differ more than --rtol {}'.format(args.rtol))
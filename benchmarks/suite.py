@@ -0,0 +1,354 @@
+"""Benchmarks of the pipeline hot paths on synthetic data
+
+Times marker decoding (EventCollection.from_acq), cvxEDA, EMG filtering,
+startle scoring (emg_master.score_trials), online startle scoring in 50 ms
+blocks (ecutils.stream), decomposition and trial extraction of an
+experiment phase (eda_master.process_phase), online decomposition of a whole
+session in 1 s blocks (ecutils.eda_stream) and group-level
+normalization (collect_scores) and a 100-point sweep of EDA scoring
+windows (sweep_eda) on recordings from benchmarks/synthetic.py.
+Recording cases run for each --lengths factor (1 is a full session:
+48 observational and 24 direct trials), collect_scores and eda_sweep for
+each number of --subjects.
+
+Results (best and median of --repeat runs) are written to out/benchmarks
+as JSON and compared with the latest earlier result of each case from the
+same machine (or with --baseline); the script exits with an error if a case
+became slower by more than --threshold.
+
+Run from any directory; nothing but the result file is written.
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np  # noqa: E402
+import pandas  # noqa: E402
+
+import collect_scores  # noqa: E402
+import cvxEDA  # noqa: E402
+import eda_master  # noqa: E402
+import emg_master  # noqa: E402
+import sweep_eda  # noqa: E402
+import synthetic  # noqa: E402
+from ecutils.eda_stream import EDAStream  # noqa: E402
+from ecutils.emg import preprocess_emg, preprocess_emg_local  # noqa: E402
+from ecutils.eventhandler import EventCollection  # noqa: E402
+from ecutils.resample import downsample  # noqa: E402
+from ecutils.stream import StartleStream  # noqa: E402
+
+RESULT_DIR = os.path.join('out', 'benchmarks')
+
+
+class Recording:
+    """Synthetic recording of one subject, with derived signals"""
+
+    def __init__(self, length, seed=0):
+        rec = synthetic.recording(seed, length)
+        self.fs = synthetic.FS
+        self.eda_raw = rec['eda']
+        self.emg_raw = rec['emg']
+        self.events = EventCollection.from_arrays(rec['samples'],
+                                                  rec['values'])
+        self.digital = synthetic.digital_channels(
+            rec['samples'], rec['values'], len(self.eda_raw))
+
+        fs = eda_master.PARAMS['fs']
+        self.eda, self.eda_events = downsample(
+            self.eda_raw, self.events, self.fs, fs)
+        self.ofl_eda, _ = eda_master.extract_phase(
+            self.eda, self.eda_events, 13, 14)
+
+        probes = self.events.samples[
+            np.isin(self.events.values, emg_master.PROBES)]
+        self.probes = probes
+        self.emg_rough, self.emg_smooth = preprocess_emg_local(
+            self.emg_raw, probes)
+
+    def seconds(self):
+        return len(self.eda_raw) / self.fs
+
+
+def case_from_acq(rec):
+    data = SimpleNamespace(
+        channels=[SimpleNamespace(data=ch) for ch in rec.digital])
+
+    def run():
+        ec = EventCollection.from_acq(data, 0, 10)
+        assert np.array_equal(ec.samples, rec.events.samples)
+        assert np.array_equal(ec.values, rec.events.values)
+    return run
+
+
+def case_cvxeda(rec):
+    fs = eda_master.PARAMS['fs']
+    backend = cvxEDA.CvxoptBackend(options={'reltol': 1e-9,
+                                            'show_progress': False})
+
+    def run():
+        cvxEDA.cvxEDA(rec.ofl_eda, 1 / fs, backend=backend,
+                      **eda_master.PARAMS['cvxeda'])
+    return run
+
+
+def case_preprocess_emg(rec):
+    return lambda: preprocess_emg(rec.emg_raw)
+
+
+def case_preprocess_emg_local(rec):
+    return lambda: preprocess_emg_local(rec.emg_raw, rec.probes)
+
+
+def case_emg_score_trials(rec):
+    events = rec.events.events_between_events(13, 14)
+
+    def run():
+        emg_master.score_trials(events, rec.emg_rough, rec.emg_smooth,
+                                'SYNAAA', 'obs')
+    return run
+
+
+def case_startle_stream(rec):
+    block = 100  # 50 ms
+
+    def run():
+        stream = StartleStream()
+        for start in range(0, len(rec.emg_raw), block):
+            stream.feed(rec.emg_raw[start:start + block],
+                        rec.digital[:, start:start + block])
+        stream.flush()
+    return run
+
+
+def case_eda_stream(rec):
+    fs = eda_master.PARAMS['fs']
+
+    def run():
+        stream = EDAStream(fs, **eda_master.PARAMS['cvxeda'])
+        for start in range(0, len(rec.eda), fs):
+            stream.feed(rec.eda[start:start + fs])
+        stream.flush()
+    return run
+
+
+def case_process_phase(rec):
+    def run():
+        # cvxopt reports progress with print
+        with contextlib.redirect_stdout(io.StringIO()):
+            eda_master.process_phase(rec.eda, rec.eda_events, 13, 14, 6,
+                                     eda_master.PARAMS['fs'], 'SYNAAA')
+    return run
+
+
+def score_table(modality, n_subjects, seed=0):
+    """Trial scores of n_subjects, shaped like the score store tables"""
+
+    rng = np.random.RandomState(seed)
+    if modality == 'emg':
+        stimuli = ['obs fix', 'obs CS+', 'obs CS-',
+                   'direct fix', 'direct CS+', 'direct CS-']
+        counts = [16, 8, 8, 8, 4, 4]
+    else:
+        stimuli = ['obs CS+', 'obs US present', 'obs US absent', 'obs CS-',
+                   'direct CS+', 'direct CS-']
+        counts = [24, 6, 6, 24, 12, 12]
+    stimulus = np.repeat(stimuli, counts)
+    trial = np.concatenate([np.arange(1, c + 1) for c in counts])
+
+    n = len(stimulus)
+    amplitude = rng.lognormal(-3, 1, (n_subjects, n))
+    if modality == 'eda':
+        amplitude[rng.rand(n_subjects, n) < .3] = np.nan  # below threshold
+    codes = [synthetic.subject_code(i) for i in range(n_subjects)]
+    return pandas.DataFrame({
+        'code': pandas.Categorical(np.repeat(codes, n)),
+        'stimulus': pandas.Categorical(np.tile(stimulus, n_subjects)),
+        'trial': np.tile(trial, n_subjects),
+        'amplitude': amplitude.ravel(),
+        })
+
+
+_phases = {}
+
+
+def decomposed_phases():
+    """OFL and DE of a full synthetic session, decomposed once"""
+
+    if not _phases:
+        rec = Recording(1.)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for start, stop, name in [(13, 14, 'obs'), (15, 16, 'direct')]:
+                _, _phases[name] = eda_master.process_phase(
+                    rec.eda, rec.eda_events, start, stop, 1,
+                    eda_master.PARAMS['fs'])
+    return _phases
+
+
+def case_eda_sweep(n_subjects):
+    # every subject has the same decomposition, only the size matters
+    decompositions = {synthetic.subject_code(i): decomposed_phases()
+                      for i in range(n_subjects)}
+    grid = sweep_eda.parameter_grid(
+        cs_onset=[0, 2, 3, 4, 5], cs_duration=[4, 5, 6, 7, 8],
+        us_duration=[4, 6], threshold=[.01, .05])  # 100 parameter sets
+    return lambda: sweep_eda.sweep(decompositions, grid)
+
+
+def case_collect_scores(n_subjects):
+    emg = score_table('emg', n_subjects)
+    eda = score_table('eda', n_subjects)
+
+    def run():
+        collect_scores.normalize_emg(emg)
+        collect_scores.normalize_eda(eda)
+    return run
+
+
+RECORDING_CASES = {
+    'from_acq': case_from_acq,
+    'cvxeda': case_cvxeda,
+    'preprocess_emg': case_preprocess_emg,
+    'preprocess_emg_local': case_preprocess_emg_local,
+    'emg_score_trials': case_emg_score_trials,
+    'startle_stream': case_startle_stream,
+    'process_phase': case_process_phase,
+    'eda_stream': case_eda_stream,
+    }
+SUBJECT_CASES = {
+    'collect_scores': case_collect_scores,
+    'eda_sweep': case_eda_sweep,
+    }
+
+
+def measure(run, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times), float(np.median(times))
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def earlier_results(machine):
+    """Best times of earlier runs on this machine, the latest for each case
+
+    Returns a dict: (case, size) -> best time.
+    """
+
+    reference = {}
+    for file_name in sorted(glob.glob(os.path.join(RESULT_DIR, '*.json'))):
+        with open(file_name) as f:
+            result = json.load(f)
+        if result['machine'] == machine:
+            reference.update(((r['case'], r['size']), r['best'])
+                             for r in result['results'])
+    return reference
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', help='run only these cases', nargs='+',
+                        choices=sorted({**RECORDING_CASES, **SUBJECT_CASES}))
+    parser.add_argument('--lengths', help='recording length factors',
+                        nargs='+', type=float, default=[.5, 1, 2])
+    parser.add_argument('--subjects', help='numbers of subjects',
+                        nargs='+', type=int, default=[10, 100, 1000])
+    parser.add_argument('--repeat', help='runs of each case', type=int,
+                        default=5)
+    parser.add_argument('--baseline', help='result file to compare with '
+                        '(default: latest results from this machine)')
+    parser.add_argument('--threshold', help='relative slow-down reported '
+                        'as a regression', type=float, default=.2)
+    parser.add_argument('--no-save', help='do not store the results',
+                        action='store_true')
+    args = parser.parse_args()
+
+    selected = args.cases or list(RECORDING_CASES) + list(SUBJECT_CASES)
+    machine = platform.node()
+    if args.baseline is None:
+        baseline = 'earlier results'
+        reference = earlier_results(machine)
+    else:
+        baseline = args.baseline
+        with open(baseline) as f:
+            reference = {(r['case'], r['size']): r['best']
+                         for r in json.load(f)['results']}
+
+    results = []
+    print('{:<22} {:>10} {:>10} {:>10} {:>9}'.format(
+        'case', 'size', 'best (s)', 'median (s)', 'change'))
+
+    def report(case, size, run):
+        best, median = measure(run, args.repeat)
+        results.append({'case': case, 'size': size, 'best': best,
+                        'median': median, 'repeat': args.repeat})
+        change = ''
+        if (case, size) in reference:
+            ratio = best / reference[case, size] - 1
+            change = '{:+.0%}'.format(ratio)
+            if ratio > args.threshold:
+                change += ' !'
+        print('{:<22} {:>10} {:>10.4f} {:>10.4f} {:>9}'.format(
+            case, size, best, median, change))
+
+    for length in args.lengths:
+        cases = [c for c in RECORDING_CASES if c in selected]
+        if not cases:
+            break
+        rec = Recording(length)
+        for case in cases:
+            report(case, '{:.0f}s'.format(rec.seconds()),
+                   RECORDING_CASES[case](rec))
+
+    for n_subjects in args.subjects:
+        for case in [c for c in SUBJECT_CASES if c in selected]:
+            report(case, '{} subj'.format(n_subjects),
+                   SUBJECT_CASES[case](n_subjects))
+
+    if not args.no_save:
+        if not os.path.exists(RESULT_DIR):
+            os.makedirs(RESULT_DIR)
+        file_name = os.path.join(RESULT_DIR, time.strftime(
+            '%Y%m%d-%H%M%S') + '.json')
+        with open(file_name, 'wt') as f:
+            json.dump({
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'commit': git_commit(),
+                'machine': machine,
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'results': results,
+                }, f, indent=1)
+        print('Results saved in', file_name)
+
+    regressions = [r for r in results
+                   if (r['case'], r['size']) in reference
+                   and r['best'] > (1 + args.threshold)
+                   * reference[r['case'], r['size']]]
+    if regressions:
+        sys.exit('{} case(s) slower than {} by more than {:.0%}'.format(
+            len(regressions), baseline, args.threshold))
@@ -0,0 +1,217 @@
+"""Synthetic recordings with the structure of the experiment
+
+Markers follow the phases used by the analysis: rest (11 - 12),
+observational fear learning (13 - 14) and direct expression (15 - 16).
+Each trial starts with CS+ (1) or CS- (2); startle probes are presented
+during the CS (5 for CS+, 6 for CS-) or during fixation (4), and in the
+observational phase CS+ trials without a probe end with the US (8) or its
+omission (7).
+
+EDA is a slowly drifting tonic level with Bateman-shaped SCRs (the same
+rise / decay time constants as used by cvxEDA) after CS onsets, USs,
+probes and spontaneously; EMG is noise with startle bursts after probes.
+Markers are also available as 8 digital channels (bit n of the marker value
+on channel n), as decoded by EventCollection.from_acq.
+
+Use from the command line to write a cohort of subject containers:
+
+    python benchmarks/synthetic.py out/raw_data --subjects 10 --length 1
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from scipy import signal as ss
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ecutils.container import SUFFIX, write_container  # noqa: E402
+from ecutils.eventhandler import marker_channels  # noqa: E402
+
+FS = 2000  # sampling rate of the recordings
+TAU_RISE, TAU_DECAY = .7, 2.  # Bateman function, as cvxEDA tau1 & tau0
+
+
+def experiment_events(rng, length=1., fs=FS):
+    """Marker events of one session
+
+    Arguments:
+    # rng -- numpy RandomState
+    # length -- scales the number of trials (48 observational and 24 direct
+      for 1) and the duration of rest
+    # fs -- sampling rate
+
+    Returns two integer arrays: samples and marker values, sorted.
+    """
+
+    n_ofl = max(6, int(round(48 * length)))
+    n_de = max(6, int(round(24 * length)))
+
+    events = []
+    t = 5.
+    events += [(t, 11), (t + 180 * length, 12)]
+    t += 180 * length + 10
+
+    for start, stop, n_trials in [(13, 14, n_ofl), (15, 16, n_de)]:
+        events.append((t, start))
+        t += 5
+        # balanced CS+ / CS-, a third each with CS probe, fix probe, none
+        is_plus = rng.permutation(np.arange(n_trials) % 2 == 0)
+        probe = rng.permutation(np.arange(n_trials) % 3)
+        for plus, p in zip(is_plus, probe):
+            events.append((t, 1 if plus else 2))
+            if p == 1:
+                events.append((t + 4, 5 if plus else 6))
+            elif p == 2:
+                events.append((t + 14, 4))
+            elif start == 13 and plus:
+                events.append((t + 7.5, 8 if rng.rand() < .5 else 7))
+            t += 19 + rng.uniform(1, 3)  # 9 s CS, 10 s fixation, interval
+        events.append((t, stop))
+        t += 10
+
+    samples = np.array([int(round(s * fs)) for s, v in events])
+    values = np.array([v for s, v in events])
+    order = np.argsort(samples, kind='stable')
+    return samples[order], values[order]
+
+
+def bateman(fs, duration=30.):
+    """SCR shape with unit peak"""
+
+    t = np.arange(int(duration * fs)) / fs
+    b = np.exp(-t / TAU_DECAY) - np.exp(-t / TAU_RISE)
+    return b / b.max()
+
+
+def eda_signal(rng, n, samples, values, fs=FS, rate=100):
+    """Skin conductance (µS): drifting tonic level with SCRs
+
+    SCRs are generated at a lower rate and interpolated, the signal is
+    smooth at that scale.
+    """
+
+    m = n * rate // fs + 1
+    t = np.arange(m) / rate
+
+    # tonic level: a few slow oscillations and a linear trend
+    tonic = 2 + 6 * rng.rand() + rng.uniform(-1, 1) * t / t[-1]
+    for period in rng.uniform(60, 600, size=3):
+        tonic += rng.uniform(.05, .3) * np.sin(
+            2 * np.pi * t / period + rng.uniform(0, 2 * np.pi))
+
+    # drivers: responses to stimuli (not always) and spontaneous SCRs
+    drivers = np.zeros(m)
+    gain = {1: 1., 2: .6, 4: .3, 5: .3, 6: .3, 7: .5, 8: 2.}
+    responsive = rng.uniform(.1, .4)
+    for s, v in zip(samples, values):
+        if v in gain and rng.rand() < .75:
+            i = int((s / fs + rng.uniform(1, 3)) * rate)
+            if i < m:
+                drivers[i] += gain[v] * responsive * rng.lognormal(0, .5)
+    n_spont = rng.poisson(2 * t[-1] / 60)
+    np.add.at(drivers, rng.randint(0, m, n_spont),
+              rng.exponential(.05, n_spont))
+
+    phasic = ss.fftconvolve(drivers, bateman(rate))[:m]
+    eda = np.interp(np.arange(n) / fs, t, tonic + phasic)
+    return eda + .003 * rng.standard_normal(n)
+
+
+def emg_signal(rng, n, samples, values, fs=FS):
+    """Raw EMG (mV): noise, mains hum and startle bursts after probes"""
+
+    emg = .004 * rng.standard_normal(n)
+    emg += .002 * np.sin(2 * np.pi * 50 * np.arange(n) / fs)
+
+    burst_len = int(.1 * fs)
+    envelope = np.hanning(burst_len)
+    responsive = rng.uniform(.02, .1)
+    for s in samples[np.isin(values, [4, 5, 6])]:
+        if rng.rand() < .15:
+            continue  # no measurable reaction
+        i = s + int(rng.uniform(.02, .06) * fs)
+        amp = responsive * rng.lognormal(0, .4)
+        burst = amp * envelope * rng.standard_normal(burst_len)
+        emg[i:i + burst_len] += burst[:max(n - i, 0)]
+    return emg
+
+
+def digital_channels(samples, values, n, pulse=20):
+    """8 digital channels (0 / 5 V, uint8 to save memory) encoding markers"""
+
+    return marker_channels(samples, values, 0, n, pulse=pulse)
+
+
+def recording(seed, length=1., fs=FS):
+    """Synthetic recording of one subject
+
+    Returns a dict with eda, emg, samples and values (of marker events).
+    """
+
+    rng = np.random.RandomState(seed)
+    samples, values = experiment_events(rng, length, fs)
+    n = samples[-1] + int(10 * fs)
+    return {
+        'eda': eda_signal(rng, n, samples, values, fs),
+        'emg': emg_signal(rng, n, samples, values, fs),
+        'samples': samples,
+        'values': values,
+        }
+
+
+def subject_code(n):
+    """Six capital letters like the codes of real subjects, SYN + 3"""
+
+    letters = []
+    for _ in range(3):
+        n, r = divmod(n, 26)
+        letters.append(chr(ord('A') + r))
+    return 'SYN' + ''.join(reversed(letters))
+
+
+def write_subject(file_name, seed, length=1., fs=FS, storage=None,
+                  compress=False):
+    """Write a synthetic recording into a subject container"""
+
+    rec = recording(seed, length, fs)
+    with write_container(file_name) as writer:
+        for name in ['eda', 'emg']:
+            out = writer.add_channel(name, rec[name].dtype, len(rec[name]),
+                                     fs, storage=storage, compress=compress)
+            out[:] = rec[name]
+            del out
+        writer.set_events(rec['samples'], rec['values'], fs)
+        writer.set_metadata({
+            'subject': os.path.basename(file_name).split('.')[0],
+            'synthetic': {'seed': seed, 'length': length},
+            'extracted': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            })
+    return file_name
+
+
+def write_cohort(directory, n_subjects, length=1., seed=0, **kwargs):
+    """Write containers for n_subjects, returns list of files"""
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return [write_subject(os.path.join(directory, subject_code(i) + SUFFIX),
+                          seed + i, length, **kwargs)
+            for i in range(n_subjects)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', help='where to write containers')
+    parser.add_argument('--subjects', type=int, default=4)
+    parser.add_argument('--length', help='scales number of trials and '
+                        'duration of rest', type=float, default=1.)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for f in write_cohort(args.directory, args.subjects, args.length,
+                          args.seed):
+        print(f)
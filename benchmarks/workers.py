@@ -0,0 +1,164 @@
+"""Check that workers sharing a directory score every subject, also when
+some of them crash
+
+Writes a synthetic cohort (benchmarks/synthetic.py) to a temporary
+directory, starts --workers processes of emg_master.py (or eda_master.py)
+--worker in it and kills (SIGKILL) --kill of them as soon as each holds a
+lease, i.e. in the middle of a subject. The others take over the expired
+leases (after --ttl seconds, see ecutils/leases.py). Then checks that:
+# every subject has a completion marker and no lease is left
+# the scores are the same as from a single process, on a copy of the cohort
+# markers were written by the workers started here
+
+Prints, for each worker, the subjects it completed and the leases it took
+over. Exits with an error if a check fails.
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import synthetic  # noqa: E402
+from ecutils.scores import ScoreStore  # noqa: E402
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--stage', choices=['emg', 'eda'], default='emg')
+parser.add_argument('--workers', type=int, default=4)
+parser.add_argument('--kill', help='number of workers killed', type=int,
+                    default=2)
+parser.add_argument('--subjects', type=int, default=8)
+parser.add_argument('--length', help='session length, see synthetic.py',
+                    type=float, default=.25)
+parser.add_argument('--ttl', help='lease expiry (s)', type=float, default=2.)
+parser.add_argument('--keep', help='keep temporary directories',
+                    action='store_true')
+args = parser.parse_args()
+
+script = os.path.join(ROOT, args.stage + '_master.py')
+env = dict(os.environ, MPLBACKEND='Agg',
+           PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+
+
+def cohort():
+    directory = tempfile.mkdtemp(prefix='workers_')
+    synthetic.write_cohort(os.path.join(directory, 'out', 'raw_data'),
+                           args.subjects, args.length)
+    return directory
+
+
+def held_by(directory, pid):
+    """Lease files of a worker process"""
+
+    leases = []
+    pattern = os.path.join(directory, 'out', 'work', args.stage, 'leases',
+                           '*.lease')
+    for file_name in glob.glob(pattern):
+        try:
+            with open(file_name) as f:
+                if json.load(f)['pid'] == pid:
+                    leases.append(file_name)
+        except (OSError, ValueError, KeyError):
+            pass  # released, or being written
+    return leases
+
+
+def scores(directory):
+    df = ScoreStore(args.stage, directory=os.path.join(
+        directory, 'out', 'scores')).read()
+    df = df.astype({'code': str, 'stimulus': str})
+    return df.sort_values(['code', 'stimulus', 'trial']).reset_index(
+        drop=True)
+
+
+shared = cohort()
+print('cohort of {} subjects in {}'.format(args.subjects, shared))
+reference = tempfile.mkdtemp(prefix='workers_')
+shutil.copytree(os.path.join(shared, 'out'), os.path.join(reference, 'out'))
+
+t0 = time.perf_counter()
+workers = []
+for i in range(args.workers):
+    log = open(os.path.join(shared, 'worker{}.log'.format(i)), 'wt')
+    workers.append((subprocess.Popen(
+        [sys.executable, script, '--worker', '--ttl', str(args.ttl),
+         '--no-figures'], cwd=shared, env=env, stdout=log,
+        stderr=subprocess.STDOUT), log))
+
+killed = set()
+for i, (process, _) in enumerate(workers[:args.kill]):
+    while process.poll() is None and not held_by(shared, process.pid):
+        time.sleep(.01)
+    if process.poll() is None:
+        process.send_signal(signal.SIGKILL)
+        killed.add(i)
+        print('killed worker {} (pid {}) holding {}'.format(
+            i, process.pid, ', '.join(
+                os.path.basename(f) for f in held_by(shared, process.pid))
+            or 'nothing'))
+
+failed = []
+for i, (process, log) in enumerate(workers):
+    code = process.wait()
+    log.close()
+    if i not in killed and code != 0:
+        failed.append('worker {} exited with {}'.format(i, code))
+elapsed = time.perf_counter() - t0
+
+# who completed what
+work = os.path.join(shared, 'out', 'work', args.stage)
+markers = {}
+for file_name in glob.glob(os.path.join(work, 'done', '*.json')):
+    with open(file_name) as f:
+        markers[os.path.basename(file_name)[:-5]] = json.load(f)
+pids = {p.pid for p, _ in workers}
+for i, (process, _) in enumerate(workers):
+    done = sorted(c for c, m in markers.items() if m['pid'] == process.pid)
+    with open(os.path.join(shared, 'worker{}.log'.format(i))) as f:
+        took_over = [line.split(':')[0] for line in f
+                     if 'took over the expired lease' in line]
+    print('worker {}{}: completed {}; took over {}'.format(
+        i, ' (killed)' if i in killed else '', ', '.join(done) or 'nothing',
+        ', '.join(took_over) or 'nothing'))
+print('{} workers finished in {:.1f} s'.format(args.workers, elapsed))
+
+codes = sorted(synthetic.subject_code(n) for n in range(args.subjects))
+missing = sorted(set(codes) - set(markers))
+if missing:
+    failed.append('no completion marker: ' + ', '.join(missing))
+if any(m['pid'] not in pids for m in markers.values()):
+    failed.append('markers written by unknown processes')
+left = glob.glob(os.path.join(work, 'leases', '*'))
+if left:
+    failed.append('leases left: ' + ', '.join(left))
+
+subprocess.run([sys.executable, script, '--no-figures'], cwd=reference,
+               env=env, check=True, stdout=subprocess.DEVNULL)
+df, expected = scores(shared), scores(reference)
+if sorted(df.code.unique()) != codes:
+    failed.append('scores of {} subjects, expected {}'.format(
+        df.code.nunique(), len(codes)))
+elif not (df[['code', 'stimulus', 'trial']].equals(
+        expected[['code', 'stimulus', 'trial']]) and np.allclose(
+        df.amplitude, expected.amplitude, rtol=0, atol=0, equal_nan=True)):
+    failed.append('scores differ from a single process run')
+else:
+    print('scores of all subjects equal to a single process run')
+
+if not args.keep:
+    shutil.rmtree(shared)
+    shutil.rmtree(reference)
+for message in failed:
+    print('FAILED:', message)
+sys.exit(1 if failed else 0)
@@ -1,55 +1,105 @@
-import glob
 import os
 import numpy as np
 import pandas
-from scipy import stats
-import re
 
-emg_paths = glob.glob(os.path.join('out', 'stat_data', 'emg', '*.pickle'))
-eda_paths = glob.glob(os.path.join('out', 'stat_data', 'eda', '*.pickle'))
-
-pat = re.compile('([A-Z]+).pickle')
+from ecutils.scores import ScoreStore
 
 # subjects to exclude after visual inspection
 exclude_emg = {'ESFMRF': 'Bad signal quality (noise)'}
 
-# t-score emg amplitudes for each subject & gather together
-print('Collecting EMG')
-data_frames = []
-for f in emg_paths:
-    code = re.search(pat, f).group(1)
-    raw = pandas.read_pickle(f)
 
-    if code in exclude_emg:
-        print('Excluding subject', code, exclude_emg[code])
-    elif (raw.amplitude > 0.01).sum() < 6:
+def exclusions(codes, rules):
+    """Table of excluded subjects (code, reason) and a mask of kept rows
+
+    Arguments:
+    # codes -- code column of the scores
+    # rules -- list of (reason, row mask) tuples, in order of precedence;
+      reason is a string or an array with a reason for each row. A subject
+      is excluded for the first rule whose mask is true on its rows.
+    """
+
+    reason = pandas.Series(None, index=codes.index, dtype=object)
+    for text, mask in rules:
+        reason = reason.mask(reason.isnull().values & mask, text)
+
+    excluded = (pandas.DataFrame({'code': codes, 'reason': reason})
+                .dropna()
+                .drop_duplicates('code')
+                .reset_index(drop=True))
+    return excluded, reason.isnull().values
+
+
+def _zscore(x):
+    # as scipy.stats.zscore, but NaN (trials which could not be scored) are
+    # left out of the mean and standard deviation
+    return (x - x.mean()) / x.std(ddof=0)
+
+
+def normalize_emg(scores, exclude=exclude_emg):
+    """T-score emg amplitudes of each subject
+
+    Subjects listed in exclude or with less than 6 measurable reactions are
+    left out. Returns normalized scores and a table of excluded subjects.
+    """
+
+    listed = scores.code.astype(object).map(exclude).values
+    n_measurable = ((scores.amplitude > 0.01)
+                    .groupby(scores.code, observed=True, sort=False)
+                    .transform('sum'))
+
+    excluded, keep = exclusions(scores.code, [
+        (listed, pandas.notnull(listed)),
         # here, t-scores would be hard to interpret
-        print('Excluding subject', code, 'Not enough measurable reactions')
-    else:
-        raw.amplitude = 50 + 10 * stats.zscore(raw.amplitude)
-        data_frames.append(raw)
-
-df = pandas.concat(data_frames, ignore_index=True)
-
-# save both as pickle and csv
-df.to_pickle(os.path.join('out', 'stat_data', 'emg.pickle'))
-df.to_csv(os.path.join('out', 'stat_data', 'emg.csv'))
-
-
-# gather together eda amplitudes
-print('Collecting EDA')
-data_frames = []
-for f in eda_paths:
-    code = re.search(pat, f).group(1)
-    raw = pandas.read_pickle(f)
-
-    q = raw.query('stimulus.str.startswith("direct") & amplitude.notna()')
-    if q.shape[0] < 5:
-        print('Excluding subject', code, 'Not enough DE reactions')
-    else:
-        raw.amplitude = np.log(1 + raw.amplitude/raw.amplitude.max())
-        data_frames.append(raw)
-
-df = pandas.concat(data_frames, ignore_index=True)
-df.to_pickle(os.path.join('out', 'stat_data', 'eda.pickle'))
-df.to_csv(os.path.join('out', 'stat_data', 'eda.csv'))
+        ('Not enough measurable reactions', (n_measurable < 6).values),
+        ])
+
+    df = scores[keep].reset_index(drop=True)
+    df['amplitude'] = 50 + 10 * (df.groupby('code', observed=True, sort=False)
+                                 .amplitude
+                                 .transform(_zscore))
+    return df, excluded
+
+
+def normalize_eda(scores):
+    """Scale eda amplitudes of each subject as log(1 + amplitude / max)
+
+    Subjects with less than 5 direct expression reactions are left out.
+    Returns normalized scores and a table of excluded subjects.
+    """
+
+    is_reaction = (scores.stimulus.str.startswith('direct')
+                   & scores.amplitude.notna())
+    n_reactions = is_reaction.groupby(scores.code, observed=True,
+                                      sort=False).transform('sum')
+
+    excluded, keep = exclusions(scores.code, [
+        ('Not enough DE reactions', (n_reactions < 5).values),
+        ])
+
+    df = scores[keep].reset_index(drop=True)
+    a_max = (df.groupby('code', observed=True, sort=False)
+             .amplitude
+             .transform('max'))
+    df['amplitude'] = np.log(1 + df.amplitude/a_max)
+    return df, excluded
+
+
+if __name__ == '__main__':
+    # tables for use outside of python
+    csv_directory = os.path.join('out', 'stat_data')
+    if not os.path.exists(csv_directory):
+        os.makedirs(csv_directory)
+
+    for modality, normalize in [('emg', normalize_emg),
+                                ('eda', normalize_eda)]:
+        print('Collecting', modality.upper())
+        df, excluded = normalize(ScoreStore(modality).read())
+
+        # save both in the score store and as csv
+        ScoreStore(modality, 'normalized').write(df)
+        ScoreStore(modality, 'excluded').write(excluded)
+        df.to_csv(os.path.join(csv_directory, modality + '.csv'))
+        excluded.to_csv(os.path.join(csv_directory,
+                                     modality + '_excluded.csv'))
+        print('Excluded {} of {} subjects, see {}_excluded.csv'.format(
+            len(excluded), df.code.nunique() + len(excluded), modality))
@@ -0,0 +1,68 @@
+"""Convert extracted data from _eda.npy, _emg.npy & _events.txt files into
+subject containers (see ecutils/container.py)"""
+
+import argparse
+import glob
+import numpy as np
+import os
+import re
+import time
+
+from ecutils.container import (STORAGE, SUFFIX, int16_scaling,
+                               write_container)
+from ecutils.eventhandler import EventCollection
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--directory', help='directory with extracted data',
+                    default=os.path.join('out', 'raw_data'))
+parser.add_argument('--fs', help='sampling rate of the old files',
+                    type=float, default=2000.)
+parser.add_argument('--remove', help='remove old files after conversion',
+                    action='store_true')
+parser.add_argument('--storage', help='store signals in a more compact form; '
+                    'int16 covers the range of each signal (old files have '
+                    'no A/D scaling information)', choices=STORAGE)
+parser.add_argument('--compress', help='compress stored signals',
+                    action='store_true')
+args = parser.parse_args()
+
+fname_pattern = re.compile('([A-Z]+)_eda.npy')
+
+for eda_file in sorted(glob.glob(os.path.join(args.directory,
+                                              '[A-Z]*_eda.npy'))):
+    subject = re.search(fname_pattern, eda_file).group(1)
+    old_files = {
+        'eda': eda_file,
+        'emg': eda_file.replace('_eda.npy', '_emg.npy'),
+        'events': eda_file.replace('_eda.npy', '_events.txt'),
+        }
+    if not all(os.path.exists(f) for f in old_files.values()):
+        print(subject, 'incomplete, skipping')
+        continue
+
+    out_file = os.path.join(args.directory, subject + SUFFIX)
+    events = EventCollection.from_txt(old_files['events'])
+
+    with write_container(out_file) as writer:
+        for name in ['eda', 'emg']:
+            data = np.load(old_files[name], mmap_mode='r')
+            scale, offset = None, None
+            if args.storage == 'int16':
+                scale, offset = int16_scaling(data)
+            out = writer.add_channel(
+                name, data.dtype, len(data), args.fs, storage=args.storage,
+                scale=scale, offset=offset, compress=args.compress)
+            out[:] = data
+            del out
+        writer.set_events(events.samples, events.values, args.fs)
+        writer.set_metadata({
+            'subject': subject,
+            'converted_from': [os.path.basename(f)
+                               for f in old_files.values()],
+            'converted': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            })
+    print(subject, '->', out_file)
+
+    if args.remove:
+        for f in old_files.values():
+            os.remove(f)
@@ -1,139 +1,398 @@
-"""
-______________________________________________________________________________
-
- File:                         cvxEDA.py
- Last revised:                 07 Nov 2015 r69
- ______________________________________________________________________________
-
- Copyright (C) 2014-2015 Luca Citi, Alberto Greco
- 
- This program is free software; you can redistribute it and/or modify it under
- the terms of the GNU General Public License as published by the Free Software
- Foundation; either version 3 of the License, or (at your option) any later
- version.
- 
- This program is distributed in the hope that it will be useful, but WITHOUT
- ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
- FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
- 
- You may contact the author by e-mail (lciti@ieee.org).
- ______________________________________________________________________________
-
- This method was first proposed in:
- A Greco, G Valenza, A Lanata, EP Scilingo, and L Citi
- "cvxEDA: a Convex Optimization Approach to Electrodermal Activity Processing"
- IEEE Transactions on Biomedical Engineering, 2015
- DOI: 10.1109/TBME.2015.2474131
-
- If you use this program in support of published research, please include a
- citation of the reference above. If you use this code in a software package,
- please explicitly inform the end users of this copyright notice and ask them
- to cite the reference above in their published research.
- ______________________________________________________________________________
-"""
-
-import numpy as np
-import cvxopt as cv
-import cvxopt.solvers
-
-def cvxEDA(y, delta, tau0=2., tau1=0.7, delta_knot=10., alpha=8e-4, gamma=1e-2,
-           solver=None, options={'reltol':1e-9}):
-    """CVXEDA Convex optimization approach to electrodermal activity processing
-
-    This function implements the cvxEDA algorithm described in "cvxEDA: a
-    Convex Optimization Approach to Electrodermal Activity Processing"
-    (http://dx.doi.org/10.1109/TBME.2015.2474131, also available from the
-    authors' homepages).
-
-    Arguments:
-       y: observed EDA signal (we recommend normalizing it: y = zscore(y))
-       delta: sampling interval (in seconds) of y
-       tau0: slow time constant of the Bateman function
-       tau1: fast time constant of the Bateman function
-       delta_knot: time between knots of the tonic spline function
-       alpha: penalization for the sparse SMNA driver
-       gamma: penalization for the tonic spline coefficients
-       solver: sparse QP solver to be used, see cvxopt.solvers.qp
-       options: solver options, see:
-                http://cvxopt.org/userguide/coneprog.html#algorithm-parameters
-
-    Returns (see paper for details):
-       r: phasic component
-       p: sparse SMNA driver of phasic component
-       t: tonic component
-       l: coefficients of tonic spline
-       d: offset and slope of the linear drift term
-       e: model residuals
-       obj: value of objective function being minimized (eq 15 of paper)
-    """
-
-    n = len(y)
-    y = cv.matrix(y)
-
-    # bateman ARMA model
-    a1 = 1./min(tau1, tau0) # a1 > a0
-    a0 = 1./max(tau1, tau0)
-    ar = np.array([(a1*delta + 2.) * (a0*delta + 2.), 2.*a1*a0*delta**2 - 8.,
-        (a1*delta - 2.) * (a0*delta - 2.)]) / ((a1 - a0) * delta**2)
-    ma = np.array([1., 2., 1.])
-
-    # matrices for ARMA model
-    i = np.arange(2, n)
-    A = cv.spmatrix(np.tile(ar, (n-2,1)), np.c_[i,i,i], np.c_[i,i-1,i-2], (n,n))
-    M = cv.spmatrix(np.tile(ma, (n-2,1)), np.c_[i,i,i], np.c_[i,i-1,i-2], (n,n))
-
-    # spline
-    delta_knot_s = int(round(delta_knot / delta))
-    spl = np.r_[np.arange(1.,delta_knot_s), np.arange(delta_knot_s, 0., -1.)] # order 1
-    spl = np.convolve(spl, spl, 'full')
-    spl /= max(spl)
-    # matrix of spline regressors
-    i = np.c_[np.arange(-(len(spl)//2), (len(spl)+1)//2)] + np.r_[np.arange(0, n, delta_knot_s)]
-    nB = i.shape[1]
-    j = np.tile(np.arange(nB), (len(spl),1))
-    p = np.tile(spl, (nB,1)).T
-    valid = (i >= 0) & (i < n)
-    B = cv.spmatrix(p[valid], i[valid], j[valid])
-
-    # trend
-    C = cv.matrix(np.c_[np.ones(n), np.arange(1., n+1.)/n])
-    nC = C.size[1]
-
-    # Solve the problem:
-    # .5*(M*q + B*l + C*d - y)^2 + alpha*sum(A,1)*p + .5*gamma*l'*l
-    # s.t. A*q >= 0
-
-    old_options = cv.solvers.options.copy()
-    cv.solvers.options.clear()
-    cv.solvers.options.update(options)
-    if solver == 'conelp':
-        # Use conelp
-        z = lambda m,n: cv.spmatrix([],[],[],(m,n))
-        G = cv.sparse([[-A,z(2,n),M,z(nB+2,n)],[z(n+2,nC),C,z(nB+2,nC)],
-                    [z(n,1),-1,1,z(n+nB+2,1)],[z(2*n+2,1),-1,1,z(nB,1)],
-                    [z(n+2,nB),B,z(2,nB),cv.spmatrix(1.0, range(nB), range(nB))]])
-        h = cv.matrix([z(n,1),.5,.5,y,.5,.5,z(nB,1)])
-        c = cv.matrix([(cv.matrix(alpha, (1,n)) * A).T,z(nC,1),1,gamma,z(nB,1)])
-        res = cv.solvers.conelp(c, G, h, dims={'l':n,'q':[n+2,nB+2],'s':[]})
-        obj = res['primal objective']
-    else:
-        # Use qp
-        Mt, Ct, Bt = M.T, C.T, B.T
-        H = cv.sparse([[Mt*M, Ct*M, Bt*M], [Mt*C, Ct*C, Bt*C], 
-                    [Mt*B, Ct*B, Bt*B+gamma*cv.spmatrix(1.0, range(nB), range(nB))]])
-        f = cv.matrix([(cv.matrix(alpha, (1,n)) * A).T - Mt*y,  -(Ct*y), -(Bt*y)])
-        res = cv.solvers.qp(H, f, cv.spmatrix(-A.V, A.I, A.J, (n,len(f))),
-                            cv.matrix(0., (n,1)), solver=solver)
-        obj = res['primal objective'] + .5 * (y.T * y)
-    cv.solvers.options.clear()
-    cv.solvers.options.update(old_options)
-
-    l = res['x'][-nB:]
-    d = res['x'][n:n+nC]
-    t = B*l + C*d
-    q = res['x'][:n]
-    p = A * q
-    r = M * q
-    e = y - r - t
-
-    return (np.array(a).ravel() for a in (r, p, t, l, d, e, obj))
+"""
+______________________________________________________________________________
+
+ File:                         cvxEDA.py
+ Last revised:                 07 Nov 2015 r69
+ ______________________________________________________________________________
+
+ Copyright (C) 2014-2015 Luca Citi, Alberto Greco
+ 
+ This program is free software; you can redistribute it and/or modify it under
+ the terms of the GNU General Public License as published by the Free Software
+ Foundation; either version 3 of the License, or (at your option) any later
+ version.
+ 
+ This program is distributed in the hope that it will be useful, but WITHOUT
+ ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+ FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+ 
+ You may contact the author by e-mail (lciti@ieee.org).
+ ______________________________________________________________________________
+
+ This method was first proposed in:
+ A Greco, G Valenza, A Lanata, EP Scilingo, and L Citi
+ "cvxEDA: a Convex Optimization Approach to Electrodermal Activity Processing"
+ IEEE Transactions on Biomedical Engineering, 2015
+ DOI: 10.1109/TBME.2015.2474131
+
+ If you use this program in support of published research, please include a
+ citation of the reference above. If you use this code in a software package,
+ please explicitly inform the end users of this copyright notice and ask them
+ to cite the reference above in their published research.
+ ______________________________________________________________________________
+"""
+
+import functools
+import warnings
+import numpy as np
+import scipy.sparse as sp
+import cvxopt as cv
+import cvxopt.solvers
+
+from ecutils.qp import solve_qp
+
+MODEL_CACHE_SIZE = 32  # number of CvxEDAModel objects kept by get_model
+
+def cvxEDA(y, delta, tau0=2., tau1=0.7, delta_knot=10., alpha=8e-4, gamma=1e-2,
+           solver=None, options={'reltol':1e-9}, backend=None):
+    """CVXEDA Convex optimization approach to electrodermal activity processing
+
+    This function implements the cvxEDA algorithm described in "cvxEDA: a
+    Convex Optimization Approach to Electrodermal Activity Processing"
+    (http://dx.doi.org/10.1109/TBME.2015.2474131, also available from the
+    authors' homepages).
+
+    Arguments:
+       y: observed EDA signal (we recommend normalizing it: y = zscore(y))
+       delta: sampling interval (in seconds) of y
+       tau0: slow time constant of the Bateman function
+       tau1: fast time constant of the Bateman function
+       delta_knot: time between knots of the tonic spline function
+       alpha: penalization for the sparse SMNA driver
+       gamma: penalization for the tonic spline coefficients
+       solver: sparse QP solver to be used, see cvxopt.solvers.qp
+       options: solver options, see:
+                http://cvxopt.org/userguide/coneprog.html#algorithm-parameters
+       backend: object solving the optimization problem (see CvxoptBackend,
+                ScipyBackend); if given, solver and options are ignored.
+                Default: CvxoptBackend(solver, options)
+
+    Returns (see paper for details):
+       r: phasic component
+       p: sparse SMNA driver of phasic component
+       t: tonic component
+       l: coefficients of tonic spline
+       d: offset and slope of the linear drift term
+       e: model residuals
+       obj: value of objective function being minimized (eq 15 of paper)
+
+    Model matrices are reused between calls with the same signal length and
+    model parameters, see get_model.
+    """
+
+    if backend is None:
+        backend = CvxoptBackend(solver, options)
+    model = get_model(len(y), delta, tau0, tau1, delta_knot)
+    return model.solve(y, alpha, gamma, backend)
+
+
+@functools.lru_cache(maxsize=MODEL_CACHE_SIZE)
+def get_model(n, delta, tau0=2., tau1=0.7, delta_knot=10.):
+    """Return a (shared) CvxEDAModel; the last MODEL_CACHE_SIZE are kept"""
+    return CvxEDAModel(n, delta, tau0, tau1, delta_knot)
+
+
+class CvxEDAModel(object):
+    """Matrices of the cvxEDA model for a given signal length and parameters
+
+    Everything which does not depend on the signal (ARMA matrices A and M,
+    spline basis B, trend C and their products) is built once, so that
+    solve can be called repeatedly for signals of length n. Matrices which
+    depend on gamma are kept for the last value of gamma used.
+    """
+
+    def __init__(self, n, delta, tau0=2., tau1=0.7, delta_knot=10.):
+        self.n = n
+
+        # bateman ARMA model
+        a1 = 1./min(tau1, tau0) # a1 > a0
+        a0 = 1./max(tau1, tau0)
+        ar = np.array([(a1*delta + 2.) * (a0*delta + 2.), 2.*a1*a0*delta**2 - 8.,
+            (a1*delta - 2.) * (a0*delta - 2.)]) / ((a1 - a0) * delta**2)
+        ma = np.array([1., 2., 1.])
+
+        # matrices for ARMA model
+        i = np.arange(2, n)
+        A = cv.spmatrix(np.tile(ar, (n-2,1)), np.c_[i,i,i], np.c_[i,i-1,i-2], (n,n))
+        M = cv.spmatrix(np.tile(ma, (n-2,1)), np.c_[i,i,i], np.c_[i,i-1,i-2], (n,n))
+
+        # spline
+        delta_knot_s = int(round(delta_knot / delta))
+        spl = np.r_[np.arange(1.,delta_knot_s), np.arange(delta_knot_s, 0., -1.)] # order 1
+        spl = np.convolve(spl, spl, 'full')
+        spl /= max(spl)
+        # matrix of spline regressors
+        i = np.c_[np.arange(-(len(spl)//2), (len(spl)+1)//2)] + np.r_[np.arange(0, n, delta_knot_s)]
+        nB = i.shape[1]
+        j = np.tile(np.arange(nB), (len(spl),1))
+        p = np.tile(spl, (nB,1)).T
+        valid = (i >= 0) & (i < n)
+        B = cv.spmatrix(p[valid], i[valid], j[valid])
+
+        # trend
+        C = cv.matrix(np.c_[np.ones(n), np.arange(1., n+1.)/n])
+        nC = C.size[1]
+
+        self.A, self.M, self.B, self.C = A, M, B, C
+        self.nB, self.nC = nB, nC
+        self.ar = ar
+        self.delta_knot_s = delta_knot_s
+
+        # products used by the qp solver
+        Mt, Ct, Bt = M.T, C.T, B.T
+        self.Mt, self.Ct, self.Bt = Mt, Ct, Bt
+        self.H_blocks = [[Mt*M, Ct*M, Bt*M], [Mt*C, Ct*C, Bt*C], [Mt*B, Ct*B, Bt*B]]
+        self.G_qp = cv.spmatrix(-A.V, A.I, A.J, (n,n+nC+nB))
+        self.h_qp = cv.matrix(0., (n,1))
+
+        self._H = (None, None)  # (gamma, H)
+        self._G_conelp = None
+
+    def hessian(self, gamma):
+        """Hessian of the qp problem for a given gamma (last one is kept)"""
+        last_gamma, H = self._H
+        if gamma != last_gamma:
+            nB = self.nB
+            (MM, CM, BM), (MC, CC, BC), (MB, CB, BB) = self.H_blocks
+            H = cv.sparse([[MM, CM, BM], [MC, CC, BC],
+                        [MB, CB, BB+gamma*cv.spmatrix(1.0, range(nB), range(nB))]])
+            self._H = (gamma, H)
+        return H
+
+    def conelp_G(self):
+        """Constraint matrix of the conelp formulation"""
+        if self._G_conelp is None:
+            A, M, B, C = self.A, self.M, self.B, self.C
+            n, nB, nC = self.n, self.nB, self.nC
+            z = lambda m,n: cv.spmatrix([],[],[],(m,n))
+            self._G_conelp = cv.sparse([[-A,z(2,n),M,z(nB+2,n)],[z(n+2,nC),C,z(nB+2,nC)],
+                        [z(n,1),-1,1,z(n+nB+2,1)],[z(2*n+2,1),-1,1,z(nB,1)],
+                        [z(n+2,nB),B,z(2,nB),cv.spmatrix(1.0, range(nB), range(nB))]])
+        return self._G_conelp
+
+    def qp(self, y, alpha, gamma):
+        """Problem for cvxopt.solvers.qp: P, q, G, h (y is a cvxopt matrix)"""
+
+        # Solve the problem:
+        # .5*(M*q + B*l + C*d - y)^2 + alpha*sum(A,1)*p + .5*gamma*l'*l
+        # s.t. A*q >= 0
+
+        n, A = self.n, self.A
+        Mt, Ct, Bt = self.Mt, self.Ct, self.Bt
+        H = self.hessian(gamma)
+        f = cv.matrix([(cv.matrix(alpha, (1,n)) * A).T - Mt*y,  -(Ct*y), -(Bt*y)])
+        return H, f, self.G_qp, self.h_qp
+
+    def conelp(self, y, alpha, gamma):
+        """Problem for cvxopt.solvers.conelp: c, G, h, dims"""
+
+        n, nB, nC, A = self.n, self.nB, self.nC, self.A
+        z = lambda m,n: cv.spmatrix([],[],[],(m,n))
+        G = self.conelp_G()
+        h = cv.matrix([z(n,1),.5,.5,y,.5,.5,z(nB,1)])
+        c = cv.matrix([(cv.matrix(alpha, (1,n)) * A).T,z(nC,1),1,gamma,z(nB,1)])
+        return c, G, h, {'l':n,'q':[n+2,nB+2],'s':[]}
+
+    def solve(self, y, alpha=8e-4, gamma=1e-2, backend=None, initvals=None):
+        """Decompose y, see cvxEDA for arguments and return values
+
+        initvals -- starting point for the solver (see backend.solve)
+        """
+
+        if len(y) != self.n:
+            raise ValueError('Model built for {} samples, got {}'.format(self.n, len(y)))
+        if backend is None:
+            backend = CvxoptBackend()
+        y = cv.matrix(y)
+
+        x, obj = backend.solve(self, y, alpha, gamma, initvals)
+        return self.components(x, y, obj)
+
+    def components(self, x, y, obj):
+        """r, p, t, l, d, e, obj (see cvxEDA) from the solution vector x"""
+
+        n, nB, nC = self.n, self.nB, self.nC
+        A, M, B, C = self.A, self.M, self.B, self.C
+        x = cv.matrix(x)
+        y = cv.matrix(y)
+
+        l = x[-nB:]
+        d = x[n:n+nC]
+        t = B*l + C*d
+        q = x[:n]
+        p = A * q
+        r = M * q
+        e = y - r - t
+
+        return (np.array(a).ravel() for a in (r, p, t, l, d, e, obj))
+
+
+class CvxoptBackend(object):
+    """Solve cvxEDA with cvxopt (qp or conelp, see cvxEDA solver argument)
+
+    Options are passed to the solver on each call; the global
+    cvxopt.solvers.options are not used or modified.
+    """
+
+    def __init__(self, solver=None, options={'reltol':1e-9}):
+        self.solver = solver
+        self.options = dict(options)
+        self.history = []  # status, iterations & objective of each solve
+
+    def solve(self, model, y, alpha, gamma, initvals=None):
+        """Return the solution vector and value of the objective
+
+        initvals -- dict with a starting point x, and optionally slacks s
+        and multipliers z of the constraints (qp solver only); the ones of
+        the last solve are kept in self.last
+        """
+        if self.solver == 'conelp':
+            c, G, h, dims = model.conelp(y, alpha, gamma)
+            res = cv.solvers.conelp(c, G, h, dims=dims, options=self.options)
+            obj = res['primal objective']
+        else:
+            P, q, G, h = model.qp(y, alpha, gamma)
+            if initvals is not None:
+                initvals = {k: cv.matrix(v) for k, v in initvals.items()}
+            res = cv.solvers.qp(P, q, G, h, solver=self.solver,
+                                initvals=initvals, options=self.options)
+            obj = res['primal objective'] + .5 * (y.T * y)
+        self.last = {k: np.array(res[k]).ravel() for k in ('x', 's', 'z')
+                     if res.get(k) is not None}
+        self.history.append({'status': res['status'],
+                             'iterations': res.get('iterations'),
+                             'objective': None if obj is None
+                             else float(np.ravel(obj)[0])})
+        return res['x'], obj
+
+
+class ScipyBackend(object):
+    """Solve cvxEDA with NumPy / SciPy only (ADMM, see ecutils.qp)
+
+    The ADMM linear system is sparse and banded (A, M and B are banded), so
+    it is factorised once (per step size) and each iteration costs O(n).
+    Settings are passed to ecutils.qp.solve_qp; with the defaults, results
+    agree with cvxopt to about 1e-3 of the signal range, see
+    benchmarks/cvxeda_backends.py.
+    """
+
+    def __init__(self, **settings):
+        self.settings = {'eps_abs': 1e-7, 'eps_rel': 1e-7}
+        self.settings.update(settings)
+        self.history = []  # status, iterations & objective of each solve
+
+    def solve(self, model, y, alpha, gamma, initvals=None):
+        """Return the solution vector and value of the objective
+
+        initvals -- dict with a starting point x, and optionally
+        multipliers z of the constraints; the ones of the last solve are
+        kept in self.last
+        """
+        P, q, G, h = [_to_scipy(m) for m in model.qp(y, alpha, gamma)]
+        initvals = initvals or {}
+        res = solve_qp(P, q, G, h, x0=initvals.get('x'),
+                       y0=initvals.get('z'), **self.settings)
+        self.last = {'x': res['x'], 'z': res['y']}
+        if res['status'] != 'optimal':
+            warnings.warn('cvxEDA: ADMM did not converge in {} iterations'
+                          .format(res['iterations']))
+        x = res['x']
+        yy = np.array(y).ravel()
+        obj = .5 * x.dot(P.dot(x)) + q.dot(x) + .5 * yy.dot(yy)
+        self.history.append({'status': res['status'],
+                             'iterations': res['iterations'],
+                             'objective': float(obj)})
+        return x, np.array([obj])
+
+
+BACKENDS = {'cvxopt': CvxoptBackend, 'scipy': ScipyBackend}
+
+
+def _to_scipy(m):
+    """Convert a cvxopt matrix: sparse to scipy csc, dense to 1-D array"""
+    if isinstance(m, cv.spmatrix):
+        return sp.csc_matrix((np.array(m.V).ravel(),
+                              (np.array(m.I).ravel(), np.array(m.J).ravel())),
+                             shape=m.size)
+    return np.array(m).ravel()
+
+def cvxEDA_windowed(y, delta, window=600., overlap=120., delta_knot=10.,
+                    **kwargs):
+    """Windowed cvxEDA: decompose overlapping segments and stitch the results
+
+    Solving cvxEDA on the whole signal scales superlinearly with its length;
+    here the signal is split into segments of (at most) `window` seconds,
+    neighbouring segments overlapping by `overlap` seconds, so the cost grows
+    linearly with signal length. Segment starts are aligned to the knots of
+    the tonic spline. Outputs are joined with a linear cross-fade over the
+    middle half of each overlap; the outer quarters, which are affected by
+    segment edges, are discarded.
+
+    overlap must be positive and at most half of window (also after
+    alignment to the knots), so that no more than two segments overlap.
+
+    Tolerance, measured against the full solve on 20 synthetic 25 minute
+    signals (z-scored, 25 Hz, default window and overlap), as max. absolute
+    difference relative to the signal range: more than 60 s from the ends of
+    the signal, r and t within 1e-3 and e within 5e-4; p is sparse, so
+    individual spikes may shift by a sample or so, but its sums over 5 s stay
+    within 1e-3 of the largest such sum. Within 60 s of the ends, where the
+    split between r and t is poorly determined, differences reached 0.15 for
+    r and t and 1e-2 for e; these are not caused by the seams and do not
+    shrink with a longer overlap.
+    See cvxEDA for the remaining arguments.
+
+    Returns r, p, t, e stitched over the whole signal (same as cvxEDA), and
+       l: list of tonic spline coefficients, one array per segment
+       d: list of offset and slope of the drift, one array per segment
+       obj: sum of objective function values of all segments
+    """
+
+    if not 0 < overlap <= window / 2.:
+        raise ValueError('Overlap must be positive and at most half of the '
+                         'window')
+
+    n = len(y)
+    y = np.asarray(y, dtype=float)
+    knot = int(round(delta_knot / delta))
+    step = int((window - overlap) / delta) // knot * knot
+    seg_len = step + int(round(overlap / delta))
+
+    if n <= seg_len or step == 0:
+        r, p, t, l, d, e, obj = cvxEDA(y, delta, delta_knot=delta_knot,
+                                       **kwargs)
+        return r, p, t, [l], [d], e, obj
+
+    starts = list(range(0, n - seg_len + step, step))
+    ov = seg_len - step  # overlap in samples
+    if ov > step:
+        raise ValueError('Overlap ({} s) longer than the step between '
+                         'segments ({} s, aligned to knots)'.format(
+                             ov * delta, step * delta))
+
+    # weights of a single segment: ramp up / down in the middle of overlaps,
+    # taken at sample centres, so that ramp + ramp[::-1] == 1
+    ramp = np.clip((np.arange(ov) + .5 - ov / 4.) / (ov / 2.), 0., 1.)
+
+    out = np.zeros((4, n))  # r, p, t, e
+    total = np.zeros(n)  # sum of weights, 1 everywhere
+    ls, ds, obj = [], [], 0.
+    for k, start in enumerate(starts):
+        stop = min(start + seg_len, n)
+        r, p, t, l, d, e, o = cvxEDA(y[start:stop], delta,
+                                     delta_knot=delta_knot, **kwargs)
+        w = np.ones(stop - start)
+        if k > 0:
+            w[:ov] = ramp
+        if k < len(starts) - 1:
+            w[-ov:] = ramp[::-1]
+        out[:, start:stop] += w * np.stack([r, p, t, e])
+        total[start:stop] += w
+        ls.append(l)
+        ds.append(d)
+        obj += o[0]
+
+    if not np.allclose(total, 1.):
+        raise RuntimeError('Cross-fade weights do not sum to 1')
+    r, p, t, e = out
+    return r, p, t, ls, ds, e, np.array([obj])
@@ -0,0 +1,149 @@
+import bioread
+import bioread.reader
+import numpy as np
+
+from ecutils import profiling
+from ecutils.container import write_container
+from ecutils.eventhandler import EventCollection, MarkerDecoder
+
+CHUNK_SIZE = 1024 * 1024 * 4  # bytes of interleaved data read at once
+
+
+def channel_dtype(chan):
+    """dtype of channel data after applying scale and offset"""
+    return chan.dtype if chan.dtype.kind == 'f' else np.dtype(np.float64)
+
+
+def scaled(chan, raw):
+    """Same conversion as bioread Channel.data, for a fragment of raw data"""
+    if chan.dtype.kind == 'f':
+        return raw
+    return raw * chan.raw_scale_factor + chan.raw_offset
+
+
+def extract_acq(file_name, out_file, channel_names, first_digital_index=2,
+                width=10, chunk_size=CHUNK_SIZE, metadata=None, storage=None,
+                compress=False):
+    """Stream selected channels of an acq file into a subject container
+
+    Only the requested analog channels and the 8 digital channels used for
+    markers are decoded. Data is read in chunks of roughly chunk_size bytes,
+    written into the memory-mapped container and passed through an
+    incremental marker decoder, so memory use does not depend on recording
+    length.
+
+    Arguments:
+    # file_name -- path to the acq file
+    # out_file -- container file to write (see ecutils.container)
+    # channel_names -- dict: name in container -> acq channel name
+    # first_digital_index -- index of first digital channels
+    # width -- number of samples to check for co-ocurring events
+    # metadata -- dict with provenance information stored in the container
+    # storage -- storage of channels, see ecutils.container.STORAGE; int16
+      uses the A/D scaling from the acq header (lossless), channels without
+      it are stored as float32
+    # compress -- compress channels in the container
+
+    Returns an EventCollection (same as EventCollection.from_acq).
+    The container is written atomically.
+    """
+
+    with open(file_name, 'rb') as f:
+        reader = bioread.reader.Reader.read_headers(f)
+        if reader.datafile is None:
+            raise ValueError('Could not read headers of ' + file_name)
+        channels = reader.datafile.channels
+
+        named = [channels.index(reader.datafile.named_channels[name])
+                 for name in channel_names.values()]
+        digital = list(range(first_digital_index, first_digital_index + 8))
+
+        if reader.is_compressed:
+            # compressed files can not be streamed; still read only
+            # the channels we need
+            return _extract_whole(file_name, out_file, channel_names, named,
+                                  digital, width, metadata, storage, compress)
+
+        decoder = MarkerDecoder(n_channels=8, width=width)
+        samples, values = [], []
+
+        # digital blocks from one chunk may differ in length between channels
+        # (e.g. at the end of file), so they are aligned before decoding
+        leftover = [np.zeros(0) for _ in digital]
+
+        with write_container(out_file) as writer:
+            outs = [_add_channel(writer, name, channels[i], storage, compress)
+                    for name, i in zip(channel_names, named)]
+
+            chunks = reader.stream(named + digital, chunk_size)
+            for buffers in profiling.timed(chunks, 'read'):
+                with profiling.part('write'):
+                    for i, out in zip(named, outs):
+                        buf = buffers[i]
+                        out[buf.channel_slice] = scaled(channels[i],
+                                                        buf.buffer)
+
+                with profiling.part('markers'):
+                    parts = []
+                    for lo, i in zip(leftover, digital):
+                        new = scaled(channels[i], buffers[i].buffer)
+                        parts.append(np.concatenate([lo, new]))
+                    n = min(len(p) for p in parts)
+                    leftover = [p[n:] for p in parts]
+
+                    s, v = decoder.feed(np.stack([p[:n] for p in parts]))
+                    samples.append(s)
+                    values.append(v)
+
+            s, v = decoder.flush()
+            samples.append(s)
+            values.append(v)
+            del outs[:]
+
+            ec = EventCollection.from_arrays(np.concatenate(samples),
+                                             np.concatenate(values))
+            writer.set_events(ec.samples, ec.values,
+                              channels[digital[0]].samples_per_second)
+            writer.set_metadata(metadata or {})
+
+    return ec
+
+
+def _add_channel(writer, name, chan, storage, compress):
+    attributes = {'source_name': chan.name, 'units': chan.units}
+    if chan.dtype.kind != 'f':
+        # A/D scaling, allows lossless int16 storage
+        attributes['raw_scale_factor'] = float(chan.raw_scale_factor)
+        attributes['raw_offset'] = float(chan.raw_offset)
+
+    scale, offset = None, None
+    if storage == 'int16':
+        if chan.dtype.kind == 'f':
+            storage = 'float32'  # no A/D scaling to use
+        else:
+            scale, offset = chan.raw_scale_factor, chan.raw_offset
+
+    return writer.add_channel(
+        name, channel_dtype(chan), chan.point_count, chan.samples_per_second,
+        storage=storage, scale=scale, offset=offset, compress=compress,
+        **attributes)
+
+
+def _extract_whole(file_name, out_file, channel_names, named, digital, width,
+                   metadata, storage, compress):
+    with profiling.part('read'):
+        data = bioread.read_file(file_name, channel_indexes=named + digital)
+    with profiling.part('markers'):
+        ec = EventCollection.from_acq(data, digital[0], width)
+
+    with write_container(out_file) as writer:
+        for name, i in zip(channel_names, named):
+            chan = data.channels[i]
+            out = _add_channel(writer, name, chan, storage, compress)
+            out[:] = chan.data
+            del out
+        writer.set_events(ec.samples, ec.values,
+                          data.channels[digital[0]].samples_per_second)
+        writer.set_metadata(metadata or {})
+
+    return ec
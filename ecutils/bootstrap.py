@@ -0,0 +1,128 @@
+"""Bootstrap confidence intervals and permutation tests, resampled in chunks
+
+Resamples are generated and evaluated as matrices (resamples x subjects):
+indices drawn with replacement for the bootstrap, random signs for the
+sign-flip test of paired differences, random group labels for the
+permutation test of two groups. Each chunk of at most `chunk` resamples
+(memory: about chunk x subjects x 8 bytes) has its own random state, seeded
+with (seed, chunk number), so results depend on the seed and the chunk size
+but not on the number of processes (jobs) the chunks are spread over. The
+seed can be a tuple, e.g. (seed, test number), to give the tests of a table
+independent resamples.
+
+p-values are two-sided, (number of resampled statistics at least as extreme
+as the observed one + 1) / (resamples + 1); confidence intervals are
+percentile intervals of the resampled means.
+"""
+
+import concurrent.futures
+
+import numpy as np
+
+# relative tolerance for resampled statistics equal to the observed one
+TOLERANCE = 1e-12
+
+
+def _means(rng, size, x):
+    return x[rng.randint(len(x), size=(size, len(x)))].mean(axis=1)
+
+
+def _mean_differences(rng, size, x, y):
+    return _means(rng, size, x) - _means(rng, size, y)
+
+
+def _sign_flipped_means(rng, size, d):
+    signs = np.where(rng.random_sample((size, len(d))) < .5, -1., 1.)
+    return signs.dot(d) / len(d)
+
+
+def _permuted_mean_differences(rng, size, x, y):
+    pooled = np.concatenate([x, y])
+    # the first len(x) of a random order of subjects are labelled x
+    in_x = rng.random_sample((size, len(pooled))).argsort(axis=1) < len(x)
+    return (in_x.dot(pooled) / len(x)) - ((~in_x).dot(pooled) / len(y))
+
+
+def _run_chunk(task):
+    func, args, seed, number, size = task
+    rng = np.random.RandomState(list(seed) + [number])
+    return func(rng, size, *args)
+
+
+def resample(func, args, n_resamples, seed=0, chunk=10000, jobs=1):
+    """Statistics of n_resamples resamples, computed in chunks
+
+    Arguments:
+    # func -- func(rng, size, *args) returns statistics of size resamples
+      (a module level function, to be run in other processes)
+    # args -- arrays passed to func
+    # seed -- seed of the random states of chunks, an int or a tuple of
+      ints
+    # chunk -- resamples per chunk
+    # jobs -- number of processes
+    """
+
+    seed = tuple(np.atleast_1d(seed).tolist())
+    tasks = [(func, args, seed, number, min(chunk, n_resamples - start))
+             for number, start in enumerate(range(0, n_resamples, chunk))]
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            parts = list(executor.map(_run_chunk, tasks))
+    else:
+        parts = [_run_chunk(task) for task in tasks]
+    return np.concatenate(parts) if parts else np.zeros(0)
+
+
+def _p_value(observed, resampled):
+    extreme = np.abs(resampled) >= np.abs(observed) * (1 - TOLERANCE)
+    return (extreme.sum() + 1) / (len(resampled) + 1)
+
+
+def _values(x):
+    x = np.asarray(x, dtype=float)
+    return x[~np.isnan(x)]
+
+
+def bootstrap_ci(x, y=None, n_resamples=10000, confidence=.95, **kwargs):
+    """Percentile bootstrap interval of mean(x), or of mean(x) - mean(y) for
+    independent samples (resampled separately); NaN are dropped
+
+    Keyword arguments (seed, chunk, jobs) are passed to resample. Returns
+    a tuple (low, high).
+    """
+
+    x = _values(x)
+    if y is None:
+        means = resample(_means, (x,), n_resamples, **kwargs)
+    else:
+        means = resample(_mean_differences, (x, _values(y)), n_resamples,
+                         **kwargs)
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(means, [tail, 100 - tail])
+    return low, high
+
+
+def sign_flip_test(d, n_resamples=10000, **kwargs):
+    """Test of mean(d) = 0 for paired differences d (e.g. CS+ - CS- of each
+    subject), by random changes of their signs; NaN are dropped
+
+    Returns a tuple (mean, p).
+    """
+
+    d = _values(d)
+    observed = d.mean()
+    return observed, _p_value(observed, resample(
+        _sign_flipped_means, (d,), n_resamples, **kwargs))
+
+
+def permutation_test(x, y, n_resamples=10000, **kwargs):
+    """Test of mean(x) = mean(y) for independent groups, by random
+    assignment of subjects to the groups; NaN are dropped
+
+    Returns a tuple (mean(x) - mean(y), p).
+    """
+
+    x, y = _values(x), _values(y)
+    observed = x.mean() - y.mean()
+    return observed, _p_value(observed, resample(
+        _permuted_mean_differences, (x, y), n_resamples, **kwargs))
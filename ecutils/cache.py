@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+
+from ecutils.storage import atomic_path
+
+CACHE_DIR = os.path.join('out', 'cache')
+
+
+def file_digest(file_name, block_size=1024*1024):
+    """sha256 of file contents"""
+
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_key(input_files, params):
+    """Hash identifying a computation: contents of inputs + parameters
+
+    params must be JSON-serialisable; key order does not matter.
+    """
+
+    h = hashlib.sha256()
+    for file_name in input_files:
+        h.update(file_digest(file_name).encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Records which subjects were processed by a stage, and with what key
+
+    For each subject a small JSON stamp is kept with the key, the list of
+    output files and (optionally) extra results needed later by the stage.
+    A subject is current if the key matches and all outputs still exist.
+    """
+
+    def __init__(self, stage, directory=CACHE_DIR):
+        self.directory = os.path.join(directory, stage)
+
+    def _stamp_file(self, code):
+        return os.path.join(self.directory, code + '.json')
+
+    def lookup(self, code, key):
+        """Return the stamp stored for code if it is current, else None"""
+
+        try:
+            with open(self._stamp_file(code)) as f:
+                stamp = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if stamp['key'] != key:
+            return None
+        if not all(os.path.exists(o) for o in stamp['outputs']):
+            return None
+        return stamp
+
+    def store(self, code, key, outputs, extra=None):
+        os.makedirs(self.directory, exist_ok=True)  # may run in parallel
+
+        stamp = {'key': key, 'outputs': list(outputs), 'extra': extra}
+        with atomic_path(self._stamp_file(code)) as tmp_name:
+            with open(tmp_name, 'wt') as f:
+                json.dump(stamp, f)
@@ -0,0 +1,429 @@
+"""
+Per-subject container: channels, events and metadata in a single file.
+
+Layout: an 8-byte magic string, then array data (each array aligned to 64
+bytes), then a JSON header, its length (8 bytes, little endian) and the
+magic string again. The header describes every array (dtype, shape, offset)
+and is written last, so channels can be streamed into the file before the
+events are known. Readers only parse the header; channels are memory-mapped
+on request, so a consumer reading only EMG or only events never touches the
+rest of the file.
+
+Channels can be stored in a more compact form (see STORAGE), optionally
+compressed in chunks. Reading dequantizes transparently; error bounds:
+# float64 -- exact
+# float32 -- relative error at most 2**-24 (about 6e-8)
+# int16 -- exact for acq channels recorded as integers, when the A/D scale
+  and offset from the acq header are used (values are the original A/D
+  readings); otherwise absolute error at most scale / 2
+Compression (zlib) is lossless, but compressed channels can not be
+memory-mapped: chunks are decompressed when read. With float32 or int16
+storage, amplitudes scored by emg_master.py and eda_master.py differ from
+those of float64 data by at most 1e-3 of the largest amplitude, and the same
+EDA trials are above threshold (tests/test_container.py on synthetic data,
+benchmarks/storage_modes.py on recorded data).
+"""
+
+import contextlib
+import json
+import numpy as np
+import os
+import zlib
+
+from ecutils.eventhandler import EventCollection
+from ecutils.storage import atomic_path
+
+FORMAT_VERSION = 2  # 2: quantized & compressed channels
+SUFFIX = '.physio'
+MAGIC = b'PHYSIO\x00\x01'
+ALIGN = 64
+STORAGE = ['float64', 'float32', 'int16']
+CHUNK_LENGTH = 1024 * 64  # samples per compressed chunk
+
+
+class SubjectFile:
+    """Read access to a subject container"""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+        with open(file_name, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(file_name + ' is not a subject container')
+            f.seek(-len(MAGIC) - 8, os.SEEK_END)
+            header_length = int.from_bytes(f.read(8), 'little')
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(file_name + ' is incomplete')
+            f.seek(-len(MAGIC) - 8 - header_length, os.SEEK_END)
+            header = json.loads(f.read(header_length).decode())
+
+        if header['format_version'] > FORMAT_VERSION:
+            raise ValueError('{} has format version {}, only up to {} is '
+                             'supported'.format(file_name,
+                                                header['format_version'],
+                                                FORMAT_VERSION))
+        self.header = header
+
+    @property
+    def channel_names(self):
+        return list(self.header['channels'])
+
+    @property
+    def metadata(self):
+        """Provenance information (source file, extraction parameters...)"""
+        return self.header['metadata']
+
+    def fs(self, name):
+        """Sampling rate of a channel"""
+        return self.header['channels'][name]['fs']
+
+    def channel(self, name):
+        """Channel data (physical values), read-only
+
+        A memory map if the channel is stored uncompressed in its original
+        dtype, otherwise a ChannelData object which decodes on slicing.
+        """
+
+        channel = self.header['channels'][name]
+        desc = self.header['arrays'][channel['array']]
+        dtype = np.dtype(channel.get('dtype', desc['dtype']))
+        if (desc.get('encoding', 'raw') == 'raw'
+                and desc.get('quantization') is None
+                and np.dtype(desc['dtype']) == dtype):
+            return self._array(channel['array'])
+        return ChannelData(self.file_name, desc, dtype)
+
+    def events(self):
+        """EventCollection with samples at events_fs"""
+        return EventCollection.from_arrays(
+            self._array('event_samples'), self._array('event_values'))
+
+    @property
+    def events_fs(self):
+        return self.header['events']['fs']
+
+    def _array(self, key):
+        desc = self.header['arrays'][key]
+        shape = tuple(desc['shape'])
+        if np.prod(shape) == 0:
+            return np.zeros(shape, dtype=desc['dtype'])
+        return np.memmap(self.file_name, dtype=desc['dtype'], mode='r',
+                         offset=desc['offset'], shape=shape)
+
+
+class ChannelData:
+    """Read-only channel stored in a compact form, see module docstring
+
+    Supports len() and slicing (returning physical values as arrays of the
+    original dtype); other indexing and np.asarray decode the whole channel.
+    """
+
+    def __init__(self, file_name, desc, dtype):
+        self.file_name = file_name
+        self.desc = desc
+        self.dtype = dtype
+        self.shape = tuple(desc['shape'])
+        self.ndim = 1
+        self._stored_dtype = np.dtype(desc['dtype'])
+        self._cached = (None, None)  # last decompressed chunk
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            return self[:][key]
+
+        start, stop, _ = key.indices(len(self))
+        stop = max(start, stop)
+        if self.desc.get('encoding', 'raw') == 'zlib':
+            stored = self._read_chunks(start, stop)
+        elif stop > start:
+            stored = np.memmap(self.file_name, dtype=self._stored_dtype,
+                               mode='r', offset=self.desc['offset'],
+                               shape=self.shape)[start:stop]
+        else:
+            stored = np.zeros(0, dtype=self._stored_dtype)
+        return self._dequantize(stored)
+
+    def _dequantize(self, stored):
+        q = self.desc.get('quantization')
+        if q is None:
+            return stored.astype(self.dtype)
+        # same formula as bioread uses for raw A/D values
+        return stored * q['scale'] + q['offset']
+
+    def _read_chunks(self, start, stop):
+        length = self.desc['chunk_length']
+        parts = []
+        for c in range(start // length, -(-stop // length)):
+            chunk = self._chunk(c)
+            lo = max(start - c * length, 0)
+            parts.append(chunk[lo:stop - c * length])
+        if not parts:
+            return np.zeros(0, dtype=self._stored_dtype)
+        return np.concatenate(parts)
+
+    def _chunk(self, c):
+        if self._cached[0] == c:
+            return self._cached[1]
+        offset, nbytes = self.desc['chunks'][c]
+        with open(self.file_name, 'rb') as f:
+            f.seek(offset)
+            raw = zlib.decompress(f.read(nbytes))
+        chunk = np.frombuffer(raw, dtype=self._stored_dtype)
+        self._cached = (c, chunk)
+        return chunk
+
+
+class _ChannelWriter:
+    """Accepts physical values for consecutive slices of a channel and
+    stores them quantized and/or compressed"""
+
+    def __init__(self, writer, desc, length, memmap=None):
+        self.writer = writer
+        self.desc = desc
+        self.length = length
+        self.memmap = memmap
+        self._stored_dtype = np.dtype(desc['dtype'])
+        self._pending = []  # values not yet compressed
+        self._position = 0
+
+    def _quantize(self, values):
+        q = self.desc.get('quantization')
+        values = np.asarray(values)
+        if q is None:
+            return values.astype(self._stored_dtype)
+        info = np.iinfo(self._stored_dtype)
+        stored = np.round((values - q['offset']) / q['scale'])
+        return np.clip(stored, info.min, info.max).astype(self._stored_dtype)
+
+    def __setitem__(self, key, values):
+        start, stop, _ = key.indices(self.length)
+        stored = self._quantize(values)
+        if self.memmap is not None:
+            self.memmap[start:stop] = stored
+            return
+
+        if start != self._position:
+            raise ValueError('Compressed channels must be written in order')
+        self._position = stop
+        self._pending.append(stored)
+        pending = np.concatenate(self._pending)
+        length = self.desc['chunk_length']
+        n_full = len(pending) // length * length
+        for c in range(0, n_full, length):
+            self._write_chunk(pending[c:c + length])
+        self._pending = [pending[n_full:]]
+
+    def _write_chunk(self, stored):
+        data = zlib.compress(stored.tobytes())
+        self.desc['chunks'].append(
+            [self.writer._append(data), len(data)])
+
+    def close(self):
+        if self.memmap is not None:
+            self.memmap.flush()
+            self.memmap = None
+        elif self._pending:
+            pending = np.concatenate(self._pending)
+            if len(pending):
+                self._write_chunk(pending)
+            self._pending = []
+
+
+class ContainerWriter:
+    """Write a subject container, see module docstring
+
+    Channels are allocated first (add_channel returns a writable memory map
+    to fill in), events and metadata can be set at any time before close.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.header = {'format_version': FORMAT_VERSION, 'arrays': {},
+                       'channels': {}, 'events': None, 'metadata': {}}
+        self._file = open(file_name, 'w+b')
+        self._file.write(MAGIC)
+        self._end = len(MAGIC)
+        self._maps = []
+        self._channels = []  # quantized or compressed
+
+    def _allocate(self, key, dtype, shape):
+        dtype = np.dtype(dtype)
+        offset = -(-self._end // ALIGN) * ALIGN
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        self._end = offset + nbytes
+        self._file.truncate(self._end)
+        self.header['arrays'][key] = {'dtype': dtype.str,
+                                      'shape': list(shape), 'offset': offset}
+        return offset, nbytes
+
+    def _append(self, data):
+        """Write bytes at the end of the file, return their offset"""
+
+        offset = -(-self._end // ALIGN) * ALIGN
+        self._file.seek(offset)
+        self._file.write(data)
+        self._end = offset + len(data)
+        return offset
+
+    def add_channel(self, name, dtype, length, fs, storage=None, scale=None,
+                    offset=None, compress=False, **attributes):
+        """Allocate a channel, return an array-like to be filled with data
+
+        Arguments:
+        # name -- channel name in the container
+        # dtype -- dtype of the (physical) values
+        # length -- number of samples
+        # fs -- sampling rate
+        # storage -- one of STORAGE, default: dtype
+        # scale, offset -- quantization for int16: value = int * scale + offset
+        # compress -- compress the channel in chunks (must then be written
+          in consecutive slices)
+        # attributes -- additional information stored in the header
+
+        Without storage and compress the result is a memory map.
+        """
+
+        dtype = np.dtype(dtype)
+        key = 'channel_' + name
+        self.header['channels'][name] = dict(
+            attributes, array=key, fs=fs, dtype=dtype.str)
+
+        stored = np.dtype(storage if storage is not None else dtype)
+        quantization = None
+        if stored.kind == 'i':
+            if scale is None:
+                raise ValueError('Integer storage requires scale and offset')
+            quantization = {'scale': float(scale),
+                            'offset': float(offset or 0.)}
+
+        if compress:
+            desc = {'dtype': stored.str, 'shape': [length],
+                    'encoding': 'zlib', 'chunk_length': CHUNK_LENGTH,
+                    'chunks': [], 'quantization': quantization}
+            self.header['arrays'][key] = desc
+            channel = _ChannelWriter(self, desc, length)
+            self._channels.append(channel)
+            return channel
+
+        offset_bytes, nbytes = self._allocate(key, stored, (length,))
+        desc = self.header['arrays'][key]
+        desc['quantization'] = quantization
+        if nbytes == 0:
+            return np.zeros(0, dtype=dtype)
+        arr = np.memmap(self._file, dtype=stored, mode='r+',
+                        offset=offset_bytes, shape=(length,))
+        if stored == dtype:
+            self._maps.append(arr)
+            return arr
+        channel = _ChannelWriter(self, desc, length, memmap=arr)
+        self._channels.append(channel)
+        return channel
+
+    def set_events(self, samples, values, fs):
+        for key, arr in [('event_samples', samples), ('event_values', values)]:
+            arr = np.ascontiguousarray(arr, dtype=np.int64)
+            offset, _ = self._allocate(key, arr.dtype, arr.shape)
+            self._file.seek(offset)
+            self._file.write(arr.tobytes())
+        self.header['events'] = {'fs': fs}
+
+    def set_metadata(self, metadata):
+        self.header['metadata'] = dict(metadata)
+
+    def close(self):
+        if self.header['events'] is None:
+            raise ValueError('Events were not set')
+
+        for arr in self._maps:
+            arr.flush()
+        del self._maps[:]
+        for channel in self._channels:
+            channel.close()
+        del self._channels[:]
+
+        header = json.dumps(self.header).encode()
+        self._file.seek(self._end)  # after the last array, not aligned
+        self._file.write(header)
+        self._file.write(len(header).to_bytes(8, 'little'))
+        self._file.write(MAGIC)
+        self._file.close()
+
+    def abort(self):
+        del self._maps[:]
+        del self._channels[:]
+        self._file.close()
+
+
+@contextlib.contextmanager
+def write_container(file_name):
+    """Yield a ContainerWriter; the file appears (atomically) only on success
+    """
+
+    with atomic_path(file_name) as tmp_name:
+        writer = ContainerWriter(tmp_name)
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+
+
+def subject_files(directory):
+    """Containers in directory, as a dict: subject code -> file name"""
+
+    return {f[:-len(SUFFIX)]: os.path.join(directory, f)
+            for f in sorted(os.listdir(directory))
+            if f.endswith(SUFFIX) and not f.startswith('.')}
+
+
+def int16_scaling(data):
+    """Scale and offset mapping the range of data onto int16"""
+
+    lo, hi = float(np.min(data)), float(np.max(data))
+    scale = (hi - lo) / 65534 if hi > lo else 1.
+    return scale, (hi + lo) / 2
+
+
+def recode(src, dst, storage=None, compress=False):
+    """Copy a container, changing how channels are stored
+
+    int16 uses the A/D scaling recorded at extraction if available, otherwise
+    it covers the range of each channel.
+    """
+
+    source = SubjectFile(src)
+    with write_container(dst) as writer:
+        for name in source.channel_names:
+            attributes = dict(source.header['channels'][name])
+            del attributes['array']
+            fs = attributes.pop('fs')
+            data = source.channel(name)
+            dtype = attributes.pop('dtype', data.dtype)
+
+            scale, offset = None, None
+            if storage == 'int16':
+                if 'raw_scale_factor' in attributes:
+                    scale = attributes['raw_scale_factor']
+                    offset = attributes['raw_offset']
+                else:
+                    scale, offset = int16_scaling(data)
+
+            out = writer.add_channel(
+                name, dtype, len(data), fs, storage=storage, scale=scale,
+                offset=offset, compress=compress, **attributes)
+            step = CHUNK_LENGTH * 16
+            for start in range(0, len(data), step):
+                out[start:start + step] = data[start:start + step]
+            del out
+
+        events = source.events()
+        writer.set_events(events.samples, events.values, source.events_fs)
+        writer.set_metadata(source.metadata)
@@ -1,11 +1,20 @@
-import copy
+import os
+
+import numpy as np
+from ecutils.eventhandler import EventCollection
+from ecutils.storage import atomic_path
+
+DECOMPOSITION_DIR = os.path.join('out', 'decompositions')
+
+# smaller event-related increases (µS) are not scored
+THRESHOLD = 0.02
 
 
 class Trial:
     def __init__(self, events, n_samples, n_bl_samples, fs, signal, smna=None):
         """ Build a representation of a trial.
 
-        events -- list of eventhandler.Event objects
+        events -- eventhandler.EventCollection (or list of Event objects)
         n_samples -- number of samples to take, starting from 1st event
         n_bl_samples -- number of baseline samples to store
         fs -- sampling frequency
@@ -20,16 +29,13 @@ class Trial:
             self.smna = smna[start_sample:end_sample]
         else:
             self.smna = None
-        self.events = copy.deepcopy(events)
-        # deepcopy - event objects should not change in their original context
+        # copy aligned with start of the trial, events should not change in
+        # their original context
         # todo: warn if events are beyond <start_sample, end_sample>
-
-        # align events with start of the trial
-        for event in self.events:
-            event.sample -= start_sample
+        self.events = EventCollection.from_list(events, reset_samples=True)
 
         # simplify access to types of events present
-        self.event_values = [e.value for e in self.events]
+        self.event_values = self.events.as_marker_list()
 
         # keep sampling frequency for seconds - samples conversion
         self.fs = fs
@@ -56,7 +62,8 @@ class Trial:
                 # shock (obs US)
                 ax.axvline(e.sample, color='red', linestyle=':')
 
-    def score_eir(self, onset, duration, baseline_length):
+    def score_eir(self, onset, duration, baseline_length,
+                  threshold=THRESHOLD):
 
         # get baseline
         if onset == 0:
@@ -84,7 +91,7 @@ class Trial:
         peak_time = onset + response.argmax() / self.fs
 
         # TODO: change return type
-        if amplitude > 0.02:
+        if amplitude > threshold:
             return amplitude, peak_time
         else:
             return None, None
@@ -106,3 +113,203 @@ class Trial:
 
     def score_peak_to_peak(self, onset, duration, footpoint_limit):
         raise NotImplementedError
+
+
+class TrialSet:
+    def __init__(self, events, onsets, n_samples, n_bl_samples, fs, signal,
+                 smna=None, tonic=None):
+        """ Represent all trials of a phase at once, for vectorized scoring.
+
+        Instead of copying data for every trial, signals are kept whole and
+        trials are windows defined by the onset vector.
+
+        events -- eventhandler.EventCollection for the phase
+        onsets -- trial onsets (in samples), in ascending order
+        n_samples -- number of samples in each trial, starting from onset
+        n_bl_samples -- number of baseline samples before onset
+        fs -- sampling frequency
+        signal -- preprocessed signal, in alignment with the events
+        smna -- sudomotor nerve activity p from cvxEDA (optional)
+        tonic -- tonic component t from cvxEDA (optional, only stored)
+        """
+
+        self.events = events
+        self.onsets = np.asarray(onsets, dtype=int)
+        self.n_samples = n_samples
+        self.n_bl_samples = n_bl_samples
+        self.fs = fs
+        self.signal = signal
+        self.smna = smna
+        self.tonic = tonic
+
+        # range of events belonging to each trial
+        self._first, self._last = self._event_ranges()
+
+    def _event_ranges(self):
+        order = np.argsort(self.events.samples, kind='stable')
+        samples = self.events.samples[order]
+        self._event_order = order
+        return (np.searchsorted(samples, self.onsets),
+                np.searchsorted(samples, self.onsets + self.n_samples))
+
+    def __len__(self):
+        return len(self.onsets)
+
+    def __getitem__(self, n):
+        """Single trial (a Trial object, e.g. for plotting)"""
+
+        onset = self.onsets[n]
+        return Trial(
+            events=self.events.events_between_samples(
+                onset, onset + self.n_samples),
+            n_samples=self.n_samples,
+            n_bl_samples=self.n_bl_samples,
+            fs=self.fs,
+            signal=self.signal,
+            smna=self.smna,
+            )
+
+    def has_marker(self, values):
+        """Boolean array: does a trial contain any of the given markers"""
+
+        matches = np.isin(self.events.values[self._event_order], values)
+        counts = np.concatenate([[0], np.cumsum(matches)])
+        return counts[self._last] > counts[self._first]
+
+    def windows(self, arr, start, stop):
+        """Samples start ... stop-1 of each trial (trials x samples)
+
+        start and stop are relative to trial onsets; samples beyond the trial
+        or the signal are NaN.
+        """
+
+        index = self.onsets[:, np.newaxis] + np.arange(start, stop)
+        inside = ((index >= 0) & (index < len(arr))
+                  & (index < (self.onsets + self.n_samples)[:, np.newaxis]))
+        result = np.full(index.shape, np.nan)
+        result[inside] = arr[index[inside]]
+        return result
+
+    def fragments(self):
+        """Arrays needed to plot all trials (see ecutils.figures)
+
+        Returns a dict: signal and smna (trials x samples, NaN beyond the
+        signal) and the events within trials, as trial index, sample
+        relative to trial onset and marker value.
+        """
+
+        counts = self._last - self._first
+        event_trial = np.repeat(np.arange(len(self)), counts)
+        # positions of the events in sorted order, trial after trial
+        offsets = np.repeat(self._first - np.cumsum(counts) + counts, counts)
+        order = self._event_order[np.arange(counts.sum()) + offsets]
+
+        smna = self.smna if self.smna is not None else np.full(
+            len(self.signal), np.nan)
+        return {
+            'signal': self.windows(self.signal, 0, self.n_samples),
+            'smna': self.windows(smna, 0, self.n_samples),
+            'event_trial': event_trial,
+            'event_sample': (self.events.samples[order]
+                             - self.onsets[event_trial]),
+            'event_value': self.events.values[order],
+            }
+
+    def score_eir(self, onset, duration, baseline_length,
+                  threshold=THRESHOLD):
+        """Vectorized Trial.score_eir, returns arrays of amplitudes and peak
+        times (NaN where amplitude is below threshold)"""
+
+        # get baseline
+        bl_end_smp = int(baseline_length * self.fs)
+        if onset == 0:
+            # take baseline from the reversed samples before onset
+            if (bl_end_smp > self.n_bl_samples
+                    or np.any(self.onsets < self.n_bl_samples)):
+                raise ValueError('Baseline too long')
+            baseline = self.windows(self.signal, 1 - bl_end_smp, 1)[:, ::-1]
+        else:
+            # take baseline from the trial signal
+            bl_start_smp = int((onset - baseline_length) * self.fs)
+            bl_end_smp = int(onset * self.fs)
+            if bl_start_smp < 0:
+                # this could be mitigated, but is unlikely to be useful
+                raise ValueError('For start > 0, baseline is too long')
+            baseline = self.windows(self.signal, bl_start_smp, bl_end_smp)
+
+        # get response
+        r_start_smp = int(onset * self.fs)
+        r_end_smp = int((onset + duration) * self.fs)
+        response = self.windows(self.signal, r_start_smp, r_end_smp)
+
+        # calculate amplitude & peak time
+        amplitude = np.nanmax(response, axis=1) - np.nanmean(baseline, axis=1)
+        peak_time = onset + np.nanargmax(response, axis=1) / self.fs
+
+        below = ~(amplitude > threshold)
+        amplitude[below] = np.nan
+        peak_time[below] = np.nan
+        return amplitude, peak_time
+
+    def score_smna(self, onset, duration):
+        """Vectorized Trial.score_smna, returns array of amplitudes"""
+
+        if self.smna is None:
+            return None
+
+        r_start_smp = int(onset * self.fs)
+        r_end_smp = int((onset + duration) * self.fs)
+        response = self.windows(self.smna, r_start_smp, r_end_smp)
+
+        return np.nansum(response, axis=1), None
+
+
+def save_trial_sets(file_name, **trial_sets):
+    """Store decomposed phases, so that trials can be scored again without
+    solving cvxEDA (e.g. with other scoring windows, see sweep_eda.py)
+
+    Trial sets (given by name, e.g. obs=..., direct=...) must share the
+    sampling rate and trial length; for each, the phasic (r), SMNA (p) and
+    tonic (t) components of the whole phase, trial onsets and the events of
+    the phase are written to a single .npz file.
+    """
+
+    arrays = {}
+    for name, trials in trial_sets.items():
+        arrays.update({
+            name + '.r': trials.signal,
+            name + '.p': trials.smna,
+            name + '.t': trials.tonic,
+            name + '.onsets': trials.onsets,
+            name + '.event_samples': trials.events.samples,
+            name + '.event_values': trials.events.values,
+            })
+        arrays.update(n_samples=trials.n_samples,
+                      n_bl_samples=trials.n_bl_samples, fs=trials.fs)
+
+    directory = os.path.dirname(file_name)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with atomic_path(file_name) as tmp_name:
+        with open(tmp_name, 'wb') as f:
+            np.savez(f, **arrays)
+    return file_name
+
+
+def load_trial_sets(file_name):
+    """Dict of name: TrialSet, from a file written by save_trial_sets"""
+
+    with np.load(file_name) as data:
+        names = [f[:-len('.onsets')] for f in data.files
+                 if f.endswith('.onsets')]
+        return {name: TrialSet(
+            events=EventCollection.from_arrays(
+                data[name + '.event_samples'], data[name + '.event_values']),
+            onsets=data[name + '.onsets'],
+            n_samples=int(data['n_samples']),
+            n_bl_samples=int(data['n_bl_samples']),
+            fs=data['fs'].item(),
+            signal=data[name + '.r'],
+            smna=data[name + '.p'],
+            tonic=data[name + '.t'],
+            ) for name in names}
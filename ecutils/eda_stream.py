@@ -0,0 +1,280 @@
+"""Online decomposition and trial scoring of EDA, while a session is recorded
+
+EDAStream is fed consecutive blocks of EDA at the processing rate (25 Hz,
+i.e. after downsampling, see ecutils.resample). Every hop (a whole number
+of tonic spline knots, 10 s by default) the last window of the signal is
+decomposed with cvxEDA, starting from the solution of the previous window
+shifted to the new one. Samples further than lookahead from the end of the
+window are then final: their phasic (r), SMNA (p) and tonic (t) components
+are emitted and never change afterwards. The window has a fixed length, so
+each update costs the same however long the session is, and a sample is
+final at most lookahead + hop after it was recorded (plus the solve time).
+
+TrialStream collects the final samples and the events, and returns each
+trial of the OFL and DE phases as a TrialSet (of a single trial), to be
+scored like the offline ones (eda_master.score_trials), as soon as the
+samples needed for scoring are final and the trial has ended.
+
+The decomposition of a window does not know the signal after it, so
+components near the end of a window differ from the ones of a solve of the
+whole phase; the lookahead controls this difference, see replay_eda.py.
+"""
+
+import numpy as np
+
+import cvxEDA
+from ecutils.eda import TrialSet
+from ecutils.eventhandler import EventCollection
+
+# start marker: stop marker, prefix of stimulus labels (as in eda_master)
+PHASES = {13: (14, 'obs'), 15: (16, 'direct')}
+# markers starting a trial
+TRIAL_MARKERS = (1, 2)
+
+
+class EDAStream:
+    def __init__(self, fs, window=60., lookahead=10., hop=None, backend=None,
+                 warm_start=True, tau0=2., tau1=.7, delta_knot=10.,
+                 alpha=8e-4, gamma=1e-2):
+        """Sliding window cvxEDA for a signal fed in blocks
+
+        Arguments:
+        # fs -- sampling rate of the signal
+        # window -- length of the decomposed window (s)
+        # lookahead -- signal after a sample needed before it is final (s)
+        # hop -- time between solves (s), rounded to a multiple of
+          delta_knot (default: delta_knot)
+        # backend -- cvxEDA backend (default: cvxopt without progress output)
+        # warm_start -- start each solve from the previous solution
+        # tau0, tau1, delta_knot, alpha, gamma -- see cvxEDA
+        """
+
+        self.fs = fs
+        self.model_params = {'tau0': tau0, 'tau1': tau1,
+                             'delta_knot': delta_knot}
+        self.alpha = alpha
+        self.gamma = gamma
+        self.backend = backend or cvxEDA.CvxoptBackend(
+            options={'reltol': 1e-9, 'show_progress': False})
+        self.warm_start = warm_start
+
+        # window and hop are aligned to the knots of the tonic spline, so
+        # that the previous solution can be shifted by whole knots
+        self.knot = int(round(delta_knot * fs))
+        self.hop = max(int(round((hop or delta_knot) * fs / self.knot)),
+                       1) * self.knot
+        self.window = max(int(round(window * fs / self.knot)), 1) * self.knot
+        self.lookahead = int(round(lookahead * fs))
+        if self.window < self.hop + self.lookahead:
+            raise ValueError('Window must be longer than hop + lookahead')
+
+        self.n_samples = 0
+        self.n_final = 0
+        self._solved = 0  # end of the last decomposed window
+        self._buffer = np.zeros(0)
+        self._start = 0  # sample index of the first buffered sample
+        self._last = None  # solution of the last window, for warm start
+
+    @property
+    def latency(self):
+        """Largest delay (in samples) between a sample and its components"""
+        return self.lookahead + self.hop
+
+    def feed(self, eda):
+        """Process a block of EDA
+
+        Returns a dict with components of the samples which became final:
+        start (index of the first of them), r, p and t.
+        """
+
+        self._buffer = np.concatenate([self._buffer,
+                                       np.asarray(eda, dtype=float)])
+        self.n_samples += len(eda)
+
+        start = self.n_final
+        parts = []
+        while self.n_samples - self._solved >= self.hop:
+            self._solved += self.hop
+            parts.append(self._solve(self._solved,
+                                     max(self._solved - self.lookahead, 0)))
+        self._trim()
+        return self._join(start, parts)
+
+    def flush(self):
+        """Decompose the rest of the signal, at the end of the recording"""
+
+        start = self.n_final
+        parts = []
+        if self.n_final < self.n_samples:
+            parts.append(self._solve(self.n_samples, self.n_samples))
+        return self._join(start, parts)
+
+    def _solve(self, end, final):
+        start = max(end - self.window, 0)
+        y = self._buffer[start - self._start:end - self._start]
+        model = cvxEDA.get_model(len(y), 1 / self.fs, **self.model_params)
+        initvals = None
+        if self.warm_start and self._last is not None:
+            initvals = self._initvals(model, start)
+
+        r, p, t, l, d, e, obj = model.solve(y, self.alpha, self.gamma,
+                                            self.backend, initvals)
+        self._last = dict(self.backend.last, start=start, n=len(y))
+
+        first = self.n_final - start
+        self.n_final = final
+        last = final - start
+        return r[first:last], p[first:last], t[first:last]
+
+    def _initvals(self, model, start):
+        """Previous solution shifted to a window beginning at start"""
+
+        last = self._last
+        shift = start - last['start']
+        n0, n = last['n'], model.n
+        x0 = last['x']
+
+        # SMNA state: shifted, then a free decay of the phasic response
+        q = np.zeros(n)
+        keep = min(n0 - shift, n)
+        q[:keep] = x0[shift:shift + keep]
+        a = model.ar
+        for i in range(max(keep, 2), n):
+            q[i] = -(a[1] * q[i - 1] + a[2] * q[i - 2]) / a[0]
+
+        # drift: same line, in coordinates of the new window
+        offset, slope = x0[n0:n0 + 2]
+        d = [offset + slope * shift / n0, slope * n / n0]
+
+        # tonic spline: shifted by whole knots, last coefficient repeated
+        l0 = x0[n0 + 2:]
+        k = int(round(shift / self.knot))
+        l = np.full(model.nB, l0[-1])
+        l[:min(len(l0) - k, model.nB)] = l0[k:k + model.nB]
+
+        # (only the primal solution: shifted multipliers and slacks slow
+        # down both backends)
+        return {'x': np.concatenate([q, d, l])}
+
+    def _join(self, start, parts):
+        if parts:
+            r, p, t = [np.concatenate(c) for c in zip(*parts)]
+        else:
+            r = p = t = np.zeros(0)
+        return {'start': start, 'r': r, 'p': p, 't': t}
+
+    def _trim(self):
+        # windows (also the last one, see flush) start at most this far back
+        keep = self._solved - self.window
+        drop = keep - self._start
+        if drop > len(self._buffer) // 2:
+            self._buffer = self._buffer[drop:]
+            self._start += drop
+
+
+class TrialStream:
+    def __init__(self, fs, trial_length, baseline_length, ready, history=None,
+                 phases=PHASES):
+        """Trials of a session, from final EDA components and events
+
+        Arguments:
+        # fs -- sampling rate
+        # trial_length, baseline_length -- see eda_master.PARAMS (s)
+        # ready -- signal after the trial onset needed for scoring (s)
+        # history -- signal kept before the oldest unscored trial (s,
+          default: baseline_length)
+        # phases -- dict of phase start marker: (stop marker, prefix)
+        """
+
+        self.fs = fs
+        self.n_samples = int(trial_length * fs)
+        self.n_bl_samples = int(baseline_length * fs)
+        self.ready = int(np.ceil(ready * fs))
+        self.history = int((history or baseline_length) * fs)
+        self.phases = phases
+
+        self._signal = np.zeros(0)
+        self._smna = np.zeros(0)
+        self._start = 0  # sample index of the first buffered sample
+        self._events = [], []  # samples, values of events in trials
+        self._phase = None
+        self._trials = {}
+        self._pending = []  # (onset, prefix, number) of started trials
+        self._time = 0  # events are known up to this sample
+
+    def feed(self, components, samples=(), values=(), now=None):
+        """Add final components (EDAStream.feed) and events
+
+        Arguments:
+        # components -- dict with start, r and p
+        # samples, values -- events which occurred since the last call
+        # now -- number of samples recorded so far (events until then are
+          known), default: end of the components
+
+        Returns a list of (prefix, trial number, onset, TrialSet) of trials
+        which can be scored (trials are numbered from 0 in each phase, as
+        by eda_master.score_trials).
+        """
+
+        self._signal = np.concatenate([self._signal, components['r']])
+        self._smna = np.concatenate([self._smna, components['p']])
+        end = self._start + len(self._signal)
+        self._time = max(self._time, end if now is None else now)
+
+        for sample, value in zip(samples, values):
+            if value in self.phases:
+                self._phase = self.phases[value]
+            elif self._phase is not None and value == self._phase[0]:
+                self._phase = None
+            elif self._phase is not None:
+                if value in TRIAL_MARKERS:
+                    number = self._trials.get(self._phase[1], 0)
+                    self._trials[self._phase[1]] = number + 1
+                    self._pending.append((sample, self._phase[1], number))
+                self._events[0].append(sample)
+                self._events[1].append(value)
+
+        done = [t for t in self._pending
+                if t[0] + self.ready <= end
+                and t[0] + self.n_samples <= self._time]
+        self._pending = self._pending[len(done):]
+        trials = [(prefix, number, onset, self._trial(onset))
+                  for onset, prefix, number in done]
+        self._trim()
+        return trials
+
+    def flush(self):
+        """Trials not yet returned, at the end of the recording"""
+
+        self._time = max(self._time, self._start + len(self._signal))
+        trials = [(prefix, number, onset, self._trial(onset))
+                  for onset, prefix, number in self._pending]
+        self._pending = []
+        return trials
+
+    def _trial(self, onset):
+        samples, values = [np.array(a, dtype=np.int64) for a in self._events]
+        inside = (samples >= onset) & (samples < onset + self.n_samples)
+        events = EventCollection.from_arrays(samples[inside] - self._start,
+                                             values[inside])
+        return TrialSet(events=events,
+                        onsets=[onset - self._start],
+                        n_samples=self.n_samples,
+                        n_bl_samples=self.n_bl_samples,
+                        fs=self.fs,
+                        signal=self._signal,
+                        smna=self._smna)
+
+    def _trim(self):
+        end = self._start + len(self._signal)
+        oldest = self._pending[0][0] if self._pending else self._time
+        keep = min(oldest - self.history, end)
+        samples, values = self._events
+        while samples and samples[0] < keep:
+            samples.pop(0)
+            values.pop(0)
+        drop = keep - self._start
+        if drop > len(self._signal) // 2:
+            self._signal = self._signal[drop:]
+            self._smna = self._smna[drop:]
+            self._start += drop
@@ -1,40 +1,144 @@
+import functools
 import numpy as np
 from scipy import signal
 
+# filter settings used by preprocess_emg (frequencies relative to Nyquist)
+FILTER_PARAMS = {
+    'bandpass_order': 4,
+    'bandpass_band': [0.028, 0.500],
+    'smooth_taps': 101,
+    'smooth_cutoff': 0.040,
+    }
+
+
+@functools.lru_cache()
+def _bandpass_filter():
+    return signal.iirfilter(
+        FILTER_PARAMS['bandpass_order'], FILTER_PARAMS['bandpass_band'],
+        btype='bandpass', analog=False, ftype='butter', output='ba')
+
+
+@functools.lru_cache()
+def _smoothing_filter():
+    return signal.firwin(
+        FILTER_PARAMS['smooth_taps'], FILTER_PARAMS['smooth_cutoff'])
+
 
 def preprocess_emg(raw_emg, bandpass=True, rectify=True, smooth=True):
 
     s = raw_emg
 
     if bandpass:
-        b, a = signal.iirfilter(4, [0.028, 0.500], btype='bandpass', analog=False, ftype='butter', output='ba')
+        b, a = _bandpass_filter()
         s = signal.filtfilt(b, a, raw_emg)
 
     if rectify:
         s = np.abs(s)
 
     if smooth:
-        h = signal.firwin(101, 0.040)
-        s = signal.filtfilt(h, np.array([1.]), s)
+        s = signal.filtfilt(_smoothing_filter(), np.array([1.]), s)
 
     return s
 
 
-def extract_trials(signal_array, onsets, samples_before=100, samples_after=300):
+def preprocess_emg_local(raw_emg, samples, before=100, after=300,
+                         padding=1000):
+    """Preprocess EMG only around selected events
+
+    Each window (before, after samples around an event) is extended by
+    padding samples on both sides, so that filter edge effects die out
+    before the window; overlapping segments are merged. The bandpassed and
+    rectified signal is computed once and smoothed afterwards.
+
+    Arguments:
+    # raw_emg -- 1-D array with raw EMG
+    # samples -- event onsets (in samples)
+    # before, after -- window around each event which needs to be valid
+    # padding -- additional samples filtered on each side of a window
+
+    Returns a tuple of arrays shaped like raw_emg: bandpassed & rectified
+    signal and the same signal smoothed (as preprocess_emg with smooth=False
+    and smooth=True). Values outside the padded segments are NaN.
+    """
+
+    n = len(raw_emg)
+    rough = np.full(n, np.nan)
+    smooth = np.full(n, np.nan)
+
+    starts = np.clip(np.sort(samples) - before - padding, 0, n)
+    stops = np.clip(np.sort(samples) + after + padding, 0, n)
+
+    # merge overlapping segments
+    segments = []
+    for start, stop in zip(starts, stops):
+        if segments and start <= segments[-1][1]:
+            segments[-1][1] = max(segments[-1][1], stop)
+        else:
+            segments.append([start, stop])
+
+    for start, stop in segments:
+        s = preprocess_emg(raw_emg[start:stop], smooth=False)
+        rough[start:stop] = s
+        smooth[start:stop] = preprocess_emg(s, bandpass=False, rectify=False)
+
+    return rough, smooth
+
+
+def epochs(signal_array, onsets, samples_before, samples_after,
+           fill=np.nan):
+    """Gather windows around onsets into one (trials x samples) array
+
+    All windows are taken with a single fancy-indexing operation. Samples of
+    windows which extend past the edges of the signal are set to fill.
+
+    Arguments:
+    # signal_array -- 1-D array with channel data
+    # onsets -- event onsets (in samples)
+    # samples_before, samples_after -- window relative to each onset
+    # fill -- value used outside the signal
+    """
+
+    onsets = np.asarray(onsets, dtype=int)
+    index = onsets[:, np.newaxis] + np.arange(-samples_before, samples_after)
+
+    inside = (index >= 0) & (index < len(signal_array))
+    if inside.all():
+        return np.asarray(signal_array[index], dtype=float)
+
+    epochs_array = np.full(index.shape, fill, dtype=float)
+    epochs_array[inside] = signal_array[index[inside]]
+    return epochs_array
+
+
+def startle_amplitude(epochs_prep, onset, baseline, peak_window):
+    """Startle amplitude of each trial: peak minus mean baseline, at least 0
+
+    Trials whose windows extend past the signal (samples filled with NaN by
+    epochs) are NaN, not 0, so they are not counted as absent responses.
+
+    Arguments:
+    # epochs_prep -- (trials x samples) array of preprocessed EMG
+    # onset -- index of the probe in each window
+    # baseline -- number of samples before the probe
+    # peak_window -- first and last (exclusive) sample after the probe
+    """
+
+    base = epochs_prep[:, onset - baseline:onset].mean(axis=1)
+    pk_start, pk_end = [onset + x for x in peak_window]
+    peak = epochs_prep[:, pk_start:pk_end].max(axis=1)
+    amplitude = peak - base
+    return np.where(np.isnan(amplitude), np.nan, np.maximum(amplitude, 0.))
+
+
+def extract_trials(signal_array, onsets, samples_before=100, samples_after=300,
+                   fill=np.nan):
     """
     Extract trials from a given channel, relative to a given marker value.
     :param signal_array: 1-D array with channel data
     :param onsets: event onsets (in samples)
     :param samples_before: number of samples taken before the marker
     :param samples_after: number of samples taken after the marker
+    :param fill: value for samples beyond the edges of the signal
     :return: trials_array: array containing trials, with shape (trials x samples)
     """
-    window_size = samples_before + samples_after
-    n_trials = len(onsets)
-    trials_array = np.zeros((n_trials, window_size))
-
-    for n in range(n_trials):
-        s = onsets[n]
-        trials_array[n, :] = signal_array[s - samples_before:s + samples_after]
-
-    return trials_array
+    return epochs(signal_array, onsets, samples_before, samples_after, fill)
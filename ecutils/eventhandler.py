@@ -1,19 +1,222 @@
 import numpy as np
-import copy
+
+
+def find_rising_edges(data, threshold=2.5):
+    """Return indices of rising edges in a digital channel
+
+    Index i marks a transition between samples i and i+1, i.e. the same
+    position as in np.diff of the binarised channel.
+    """
+    d = (np.asarray(data) > threshold).view(np.int8)  # binary (0/1)
+    return np.flatnonzero(np.diff(d) > 0)
+
+
+def group_edges(edges, width, resume=-1, complete=None):
+    """Merge rising edges from several channels into marker events
+
+    Arguments:
+    # edges -- list of arrays with rising edge indices, one per channel
+    #          (channel n contributes 2**n to the marker value)
+    # width -- number of samples to check for co-ocurring events
+    # resume -- edges before this index can not start a new event
+    # complete -- number of edge indices decoded so far; events whose window
+    #             extends past it are not returned (None: input is complete)
+
+    An event starts at the first edge on any channel; all edges within
+    the following `width` samples (on all channels) are merged into its
+    value, and the search resumes `width` samples after the event start.
+
+    Returns two integer arrays: event samples and marker values.
+    """
+
+    candidates = np.unique(np.concatenate(edges)) if edges else []
+
+    # greedy skip-ahead: only candidate edges are visited, not all samples
+    starts = []
+    next_free = resume
+    for c in candidates:
+        if c >= next_free:
+            if complete is not None and c + width > complete:
+                break  # window not fully decoded yet
+            starts.append(c)
+            next_free = c + width
+    starts = np.array(starts, dtype=np.int64)
+
+    values = np.zeros(len(starts), dtype=np.int64)
+    for n, chan_edges in enumerate(edges):
+        first = np.searchsorted(chan_edges, starts, side='left')
+        last = np.searchsorted(chan_edges, starts + width, side='left')
+        values += (last > first) * 2**n
+
+    return starts, values
+
+
+def marker_channels(samples, values, start, stop, n_channels=8, pulse=20,
+                    level=5):
+    """Digital channels encoding marker events, as decoded by from_acq
+
+    The pulse of an event at sample s starts at s + 1, so that its rising
+    edge is found at s. Channel n is high for values with bit n set.
+
+    Arguments:
+    # samples, values -- marker events, sorted by sample
+    # start, stop -- range of samples to encode
+    # pulse -- pulse length in samples (shorter than the gap between events)
+    # level -- value of high samples
+
+    Returns a uint8 array of shape (n_channels, stop - start).
+    """
+
+    channels = np.zeros((n_channels, stop - start), dtype=np.uint8)
+    first, last = np.searchsorted(samples, [start - pulse, stop])
+    for s, v in zip(samples[first:last], values[first:last]):
+        on = min(max(s + 1 - start, 0), stop - start)
+        off = min(max(s + 1 + pulse - start, 0), stop - start)
+        for bit in range(n_channels):
+            if v & (1 << bit):
+                channels[bit, on:off] = level
+    return channels
+
+
+class MarkerDecoder:
+    """Incremental version of the marker detection done by from_acq
+
+    Digital channels are fed in consecutive blocks; the last binary sample of
+    each block and edges belonging to not yet completed events are carried
+    over, so the result does not depend on how the recording is split.
+    """
+
+    def __init__(self, n_channels=8, width=10, threshold=2.5):
+        self.width = width
+        self.threshold = threshold
+        self.n_samples = 0
+        self.resume = -1
+        self.previous = None
+        self.pending = [np.zeros(0, dtype=np.int64) for _ in range(n_channels)]
+
+    def feed(self, block):
+        """Decode a block of shape (channels, samples)
+
+        Returns event samples and values which are already complete.
+        """
+
+        block = np.asarray(block) > self.threshold
+        if block.shape[1] == 0:
+            return self._emit(self.n_samples - 1)
+
+        if self.previous is not None:
+            block = np.hstack([self.previous[:, np.newaxis], block])
+            offset = self.n_samples - 1
+        else:
+            offset = 0
+
+        # all channels at once; most blocks (when streaming) have no edges
+        channel, edges = np.nonzero(np.diff(block.view(np.int8), axis=1) > 0)
+        for i in np.unique(channel):
+            self.pending[i] = np.concatenate([self.pending[i],
+                                              edges[channel == i] + offset])
+
+        self.previous = block[:, -1]
+        self.n_samples = offset + block.shape[1]
+
+        # there are n_samples - 1 edge positions known so far
+        return self._emit(self.n_samples - 1)
+
+    def flush(self):
+        """Return remaining events, at the end of the recording"""
+        return self._emit(None)
+
+    def _emit(self, complete):
+        if not any(len(e) for e in self.pending):
+            return (np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.int64))
+        samples, values = group_edges(
+            self.pending, self.width, self.resume, complete)
+        if len(samples) > 0:
+            self.resume = samples[-1] + self.width
+            self.pending = [e[e >= self.resume] for e in self.pending]
+        return samples, values
 
 
 class Event:
+    """A single event
+
+    Events taken from an EventCollection are views: setting sample or value
+    changes the collection they came from.
+    """
+
     def __init__(self, sample, value):
-        self.sample = sample
-        self.value = value
+        self._collection = EventCollection([sample], [value])
+        self._index = 0
+
+    @classmethod
+    def _view(cls, collection, index):
+        event = cls.__new__(cls)
+        event._collection = collection
+        event._index = index
+        return event
+
+    @property
+    def sample(self):
+        return int(self._collection.samples[self._index])
+
+    @sample.setter
+    def sample(self, sample):
+        self._collection.samples[self._index] = sample
+        self._collection._modified()
+
+    @property
+    def value(self):
+        return int(self._collection.values[self._index])
+
+    @value.setter
+    def value(self, value):
+        self._collection.values[self._index] = value
+        self._collection._modified()
 
     def __str__(self):
         return 'Event: (' + str(self.sample) + ', ' + str(self.value) + ')'
 
 
 class EventCollection:
-    def __init__(self):
-        self.events = []
+    """Events stored as parallel arrays of samples and values
+
+    Samples are normally in ascending order (as recorded), which allows range
+    queries by binary search. Contiguous subsets (slices, events between
+    samples or markers) are views sharing memory with the collection they
+    were taken from. The collection also behaves as a sequence of Event
+    objects, for compatibility with code written for a list of events.
+    """
+
+    def __init__(self, samples=(), values=()):
+        self.samples = np.array(samples, dtype=np.int64)
+        self.values = np.array(values, dtype=np.int64)
+        # shared by views: incremented on every change, invalidates indexes
+        self._state = {'version': 0}
+        self._indexes = (None, {})
+
+    @classmethod
+    def _view(cls, samples, values, state):
+        ec = cls.__new__(cls)
+        ec.samples = samples
+        ec.values = values
+        ec._state = state
+        ec._indexes = (None, {})
+        return ec
+
+    def _modified(self):
+        self._state['version'] += 1
+
+    def _index(self, name, build):
+        """Return an index built by build(), cached until the next change"""
+
+        version, indexes = self._indexes
+        if version != self._state['version']:
+            indexes = {}
+            self._indexes = (self._state['version'], indexes)
+        if name not in indexes:
+            indexes[name] = build()
+        return indexes[name]
 
     @classmethod
     def from_acq(cls, data_obj, first_digital_index=2, width=10):
@@ -25,60 +228,44 @@ class EventCollection:
         # width -- number of samples to check for co-ocurring events
         """
 
-        ec = cls()
-
-        n_samples = data_obj.channels[first_digital_index].point_count
-        binary_onsets = np.zeros([8, n_samples - 1], dtype=np.int)
+        edges = [
+            find_rising_edges(data_obj.channels[first_digital_index + i].data)
+            for i in range(8)
+            ]
 
-        # detect rising edges and store them in an array
-        for i in range(8):
-            chan = data_obj.channels[first_digital_index + i]
-            d = (chan.data > 2.5).astype(np.int)  # binary (0/1)
-            edges = (np.diff(d) > 0).astype(np.int)   # rising edges
+        samples, values = group_edges(edges, width)
+        return cls.from_arrays(samples, values)
 
-            binary_onsets[i] = edges
-
-        i = 0
-        while i < n_samples - 1:
-            # go sample by sample
-
-            if np.sum(binary_onsets[:, i]) > 0:
-                # if there was a rising edge on one of the channels
-                # check neigborhood on all channels & convert to decimal
-                fragment = binary_onsets[:, i:i+width]
-                vec = np.max(fragment, axis=1)
-                marker_value = cls.to_decimal(vec)
-                ec.events.append(Event(i, marker_value))  # <<<< TUTAJ
-                i += width
-            else:
-                i += 1
-
-        return ec
+    @classmethod
+    def from_arrays(cls, samples, values):
+        """Create a collection of events from arrays of samples and values"""
+        return cls(samples, values)
 
     @classmethod
     def from_txt(cls, file_name):
         """Create a collection of events from text file"""
 
-        ec = cls()
-
         with open(file_name) as f:
-            lines = f.readlines()
-            for line in lines:
-                onset, value = line.rstrip().split()
-                ec.events.append(Event(int(onset), int(value)))
-        return ec
+            pairs = [line.split() for line in f if line.strip()]
+        pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        return cls(pairs[:, 0], pairs[:, 1])
 
     @classmethod
     def from_list(cls, events_list, reset_samples=True):
-        """Create a new collection of events from a list of events"""
+        """Create a new collection of events from a list of events
+
+        events_list may be an EventCollection or a list of Event objects;
+        the new collection is a copy.
+        """
 
-        ec = cls()
+        if isinstance(events_list, EventCollection):
+            ec = cls(events_list.samples, events_list.values)
+        else:
+            ec = cls([e.sample for e in events_list],
+                     [e.value for e in events_list])
 
-        ec.events = copy.deepcopy(events_list)
-        if reset_samples:
-            zero = ec.events[0].sample
-            for e in ec.events:
-                e.sample -= zero
+        if reset_samples and len(ec.samples) > 0:
+            ec.samples -= ec.samples[0]
 
         return ec
 
@@ -90,41 +277,101 @@ class EventCollection:
 
     def to_txt(self, file_name):
         with open(file_name, 'wt') as f:
-            for e in self.events:
-                f.write('{}\t{}\n'.format(e.sample, e.value))
+            for sample, value in zip(self.samples.tolist(),
+                                     self.values.tolist()):
+                f.write('{}\t{}\n'.format(sample, value))
 
     def downsample(self, factor):
-        for event in self.events:
-            event.sample = int(round(event.sample / factor))
+        # in place, so that views see the change
+        self.samples[:] = np.round(self.samples / factor)
+        self._modified()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._view(self.samples[key], self.values[key], self._state)
+        if isinstance(key, (int, np.integer)):
+            if not -len(self) <= key < len(self):
+                raise IndexError('event index out of range')
+            return Event._view(self, key % len(self))
+        # fancy indexing gives a copy
+        return EventCollection(self.samples[key], self.values[key])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield Event._view(self, i)
+
+    @property
+    def events(self):
+        # formerly a list of Event objects
+        return self
 
     def all_events(self):
-        return self.events
+        return self
 
     def as_marker_list(self):
-        return [event.value for event in self.events]
+        return self.values.tolist()
+
+    def indices_for_marker(self, m):
+        """Indices of events with value m, from a per-marker index"""
+
+        def build():
+            order = np.argsort(self.values, kind='stable')
+            markers, starts = np.unique(self.values[order], return_index=True)
+            return dict(zip(markers.tolist(), np.split(order, starts[1:])))
+
+        index = self._index('marker', build)
+        return index.get(m, np.zeros(0, dtype=np.int64))
 
     def samples_for_marker(self, m):
-        return [event.sample for event in self.events if event.value == m]
+        return self.samples[self.indices_for_marker(m)].tolist()
 
     def remove_at_index(self, x):
-        self.events.pop(x)
+        self.samples = np.delete(self.samples, x)
+        self.values = np.delete(self.values, x)
+        self._state = {'version': 0}  # no longer shares memory with views
+        self._indexes = (None, {})
 
     def remove_before_index(self, x):
-        self.events = self.events[x:]
+        self.samples = self.samples[x:]
+        self.values = self.values[x:]
+        self._indexes = (None, {})
 
     def events_between_samples(self, start, stop):
-        return [event for event in self.events if start <= event.sample < stop]
+        """Events with start <= sample < stop
+
+        A view found by binary search if samples are in ascending order,
+        otherwise a copy.
+        """
+
+        is_sorted = self._index(
+            'sorted', lambda: bool(np.all(np.diff(self.samples) >= 0)))
+        if not is_sorted:
+            return self[np.flatnonzero(
+                (self.samples >= start) & (self.samples < stop))]
+
+        first, last = np.searchsorted(self.samples, [start, stop])
+        return self[first:max(first, last)]
 
     def events_between_events(self, start_marker, stop_marker):
-        append = False
-        matching_events = []
-        for event in self.events:
-            if event.value == start_marker:
-                append = True
-            elif event.value == stop_marker:
-                append = False
-
-            if append:
-                matching_events.append(event)
-
-        return matching_events
+        """Events from start_marker (inclusive) to stop_marker (exclusive)
+
+        If the markers occur more than once, all such stretches are included;
+        a single stretch is returned as a view, several as a copy.
+        """
+
+        # most recent start / stop marker before each event (0 if none)
+        toggle = np.zeros(len(self), dtype=np.int8)
+        toggle[self.values == stop_marker] = -1
+        toggle[self.values == start_marker] = 1
+        last = np.maximum.accumulate(
+            np.where(toggle != 0, np.arange(len(self)), -1))
+        inside = (last >= 0) & (toggle[np.maximum(last, 0)] == 1)
+
+        indices = np.flatnonzero(inside)
+        if len(indices) == 0 or indices[-1] - indices[0] + 1 == len(indices):
+            first = indices[0] if len(indices) else 0
+            return self[first:first + len(indices)]
+        return self[indices]
@@ -0,0 +1,240 @@
+import concurrent.futures
+import glob
+import numpy as np
+import os
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from ecutils import profiling
+from ecutils.storage import atomic_path
+
+FRAGMENT_DIR = os.path.join('out', 'fragments')
+FIGURE_DIR = os.path.join('out', 'figures')
+
+# colours of event markers in EDA trial plots
+EVENT_COLORS = {4: 'green', 5: 'green', 6: 'green',  # startle probes
+                7: 'black',
+                8: 'red'}  # shock (obs US)
+
+# EMG trial types, in order of fragments
+EMG_CONDITIONS = ['fix', 'CS+', 'CS-']
+
+# figures (with their artists) kept for reuse, by kind & layout
+_figures = {}
+
+
+def save_fragments(file_name, kind, **arrays):
+    """Store signal fragments for rendering a figure later
+
+    Scoring only saves the data; figures are drawn from these files by
+    render(), in another process or on demand (see render_figures.py).
+
+    Arguments:
+    # file_name -- .npz file, figures are named after it
+    # kind -- key of RENDERERS
+    # arrays -- data & layout (keyword arguments of the renderer)
+    """
+
+    directory = os.path.dirname(file_name)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with atomic_path(file_name) as tmp_name:
+        with open(tmp_name, 'wb') as f:
+            np.savez(f, kind=kind, **arrays)
+    return file_name
+
+
+def fragment_files(modality, codes=None):
+    """Fragment files of a modality, optionally only for given subjects"""
+
+    files = sorted(glob.glob(os.path.join(FRAGMENT_DIR, modality, '*.npz')))
+    if codes is not None:
+        files = [f for f in files
+                 if os.path.basename(f).split('_')[0].split('.')[0] in codes]
+    return files
+
+
+def render(fragment_file, fig_directory):
+    """Draw figures from a fragment file, returns list of figure files"""
+
+    with np.load(fragment_file) as data:
+        arrays = {name: data[name] for name in data.files}
+    kind = str(arrays.pop('kind'))
+    name = os.path.splitext(os.path.basename(fragment_file))[0]
+
+    if not os.path.exists(fig_directory):
+        os.makedirs(fig_directory, exist_ok=True)
+    with profiling.stage('render', name.split('_')[0], kind=kind):
+        return RENDERERS[kind](os.path.join(fig_directory, name), **arrays)
+
+
+def _save(fig, fig_file):
+    with atomic_path(fig_file) as tmp_name:
+        fig.savefig(tmp_name, format='png')
+    return fig_file
+
+
+def _eda_figure(nrows, ncols):
+    """Figure with a grid of trial axes, created once per layout"""
+
+    key = ('eda_trials', nrows, ncols)
+    if key not in _figures:
+        fig = Figure(figsize=(12.8, 7.2))
+        FigureCanvasAgg(fig)
+        axs = fig.subplots(nrows, ncols, sharey=True, squeeze=False)
+        artists = []
+        for ax in axs.flat:
+            tx = ax.twinx()
+            line, = ax.plot([], [], color='C1')
+            smna, = tx.plot([], [], color='C2', alpha=0.5)
+            ax.axis('off')
+            tx.axis('off')
+            # event markers, added as needed and reused
+            artists.append({'ax': ax, 'tx': tx, 'line': line, 'smna': smna,
+                            'markers': []})
+        _figures[key] = fig, artists
+    return _figures[key]
+
+
+def render_eda_trials(base_name, signal, smna, event_trial, event_sample,
+                      event_value, nrows, ncols):
+    """Grid of EDA trials (signal, SMNA and event markers)
+
+    Produced by TrialSet.fragments; trials beyond the grid are not shown.
+    """
+
+    fig, artists = _eda_figure(int(nrows), int(ncols))
+    n_trials = len(signal)
+    pmax = np.nanmax(smna) if np.any(np.isfinite(smna)) else 1.
+    x = np.arange(signal.shape[1])
+
+    for i, a in enumerate(artists):
+        visible = i < n_trials
+        a['ax'].set_visible(visible)
+        a['tx'].set_visible(visible)
+        if not visible:
+            # no data, so that it does not affect the shared y axis
+            a['line'].set_data([], [])
+            a['smna'].set_data([], [])
+            continue
+
+        a['line'].set_data(x, signal[i])
+        a['smna'].set_data(x, smna[i])
+        a['tx'].set_ylim(0, pmax)
+
+        in_trial = (event_trial == i) & np.isin(event_value,
+                                                list(EVENT_COLORS))
+        samples, values = event_sample[in_trial], event_value[in_trial]
+        while len(a['markers']) < len(samples):
+            a['markers'].append(a['ax'].axvline(0, linestyle=':'))
+        for marker, sample, value in zip(a['markers'], samples, values):
+            marker.set_xdata([sample, sample])
+            marker.set_color(EVENT_COLORS[value])
+        for n, marker in enumerate(a['markers']):
+            marker.set_visible(n < len(samples))
+
+    # limits of all axes first, as y is shared
+    for a in artists:
+        a['ax'].relim(visible_only=True)
+    for a in artists:
+        a['ax'].autoscale_view()
+
+    return [_save(fig, base_name + '.png')]
+
+
+def _emg_figure(n_trials):
+    """Grid of startle trial axes, created once per number of trials"""
+
+    key = ('emg_grid', n_trials)
+    if key not in _figures:
+        s_before = 100
+        s_after = 300
+        t_axis = np.linspace(-s_before/2, s_after/2, s_before + s_after)
+        y_max = 0.20  # uniform for all subjects, should fit most reactions
+
+        n_rows, n_cols = 3, int(np.ceil(n_trials/3))
+        fig = Figure(figsize=(24, 12))
+        FigureCanvasAgg(fig)
+        axs = fig.subplots(n_rows, n_cols, sharex='all', sharey='all',
+                           squeeze=False)
+        lines = []
+        for n, ax in enumerate(axs.flat):
+            if n >= n_trials:
+                ax.set_visible(False)
+                continue
+            raw, = ax.plot(t_axis, np.zeros_like(t_axis))
+            prep, = ax.plot(t_axis, np.zeros_like(t_axis))
+            ax.set_title(str(n + 1))
+            ax.axvline(0, linestyle='--', color='black')
+            ax.fill_between([20, 120], 0, y_max, alpha=0.3)
+            ax.set_ylim(0, y_max)
+            lines.append((raw, prep))
+        _figures[key] = fig, lines
+    return _figures[key]
+
+
+def render_emg_grid(base_name, trials):
+    """One grid of startle trials (raw & preprocessed) per trial type
+
+    trials -- fragments from emg_master.score_trials: signal type, trial
+    type, trial number, samples
+    """
+
+    fig, lines = _emg_figure(trials.shape[2])
+    fig_files = []
+    for c_index, c_name in enumerate(EMG_CONDITIONS):
+        for n, (raw, prep) in enumerate(lines):
+            raw.set_ydata(trials[0, c_index, n, :])
+            prep.set_ydata(trials[1, c_index, n, :])
+        fig.suptitle(c_name)
+        c_nicename = c_name.replace('+', '_plus').replace('-', '_minus')
+        fig_file = '{}_{}.png'.format(base_name, c_nicename)
+        fig_files.append(_save(fig, fig_file))
+    return fig_files
+
+
+RENDERERS = {
+    'eda_trials': render_eda_trials,
+    'emg_grid': render_emg_grid,
+    }
+
+
+class RenderQueue:
+    def __init__(self, jobs=1):
+        """Render figures from fragment files in worker processes
+
+        The caller only submits file names and carries on; each worker keeps
+        its figures and updates their data for every new subject. Errors are
+        reported (not raised) by close(), as figures do not affect results.
+
+        jobs -- number of worker processes
+        """
+
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=profiling.init_worker,
+            initargs=(profiling.report_directory(),))
+        self.pending = {}
+
+    def submit(self, fragment_file, fig_directory):
+        future = self.executor.submit(render, fragment_file, fig_directory)
+        self.pending[future] = fragment_file
+
+    def close(self):
+        """Wait for all figures, returns list of figure files"""
+
+        fig_files = []
+        for future in concurrent.futures.as_completed(self.pending):
+            try:
+                fig_files.extend(future.result())
+            except Exception as e:
+                print('Rendering', self.pending[future], 'failed:', repr(e))
+        self.executor.shutdown()
+        self.pending = {}
+        return fig_files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
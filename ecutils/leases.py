@@ -0,0 +1,269 @@
+"""Work distribution between processes sharing a directory, without a broker
+
+Any number of workers, on any host which sees the same directory, claim
+subjects of a processing stage by creating a lease file with O_CREAT |
+O_EXCL, which succeeds for exactly one of them (also on NFS). While a
+subject is processed, a thread refreshes the modification time of its lease
+(heartbeat). A lease which was not refreshed for ttl seconds has expired:
+its worker is assumed to be dead and the subject is claimed by another one.
+When a subject is finished, a completion marker is written (before the lease
+is removed), so it is not processed again; markers record the cache key of
+the computation (see ecutils.cache), so a change of inputs or parameters
+makes subjects pending again.
+
+Layout, in out/work/<stage>:
+# leases/<code>.lease -- owner of the lease (host, pid, token), as JSON
+# done/<code>.json -- key, host, pid and time of completion
+
+Expiry compares modification times, set by the file server, with the local
+clock, so the clocks of the hosts should not differ by more than a fraction
+of ttl. A worker which finds its lease broken (e.g. after it was suspended
+for longer than ttl) notices at the next heartbeat; its results are still
+written atomically, so the subject is at worst processed twice.
+
+lock() uses the same mechanism for short critical sections, e.g. updates of
+the score store manifest by several workers.
+"""
+
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from ecutils.storage import atomic_path
+
+WORK_DIR = os.path.join('out', 'work')
+
+
+class Lease:
+    def __init__(self, file_name, ttl):
+        """Exclusive claim on a resource, kept alive by heartbeats
+
+        Use Lease.acquire, which returns None when another process holds a
+        lease which has not expired.
+        """
+
+        self.file_name = file_name
+        self.ttl = ttl
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                       uuid.uuid4().hex[:8])
+        self.lost = False
+        self.broken = None  # owner of the expired lease replaced by this one
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def acquire(cls, file_name, ttl=60.):
+        lease = cls(file_name, ttl)
+        if lease._create() or (lease._break_expired() and lease._create()):
+            return lease
+        return None
+
+    def _create(self):
+        try:
+            fd = os.open(self.file_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                         0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'wt') as f:
+            json.dump({'owner': self.owner, 'host': socket.gethostname(),
+                       'pid': os.getpid(), 'acquired': time.time()}, f)
+
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+        return True
+
+    def _break_expired(self):
+        """Remove the lease file if it expired, True if it is gone"""
+
+        try:
+            if time.time() - os.stat(self.file_name).st_mtime < self.ttl:
+                return False
+        except FileNotFoundError:
+            return True  # released in the meantime
+
+        # only one of the workers finding the expired lease can move it
+        expired = '{}.{}.expired'.format(self.file_name, self.owner)
+        try:
+            os.rename(self.file_name, expired)
+        except FileNotFoundError:
+            return True
+        try:
+            if time.time() - os.stat(expired).st_mtime < self.ttl:
+                # another worker replaced the expired lease before the move,
+                # put the fresh one back (unless yet another one was created)
+                try:
+                    os.link(expired, self.file_name)
+                except FileExistsError:
+                    pass
+                return False
+            self.broken = _read(expired).get('owner', 'unknown')
+            return True
+        finally:
+            os.remove(expired)
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.ttl / 4):
+            if not self.is_held():
+                self.lost = True
+                return
+            try:
+                os.utime(self.file_name)
+            except FileNotFoundError:
+                self.lost = True
+                return
+
+    def is_held(self):
+        """Is the lease file still the one created by this process"""
+        return _read(self.file_name).get('owner') == self.owner
+
+    def release(self):
+        """Stop heartbeats and remove the lease file (if still held)"""
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.is_held():
+            try:
+                os.remove(self.file_name)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+        return False
+
+
+def _read(file_name):
+    try:
+        with open(file_name) as f:
+            return json.load(f)
+    except (OSError, ValueError):  # missing, or being written
+        return {}
+
+
+@contextlib.contextmanager
+def lock(file_name, ttl=60., poll=.05):
+    """Hold a lease on file_name while the with block runs, waiting for it
+
+    A lock left behind by a crashed process expires after ttl seconds.
+    """
+
+    while True:
+        lease = Lease.acquire(file_name, ttl)
+        if lease is not None:
+            break
+        time.sleep(poll)
+    try:
+        yield lease
+    finally:
+        lease.release()
+
+
+class WorkQueue:
+    def __init__(self, stage, directory=WORK_DIR, ttl=60., poll=None):
+        """Subjects of a processing stage, claimed by workers with leases
+
+        stage -- name of the stage, e.g. 'eda' (as used by ResultCache)
+        ttl -- seconds without heartbeat after which a lease expires
+        poll -- seconds between checks for subjects held by other workers
+          (default: ttl / 4)
+        """
+
+        self.path = os.path.join(directory, stage)
+        self.ttl = ttl
+        self.poll = ttl / 4 if poll is None else poll
+
+    def _lease_file(self, code):
+        return os.path.join(self.path, 'leases', code + '.lease')
+
+    def _done_file(self, code):
+        return os.path.join(self.path, 'done', code + '.json')
+
+    def is_done(self, code, key=None):
+        """Is there a completion marker for code (with this key)"""
+
+        if not os.path.exists(self._done_file(code)):
+            return False
+        return key is None or _read(self._done_file(code)).get('key') == key
+
+    def acquire(self, code):
+        """Lease on code, or None if another worker holds one"""
+
+        os.makedirs(os.path.dirname(self._lease_file(code)), exist_ok=True)
+        return Lease.acquire(self._lease_file(code), self.ttl)
+
+    def complete(self, code, key=None, **info):
+        """Write the completion marker of code"""
+
+        os.makedirs(os.path.dirname(self._done_file(code)), exist_ok=True)
+        marker = {'key': key, 'host': socket.gethostname(),
+                  'pid': os.getpid(), 'finished': time.time()}
+        marker.update(info)
+        with atomic_path(self._done_file(code)) as tmp_name:
+            with open(tmp_name, 'wt') as f:
+                json.dump(marker, f)
+
+    def claim(self, codes, keys=None, wait=True):
+        """Yield codes claimed by this worker, one at a time
+
+        The lease is held until the next code is requested; call complete
+        for a code before that, otherwise it is released unfinished (and
+        not claimed again by this worker, as it probably failed). Codes held
+        by other workers are retried until they are done, or their leases
+        expire and they can be claimed (unless wait is False).
+
+        Arguments:
+        # codes -- subjects to process
+        # keys -- dict of cache keys, codes with a marker of another key
+          are not done
+        """
+
+        keys = keys or {}
+        attempted = set()
+        while True:
+            busy = False
+            for code in codes:
+                if code in attempted or self.is_done(code, keys.get(code)):
+                    continue
+                lease = self.acquire(code)
+                if lease is None:
+                    busy = True
+                    continue
+                try:
+                    # finished by another worker just before
+                    if self.is_done(code, keys.get(code)):
+                        continue
+                    if lease.broken is not None:
+                        print('{}: took over the expired lease of {}'.format(
+                            code, lease.broken))
+                    attempted.add(code)
+                    yield code
+                finally:
+                    lease.release()
+            if not (busy and wait):
+                return
+            time.sleep(self.poll)
+
+    def status(self, codes, keys=None):
+        """Dict of code: 'done', 'leased', 'expired' or 'pending'"""
+
+        keys = keys or {}
+        status = {}
+        for code in codes:
+            if self.is_done(code, keys.get(code)):
+                status[code] = 'done'
+                continue
+            try:
+                age = time.time() - os.stat(self._lease_file(code)).st_mtime
+                status[code] = 'leased' if age < self.ttl else 'expired'
+            except FileNotFoundError:
+                status[code] = 'pending'
+        return status
@@ -0,0 +1,324 @@
+"""Time and memory used by processing stages, for run reports
+
+Scripts call enable() when asked for a report, then wrap their stages:
+
+    with profiling.stage('cvxeda', code, phase=13) as s:
+        s.array('signal', signal)
+        ...
+        s.note(iterations=17)
+
+Each finished stage is recorded with wall and CPU time, array sizes, notes
+and memory use (Linux only): the peak resident memory while the stage ran
+(peak_rss, by resetting the peak of the process at the start of the stage,
+see proc(5) clear_refs) and its increase over the memory at the start
+(peak_rss_change), the resident memory at the end and its change (rss,
+rss_change), and the peak of the process since it started
+(process_peak_rss).
+Parts of a stage (e.g. reading vs. writing in a loop) can be timed with
+part() and timed(). Records are appended to one file per process in the
+report directory, so stages run in worker processes are recorded too
+(process pools pass report_directory() to init_worker in their
+initializer); report() merges them into report.json and report.csv.
+
+When reporting is not enabled, stage() and part() return a shared object
+which does nothing, so instrumented code runs at full speed.
+"""
+
+import csv
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+REPORT_DIR = os.path.join('out', 'reports')
+
+# report directory of this run, None when disabled
+_directory = None
+# stages open in this process, innermost last
+_open = []
+
+
+def enable(run_name):
+    """Start recording stages into a new report directory"""
+
+    global _directory
+    _directory = os.path.join(REPORT_DIR, '{}-{}'.format(
+        run_name, time.strftime('%Y%m%d-%H%M%S')))
+    os.makedirs(_directory, exist_ok=True)
+    return _directory
+
+
+def enabled():
+    return _directory is not None
+
+
+def report_directory():
+    """Report directory of this run, None when disabled"""
+    return _directory
+
+
+def init_worker(report_dir):
+    """Record stages of a worker process into the report directory of its
+    parent (report_directory() of the parent, None when disabled)"""
+
+    global _directory
+    _directory = report_dir
+
+
+def current_rss():
+    """Current resident memory of this process in bytes (None if unknown)"""
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):  # not on linux
+        return None
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of this process, True if possible"""
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:  # not on linux, or not permitted
+        return False
+
+
+def peak_rss_since_reset():
+    """Peak resident memory since the last reset_peak_rss, in bytes (None if
+    unknown)"""
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def process_peak_rss():
+    """Peak resident memory of this process since it started, in bytes
+    (None if unknown)"""
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class _Null:
+    """Stands in for a stage or part when reporting is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def array(self, name, arr):
+        pass
+
+    def note(self, **info):
+        pass
+
+
+_NULL = _Null()
+
+
+class Stage:
+    def __init__(self, name, subject=None, **info):
+        """A stage of processing, measured while the with block runs"""
+
+        self.record = {'stage': name, 'subject': subject, 'pid': os.getpid()}
+        self.record.update(info)
+        self.parts = {}
+        self._peak = None  # highest peak seen so far, None if unknown
+
+    def array(self, name, arr):
+        """Record the shape and size of an array used in the stage"""
+
+        self.record.setdefault('arrays', {})[name] = {
+            'shape': list(getattr(arr, 'shape', [len(arr)])),
+            'nbytes': int(getattr(arr, 'nbytes', 0)),
+            }
+
+    def note(self, **info):
+        """Record other information, e.g. solver iterations"""
+
+        self.record.update(info)
+
+    def _update_peak(self, peak):
+        if self._peak is not None and peak is not None:
+            self._peak = max(self._peak, peak)
+
+    def __enter__(self):
+        if _open:
+            self.record['parent'] = _open[-1].record['stage']
+            # the peak of the enclosing stage so far, before it is reset
+            _open[-1]._update_peak(peak_rss_since_reset())
+        _open.append(self)
+        self.record['start'] = time.time()
+        self._rss = current_rss()
+        if self._rss is not None and reset_peak_rss():
+            self._peak = self._rss
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.record['wall'] = time.perf_counter() - self._wall
+        self.record['cpu'] = time.process_time() - self._cpu
+        rss = current_rss()
+        if rss is not None:
+            self.record['rss'] = rss
+            self.record['rss_change'] = rss - self._rss
+        self._update_peak(peak_rss_since_reset())
+        if self._peak is not None:
+            self.record['peak_rss'] = self._peak
+            self.record['peak_rss_change'] = self._peak - self._rss
+        position = _open.index(self)
+        if position > 0:
+            _open[position - 1]._update_peak(self._peak)
+        peak = process_peak_rss()
+        if peak is not None:
+            self.record['process_peak_rss'] = peak
+        if self.parts:
+            self.record['parts'] = self.parts
+        if exc_type is not None:
+            self.record['error'] = repr(exc_value)
+        _open.remove(self)
+        _write(self.record)
+        return False
+
+
+class _Part:
+    def __init__(self, stage, name):
+        self.stage = stage
+        self.name = name
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self._wall
+        self.stage.parts[self.name] = (self.stage.parts.get(self.name, 0.)
+                                       + elapsed)
+        return False
+
+
+def stage(name, subject=None, **info):
+    """Context manager measuring a stage (does nothing if not enabled)"""
+
+    if _directory is None:
+        return _NULL
+    return Stage(name, subject, **info)
+
+
+def part(name):
+    """Context manager adding wall time to a part of the current stage"""
+
+    if _directory is None or not _open:
+        return _NULL
+    return _Part(_open[-1], name)
+
+
+def timed(iterable, name):
+    """Iterate, adding the time spent in producing items to a part of the
+    current stage (e.g. reading chunks of a file)"""
+
+    if _directory is None or not _open:
+        return iterable
+    return _timed(iterable, _Part(_open[-1], name))
+
+
+def _timed(iterable, timer):
+    iterator = iter(iterable)
+    while True:
+        with timer:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def _write(record):
+    file_name = os.path.join(_directory, 'stages-{}.jsonl'.format(
+        os.getpid()))
+    with open(file_name, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def report(directory=None):
+    """Merge stage records of all processes into report.json & report.csv
+
+    Returns the list of records, ordered by start time.
+    """
+
+    directory = directory or _directory
+    records = []
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.startswith('stages-') and file_name.endswith('.jsonl'):
+            with open(os.path.join(directory, file_name)) as f:
+                records.extend(json.loads(line) for line in f)
+    records.sort(key=lambda r: r['start'])
+
+    with open(os.path.join(directory, 'report.json'), 'wt') as f:
+        json.dump({'command': sys.argv, 'records': records}, f, indent=1)
+
+    # one row per stage; sizes summed, parts and notes in own columns
+    rows = []
+    for record in records:
+        row = {k: v for k, v in record.items() if k not in ('arrays',
+                                                              'parts')}
+        row['array_bytes'] = sum(a['nbytes']
+                                 for a in record.get('arrays', {}).values())
+        for name, elapsed in record.get('parts', {}).items():
+            row['part_' + name] = elapsed
+        for k, v in row.items():
+            if isinstance(v, (list, dict)):
+                row[k] = json.dumps(v)
+        rows.append(row)
+    columns = []
+    for row in rows:
+        columns.extend(k for k in row if k not in columns)
+    with open(os.path.join(directory, 'report.csv'), 'wt', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    return records
+
+
+def print_summary(records):
+    """Print totals for each stage, the largest RSS change and the largest
+    peak RSS"""
+
+    stages = {}
+    for record in records:
+        stages.setdefault(record['stage'], []).append(record)
+
+    def megabytes(values):
+        return '{:.0f}'.format(max(values) / 2**20) if values else '-'
+
+    print('\n{:<16} {:>6} {:>10} {:>10} {:>10} {:>15} {:>14}'.format(
+        'stage', 'count', 'wall (s)', 'cpu (s)', 'max (s)',
+        'RSS change (MB)', 'peak RSS (MB)'))
+    for name, rs in stages.items():
+        print('{:<16} {:>6} {:>10.2f} {:>10.2f} {:>10.2f} {:>15} {:>14}'
+              .format(name, len(rs), sum(r['wall'] for r in rs),
+                      sum(r['cpu'] for r in rs), max(r['wall'] for r in rs),
+                      megabytes([r['rss_change'] for r in rs
+                                 if 'rss_change' in r]),
+                      megabytes([r['peak_rss'] for r in rs
+                                 if 'peak_rss' in r])))
@@ -0,0 +1,106 @@
+"""
+Sparse quadratic programming with NumPy / SciPy only.
+
+Solves problems of the form used by cvxopt.solvers.qp (without equality
+constraints):
+
+    minimize    .5 * x'Px + q'x
+    subject to  Gx <= h
+
+with ADMM (operator splitting, as in OSQP). ADMM converges quickly to
+moderate accuracy, but is slow to reach the accuracy of an interior point
+solver; tolerances should be chosen with that in mind.
+"""
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+
+def solve_qp(P, q, G, h, rho=0.1, sigma=1e-6, relax=1.6, eps_abs=1e-5,
+             eps_rel=1e-5, max_iter=10000, check_every=25, x0=None, y0=None):
+    """Solve a sparse QP, see module docstring
+
+    Arguments:
+    # P -- sparse positive semidefinite matrix (N x N)
+    # q -- vector of length N
+    # G -- sparse constraint matrix (m x N)
+    # h -- vector of length m
+    # rho, sigma, relax -- ADMM step size, regularisation and relaxation
+    # eps_abs, eps_rel -- ADMM stopping tolerances
+    # max_iter -- maximum number of ADMM iterations
+    # check_every -- how often residuals are checked and rho is adapted
+    # x0, y0 -- starting point (e.g. the solution of a similar problem)
+
+    Returns a dict with keys: x, y (multipliers of Gx <= h), iterations,
+    status ('optimal' or 'max_iter').
+    """
+
+    P = sp.csc_matrix(P)
+    G = sp.csr_matrix(G)
+    q = np.asarray(q, dtype=float).ravel()
+    h = np.asarray(h, dtype=float).ravel()
+    N = P.shape[0]
+
+    # equilibrate constraint rows (empty rows are left alone)
+    norms = np.sqrt(np.asarray(G.multiply(G).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.
+    D = sp.diags(1. / norms)
+    Gs = sp.csc_matrix(D @ G)
+    hs = h / norms
+    GsT = Gs.T.tocsc()
+
+    x = np.zeros(N) if x0 is None else np.array(x0, dtype=float).ravel()
+    z = np.minimum(Gs @ x, hs)
+    # multipliers of the equilibrated rows
+    y = np.zeros(len(hs)) if y0 is None else np.ravel(y0) * norms
+
+    def factorize(rho):
+        K = P + sigma * sp.identity(N, format='csc') + rho * (GsT @ Gs)
+        return _factorize(K)
+
+    solve = factorize(rho)
+    status = 'max_iter'
+    it = 0
+    for it in range(1, max_iter + 1):
+        x_t = solve(sigma * x - q + GsT @ (rho * z - y))
+        z_t = Gs @ x_t
+        x = relax * x_t + (1 - relax) * x
+        z_r = relax * z_t + (1 - relax) * z
+        z = np.minimum(z_r + y / rho, hs)
+        y = y + rho * (z_r - z)
+
+        if it % check_every == 0:
+            Gx = Gs @ x
+            Px = P @ x
+            GTy = GsT @ y
+            r_prim = np.abs(Gx - z).max()
+            r_dual = np.abs(Px + q + GTy).max()
+            eps_prim = eps_abs + eps_rel * max(np.abs(Gx).max(),
+                                               np.abs(z).max())
+            eps_dual = eps_abs + eps_rel * max(np.abs(Px).max(),
+                                               np.abs(GTy).max(),
+                                               np.abs(q).max())
+            if r_prim < eps_prim and r_dual < eps_dual:
+                status = 'optimal'
+                break
+
+            # adapt step size to balance the residuals (as in OSQP)
+            scale = np.sqrt((r_prim / eps_prim) / (r_dual / eps_dual))
+            if scale > 5 or scale < .2:
+                rho = np.clip(rho * scale, 1e-6, 1e6)
+                solve = factorize(rho)
+
+    return {'x': x, 'y': y / norms, 'iterations': it, 'status': status}
+
+
+def _factorize(K):
+    """Sparse LU of a symmetric positive definite matrix, returns solve function
+
+    Such matrices can be factorised without pivoting, which keeps the fill-in
+    low for banded problems.
+    """
+
+    lu = spla.splu(sp.csc_matrix(K), diag_pivot_thresh=0.,
+                   options={'SymmetricMode': True})
+    return lu.solve
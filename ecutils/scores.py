@@ -0,0 +1,216 @@
+import json
+import numpy as np
+import os
+import pandas
+from pandas.api.types import is_numeric_dtype, union_categoricals
+
+from ecutils.leases import lock
+from ecutils.storage import atomic_path
+
+SCORE_DIR = os.path.join('out', 'scores')
+
+# string columns are stored as categories (integer codes + category list)
+CATEGORICAL = ('code', 'stimulus')
+
+
+class ScoreStore:
+    def __init__(self, modality, table='scores', directory=SCORE_DIR):
+        """Columnar table of trial scores, append-only, keyed by subject
+
+        Each append writes a segment (.npz, one array per column, so that
+        readers load only the columns they need) and records it in a JSON
+        manifest. Rows of a subject in a later segment replace the rows of
+        that subject in earlier ones, so re-scoring a subject is an append
+        too; compact() rewrites the table as a single segment. String
+        columns are categorical, other columns keep their numpy type.
+        Changes of the manifest, and reads of the segments it lists, are
+        made under a lock (ecutils.leases), so several processes (e.g.
+        workers on different hosts) can write and read.
+
+        modality -- 'eda' or 'emg' (tables are partitioned by modality)
+        table -- 'scores' (from the master scripts) or e.g. 'normalized'
+        """
+
+        self.path = os.path.join(directory, modality, table)
+        self.manifest_file = os.path.join(self.path, 'manifest.json')
+
+    def _manifest(self):
+        try:
+            with open(self.manifest_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'columns': None, 'segments': [], 'next': 0}
+
+    def _lock(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        return lock(os.path.join(self.path, 'lock'))
+
+    def _save_manifest(self, manifest):
+        with atomic_path(self.manifest_file) as tmp_name:
+            with open(tmp_name, 'wt') as f:
+                json.dump(manifest, f, indent=1)
+
+    @property
+    def columns(self):
+        """List of (name, dtype) tuples, None for an empty store"""
+
+        columns = self._manifest()['columns']
+        return None if columns is None else [tuple(c) for c in columns]
+
+    def codes(self):
+        """Set of subjects in the store"""
+
+        return {c for s in self._manifest()['segments'] for c in s['codes']}
+
+    def append(self, df):
+        """Add rows of subjects not yet in the store"""
+
+        present = self.codes().intersection(df['code'])
+        if present:
+            raise ValueError('Subjects already stored: {}'.format(
+                ', '.join(sorted(present))))
+        self.upsert(df)
+
+    def upsert(self, df):
+        """Add rows, replacing all stored rows of the same subjects"""
+
+        columns = _schema(df)
+        with self._lock():
+            manifest = self._manifest()
+            if manifest['columns'] is None:
+                manifest['columns'] = columns
+            elif [tuple(c) for c in manifest['columns']] != columns:
+                raise ValueError('Columns {} do not match the store: '
+                                 '{}'.format(columns, manifest['columns']))
+
+            manifest['segments'].append(self._write_segment(manifest, df))
+            self._save_manifest(manifest)
+
+    def write(self, df):
+        """Replace the whole table with df"""
+
+        with self._lock():
+            self._replace(df)
+
+    def _replace(self, df):
+        old = self._manifest()
+        manifest = {'columns': _schema(df), 'segments': [],
+                    'next': old['next']}
+        manifest['segments'].append(self._write_segment(manifest, df))
+        self._save_manifest(manifest)
+        self._remove_segments(old['segments'])
+
+    def compact(self):
+        """Rewrite the table as one segment, dropping replaced rows"""
+
+        with self._lock():
+            if len(self._manifest()['segments']) > 1:
+                self._replace(self._read())
+
+    def read(self, columns=None, codes=None):
+        """Load the table (or some columns) as a DataFrame
+
+        Segments are read under the lock, so that they are not removed by
+        compact() or write() in another process in the meantime.
+
+        columns -- list of column names, default: all
+        codes -- only rows of these subjects, default: all
+        """
+
+        if not os.path.exists(self.manifest_file):
+            raise FileNotFoundError('No scores in {}'.format(self.path))
+        with self._lock():
+            return self._read(columns, codes)
+
+    def _read(self, columns=None, codes=None):
+        manifest = self._manifest()
+        if manifest['columns'] is None:
+            raise FileNotFoundError('No scores in {}'.format(self.path))
+        dtypes = dict(manifest['columns'])
+        if columns is None:
+            columns = list(dtypes)
+        unknown = set(columns) - set(dtypes)
+        if unknown:
+            raise KeyError('No such columns: {}'.format(sorted(unknown)))
+
+        # later segments replace subjects of earlier ones
+        parts, replaced = [], set()
+        for segment in reversed(manifest['segments']):
+            keep = set(segment['codes']) - replaced
+            if codes is not None:
+                keep &= set(codes)
+            replaced.update(segment['codes'])
+            if keep:
+                parts.append(self._read_segment(segment, columns, dtypes,
+                                                keep))
+
+        parts.reverse()
+        data = {}
+        for name in columns:
+            if dtypes[name] != 'category':
+                data[name] = np.concatenate(
+                    [p[name] for p in parts]
+                    or [np.empty(0, dtype=dtypes[name])])
+            elif parts:
+                data[name] = union_categoricals([p[name] for p in parts],
+                                                sort_categories=True)
+            else:
+                data[name] = pandas.Categorical([])
+        return pandas.DataFrame(data, columns=columns)
+
+    def _write_segment(self, manifest, df):
+        file_name = '{:06d}.npz'.format(manifest['next'])
+        manifest['next'] += 1
+
+        arrays = {}
+        for name, dtype in manifest['columns']:
+            if dtype == 'category':
+                values = pandas.Categorical(df[name])
+                arrays[name] = values.codes
+                arrays[name + '.categories'] = np.array(
+                    values.categories, dtype=str)
+            else:
+                arrays[name] = df[name].values.astype(dtype)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        with atomic_path(os.path.join(self.path, file_name)) as tmp_name:
+            with open(tmp_name, 'wb') as f:
+                np.savez(f, **arrays)
+
+        return {'file': file_name, 'rows': len(df),
+                'codes': sorted(set(df['code']))}
+
+    def _read_segment(self, segment, columns, dtypes, codes):
+        with np.load(os.path.join(self.path, segment['file'])) as data:
+            code_categories = data['code.categories']
+            rows = np.isin(code_categories[data['code']], list(codes))
+            part = {}
+            for name in columns:
+                if dtypes[name] == 'category':
+                    part[name] = pandas.Categorical.from_codes(
+                        data[name][rows], data[name + '.categories'])
+                else:
+                    part[name] = data[name][rows]
+        return part
+
+    def _remove_segments(self, segments):
+        for segment in segments:
+            file_name = os.path.join(self.path, segment['file'])
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+
+def _schema(df):
+    """(name, dtype) of each column, strings as categories"""
+
+    if 'code' not in df.columns or df['code'].isnull().any():
+        raise ValueError('Scores need a code for every row')
+    columns = []
+    for name in df.columns:
+        if name in CATEGORICAL or not is_numeric_dtype(df[name]):
+            columns.append((name, 'category'))
+        else:
+            columns.append((name, df[name].dtype.name))
+    return columns
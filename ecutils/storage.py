@@ -0,0 +1,42 @@
+import contextlib
+import numpy as np
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def atomic_path(file_name):
+    """Yield a temporary path which replaces file_name on success
+
+    The temporary file is created in the target directory, so that the final
+    os.replace is atomic; on error it is removed and file_name is untouched.
+    """
+
+    directory = os.path.dirname(os.path.abspath(file_name))
+    fd, tmp_name = tempfile.mkstemp(
+        dir=directory, prefix='.' + os.path.basename(file_name), suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmp_name
+        os.replace(tmp_name, file_name)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+
+# temporary files in /dev/shm are backed by memory, not disk
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def share_array(arr):
+    """Copy arr into a temporary .npy file, in shared memory if possible
+
+    Other processes open it with np.load(file_name, mmap_mode='r'), which
+    maps the same memory instead of passing a pickled copy. The caller
+    removes the file when it is no longer needed.
+    """
+
+    fd, file_name = tempfile.mkstemp(dir=SHARED_DIR, suffix='.npy')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, arr)
+    return file_name
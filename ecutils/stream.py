@@ -0,0 +1,166 @@
+"""Online scoring of startle responses, while a session is recorded
+
+StartleStream is fed consecutive blocks of raw EMG and of the digital
+channels (2 kHz, like the acq files). Markers are decoded incrementally
+(MarkerDecoder) and each startle probe within an experiment phase is scored
+with the windows used by emg_master.score_trials as soon as enough signal
+has arrived. Two filtering modes are available:
+
+# lookahead (default) -- the same zero-phase filtering as
+  preprocess_emg_local, applied to the probe window padded on both sides;
+  amplitudes agree with the offline scores, a score is ready padding +
+  peak_window[1] samples after the probe (0.62 s with emg_master.PARAMS)
+# causal -- the signal is filtered continuously, with filter state carried
+  across blocks, and the smoothed signal is shifted by the delay of the
+  (linear phase) smoothing filter; a score is ready 50 samples after the
+  end of the peak window (0.145 s), but amplitudes differ from the offline
+  ones (single-pass filtering, phase shift of the bandpass), so they are
+  meant for monitoring signal quality during a session
+
+Memory use does not grow with the session: only the samples needed for
+windows of probes which may still be decoded are kept.
+"""
+
+import numpy as np
+from scipy import signal
+
+from ecutils.emg import (epochs, preprocess_emg, startle_amplitude,
+                         _bandpass_filter, _smoothing_filter)
+from ecutils.eventhandler import MarkerDecoder
+
+# probe markers and names used in stimulus labels
+PROBES = {4: 'fix', 5: 'CS+', 6: 'CS-'}
+# start marker: stop marker, prefix of stimulus labels
+PHASES = {13: (14, 'obs'), 15: (16, 'direct')}
+
+
+class StartleStream:
+    def __init__(self, baseline=100, peak_window=(40, 240), padding=1000,
+                 causal=False, probes=PROBES, phases=PHASES, width=10):
+        """Incremental startle scoring of a recording fed in blocks
+
+        Arguments:
+        # baseline -- number of samples before the probe
+        # peak_window -- first and last (exclusive) sample after the probe
+        # padding -- samples filtered on each side of a window (lookahead)
+        # causal -- filter causally instead of with lookahead
+        # probes -- dict of probe marker: name
+        # phases -- dict of phase start marker: (stop marker, prefix)
+        # width -- number of samples to check for co-ocurring marker edges
+        """
+
+        self.baseline = baseline
+        self.peak_window = tuple(peak_window)
+        self.causal = causal
+        self.probes = probes
+        self.phases = phases
+        self.decoder = MarkerDecoder(width=width)
+
+        if causal:
+            b, a = _bandpass_filter()
+            self._bandpass_zi = np.zeros(max(len(a), len(b)) - 1)
+            self._smoothing_zi = np.zeros(len(_smoothing_filter()) - 1)
+            self.padding = 0
+            self.delay = (len(_smoothing_filter()) - 1) // 2
+        else:
+            self.padding = padding
+            self.delay = 0
+
+        # samples after a probe needed to score it (decoding needs width + 1)
+        self.latency = max(self.peak_window[1] + self.padding + self.delay,
+                           width + 1)
+        # samples kept for probes not yet decoded
+        self._history = baseline + self.padding + width + 1
+
+        self.n_samples = 0
+        self._buffer = np.zeros(0)  # raw (lookahead) or filtered (causal)
+        self._start = 0  # sample index of the first buffered sample
+        self._phase = None
+        self._trials = {}
+        self._pending = []  # (sample, stimulus, trial) of decoded probes
+
+    def feed(self, emg, digital):
+        """Process a block of EMG and digital channels of the same length
+
+        Returns a list of scores which became ready, dicts with sample (of
+        the probe), stimulus, trial, amplitude and ready (number of samples
+        fed when the score was computed).
+        """
+
+        emg = np.asarray(emg, dtype=float)
+        if np.shape(digital)[1] != len(emg):
+            raise ValueError('EMG and digital blocks differ in length: '
+                             '{} and {}'.format(len(emg),
+                                                np.shape(digital)[1]))
+
+        if self.causal:
+            b, a = _bandpass_filter()
+            s, self._bandpass_zi = signal.lfilter(b, a, emg,
+                                                  zi=self._bandpass_zi)
+            s, self._smoothing_zi = signal.lfilter(
+                _smoothing_filter(), np.array([1.]), np.abs(s),
+                zi=self._smoothing_zi)
+        else:
+            s = emg
+        self._buffer = np.concatenate([self._buffer, s])
+        self.n_samples += len(emg)
+
+        self._add_events(*self.decoder.feed(digital))
+
+        ready = [p for p in self._pending
+                 if p[0] + self.latency <= self.n_samples]
+        scores = [self._score(*p) for p in ready]
+        self._pending = self._pending[len(ready):]
+        self._trim()
+        return scores
+
+    def flush(self):
+        """Score the remaining probes, at the end of the recording
+
+        Windows extending past the end are scored like in score_trials,
+        i.e. as NaN.
+        """
+
+        self._add_events(*self.decoder.flush())
+        scores = [self._score(*p) for p in self._pending]
+        self._pending = []
+        return scores
+
+    def _add_events(self, samples, values):
+        for sample, value in zip(samples, values):
+            if value in self.phases:
+                self._phase = self.phases[value]
+            elif self._phase is not None and value == self._phase[0]:
+                self._phase = None
+            elif self._phase is not None and value in self.probes:
+                stimulus = '{} {}'.format(self._phase[1], self.probes[value])
+                self._trials[stimulus] = self._trials.get(stimulus, 0) + 1
+                self._pending.append((sample, stimulus,
+                                      self._trials[stimulus]))
+
+    def _score(self, sample, stimulus, trial):
+        # window of the probe, with padding, in the (delayed) buffer
+        start = max(sample - self.baseline - self.padding, 0)
+        stop = sample + self.peak_window[1] + self.padding
+        x = self._buffer[start + self.delay - self._start:
+                         stop + self.delay - self._start]
+        if not self.causal:
+            x = preprocess_emg(preprocess_emg(x, smooth=False),
+                               bandpass=False, rectify=False)
+
+        window = epochs(x, [sample - start], self.baseline,
+                        self.peak_window[1])
+        amplitude = startle_amplitude(window, self.baseline, self.baseline,
+                                      self.peak_window)[0]
+        return {'sample': int(sample), 'stimulus': stimulus, 'trial': trial,
+                'amplitude': amplitude, 'ready': self.n_samples}
+
+    def _trim(self):
+        keep = self.n_samples - self._history
+        if self._pending:
+            keep = min(keep, self._pending[0][0] - self.baseline
+                       - self.padding)
+        drop = keep + self.delay - self._start
+        if drop > len(self._buffer) // 2:  # avoid copying on every block
+            self._buffer = self._buffer[drop:]
+            self._start += drop
@@ -1,20 +1,45 @@
+from ecutils.container import SubjectFile, subject_files
 from ecutils.eventhandler import EventCollection
-from ecutils.eda import Trial
+from ecutils.eda import DECOMPOSITION_DIR, TrialSet, save_trial_sets
+from ecutils.figures import FRAGMENT_DIR, RenderQueue, save_fragments
 from ecutils.fix_assignment import fix_assignment
+from ecutils import profiling
+from ecutils.cache import ResultCache, cache_key
+from ecutils.leases import WorkQueue
+from ecutils.resample import METHODS, downsample
+from ecutils.scores import ScoreStore
+from ecutils.storage import share_array
 
 import cvxEDA
 
-import scipy.signal as ss
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.transforms as mtransforms
 import matplotlib.patches as mpatch
 import argparse
-import re
-import glob
+import concurrent.futures
+import itertools
 import pandas
 import os
 
+# everything that influences results, apart from input files
+# (increase version when the processing code changes)
+PARAMS = {
+    'version': 4,
+    'fs': 25,
+    'downsampling': 'decimate',  # see ecutils.resample.METHODS
+    'trial_length': 9 + 10,  # take 9 seconds of CS and 10 seconds of fix
+    'baseline_length': 2,
+    'cvxeda': {'tau0': 2., 'tau1': .7, 'delta_knot': 10., 'alpha': 8e-4,
+               'gamma': 1e-2},
+    'cvxeda_window': None,  # or window & overlap (s) for cvxEDA_windowed
+    'cvxeda_backend': 'cvxopt',  # see cvxEDA.BACKENDS
+    'cs_window': {'onset': 0, 'duration': 6, 'baseline_length': 2},
+    'us_window': {'onset': 7.5, 'duration': 6, 'baseline_length': 2},
+    }
+
+SCORE_COLUMNS = ('code', 'stimulus', 'trial', 'amplitude')
+
 
 def smart_annotate(axis, first, last, text, color):
     """Adds rectangle with annotation above the plot.
@@ -54,144 +79,114 @@ def extract_phase(signal, events, start_mrk, stop_mrk):
 
 
 def process_phase(all_signal, all_events, start_mrk, stop_mrk,
-                  n_fragments, fs):
+                  n_fragments, fs, code=None):
 
-    # hardcoded: length of trial and baseline
-    n_s = (9+10)*fs  # take 9 seconds of CS and 10 seconds of fix
-    n_b_s = 2*fs
+    # length of trial and baseline
+    n_s = PARAMS['trial_length'] * fs
+    n_b_s = PARAMS['baseline_length'] * fs
 
     # extract signal and events for the requested parts
     signal, events = extract_phase(all_signal, all_events, start_mrk, stop_mrk)
 
     # decompose
-    [r, p, t, l, d, e, obj] = cvxEDA.cvxEDA(signal, 1/fs)
+    backend = cvxEDA.BACKENDS[PARAMS['cvxeda_backend']]()
+    with profiling.stage('cvxeda', code, phase=start_mrk) as s:
+        s.array('signal', signal)
+        if PARAMS['cvxeda_window'] is None:
+            [r, p, t, l, d, e, obj] = cvxEDA.cvxEDA(
+                signal, 1/fs, backend=backend, **PARAMS['cvxeda'])
+        else:
+            [r, p, t, l, d, e, obj] = cvxEDA.cvxEDA_windowed(
+                signal, 1/fs, backend=backend, **PARAMS['cvxeda_window'],
+                **PARAMS['cvxeda'])
+        s.note(backend=PARAMS['cvxeda_backend'], solves=backend.history,
+               iterations=sum(h['iterations'] or 0 for h in backend.history))
 
     # divide the tonic signal into fragments and calculate SCL
     fragments = np.array_split(t, n_fragments)
     levels = [a.mean() for a in fragments]
 
     # extract trials
-    trials = []
-    onsets_cs = events.samples_for_marker(1) + events.samples_for_marker(2)
-    onsets_cs.sort()
-
-    for onset in onsets_cs:
-        trial_events = events.events_between_samples(onset, onset+n_s)
-        trials.append(Trial(events=trial_events,
-                            n_samples=n_s,
-                            n_bl_samples=n_b_s,
-                            fs=fs,
-                            signal=r,
-                            smna=p,
-                            ))
+    onsets_cs = np.sort(np.concatenate(
+        [events.samples_for_marker(1), events.samples_for_marker(2)]))
+
+    trials = TrialSet(events=events,
+                      onsets=onsets_cs,
+                      n_samples=n_s,
+                      n_bl_samples=n_b_s,
+                      fs=fs,
+                      signal=r,
+                      smna=p,
+                      tonic=t,
+                      )
 
     return levels, trials
 
 
-def score_trials(list_of_trials, name):
-    # score trials
-
-    scores = []
-    for n, trial in enumerate(list_of_trials):
-        stimulus = 'CS+' if 1 in trial.event_values else 'CS-'
-        amplitude, peak_time = trial.score_eir(
-            onset=0,
-            duration=6,
-            baseline_length=2)
+def score_rows(trials, name):
+    """Stimulus, trial number and scoring window (key of PARAMS) of each
+    score of a phase, in order of score_trials"""
 
-        scores.append(
-            {
-                'stimulus': '{} {}'.format(name, stimulus),
-                'trial': n,
-                'amplitude': amplitude,
-            })
+    is_plus = trials.has_marker([1])
+    rows = [('{} {}'.format(name, 'CS+' if plus else 'CS-'), n, 'cs_window')
+            for n, plus in enumerate(is_plus)]
 
-        # in obs stage, score reaction to US (or US absent), but only for CS+
-        if (name == 'obs' and set(trial.event_values).isdisjoint({4, 5, 6})
-                and 1 in trial.event_values):
+    # in obs stage, score reaction to US (or US absent), but only for CS+
+    if name == 'obs':
+        with_us = is_plus & ~trials.has_marker([4, 5, 6])
+        is_present = trials.has_marker([8])
 
-            stimulus = 'US present' if 8 in trial.event_values else 'US absent'
-            amplitude, peak_time = trial.score_eir(
-                onset=7.5,
-                duration=6,
-                baseline_length=2)
+        # US rows follow the CS row of the same trial
+        for n in reversed(np.flatnonzero(with_us)):
+            stimulus = 'US present' if is_present[n] else 'US absent'
+            rows.insert(n + 1, ('{} {}'.format(name, stimulus), n,
+                                'us_window'))
 
-            scores.append(
-                {
-                    'stimulus': '{} {}'.format(name, stimulus),
-                    'trial': n,
-                    'amplitude': amplitude
-                })
+    return rows
 
-    return scores
 
+def score_trials(trials, name):
+    # score all trials at once, in each window used
 
-def plot_trials(nrows, ncols, trials, fname):
-    fig, axs = plt.subplots(nrows, ncols, figsize=(12.8, 7.2), sharey=True)
-    pmax = np.max([trial.smna.max() for trial in trials])
-    for i, ax in enumerate(axs.flat):
-        tx = ax.twinx()
-        tx.set_ylim(0, pmax)
-        trials_ofl[i].plot(ax, tx)
-    fig.savefig(fname)
-    plt.close(fig)
+    rows = score_rows(trials, name)
+    amplitude = {window: trials.score_eir(**PARAMS[window])[0]
+                 for window in set(w for _, _, w in rows)}
+    return [{'stimulus': stimulus, 'trial': n, 'amplitude': amplitude[w][n]}
+            for stimulus, n, w in rows]
 
 
-def save_scores(list_of_scores, subject_code):
-    df_directory = os.path.join('out', 'stat_data', 'eda')
-    df = pandas.DataFrame.from_records(list_of_scores)
+def save_scores(list_of_scores, subject_code, store):
+    df = pandas.DataFrame.from_records(list_of_scores, columns=SCORE_COLUMNS)
 
     # fix CS+ / CS- labels
     # for some subjects versions were mismatched between OFL and DE
     fix_assignment(subject_code, df)
 
-    if not os.path.exists(df_directory):
-        os.makedirs(df_directory)
-    df_filename = os.path.join(df_directory, subject_code + '.pickle')
-    df.to_pickle(df_filename)
-
-
-# potential TODO: plot entire OFL / DE signal
-
-# optionally stop calculations after n subjects (useful for testing)
-parser = argparse.ArgumentParser()
-parser.add_argument('--stop_after', help='process at most this many subjects',
-                    type=int)
-args = parser.parse_args()
-
-# constants
-fs = 25
-fname_pattern = re.compile('([A-Z]+)_eda.npy')
+    # replaces scores of the subject from earlier runs
+    store.upsert(df)
 
-# data files
-data_files = glob.glob('out/raw_data/[A-Z]*_eda.npy')
 
-# output directory for figures
-fig_directory = os.path.join('out', 'figures', 'eda')
-if not os.path.exists(fig_directory):
-    os.makedirs(fig_directory)
+# start & stop markers of experiment phases, number of fragments for SCL
+PHASES = [(11, 12, 1), (13, 14, 6), (15, 16, 3)]
 
-all_levels = []
-fuse = args.stop_after  # stop after this many subjects - for testing
 
-for data_file in data_files:
-    eda = np.load(data_file)
+def prepare_subject(code, subject_file):
+    """Load EDA and events of a subject, downsample both & fix events"""
 
-    event_file = data_file.replace('_eda.npy', '_events.txt')
-    event_collection = EventCollection.from_txt(event_file)
+    subject = SubjectFile(subject_file)
+    if subject.fs('eda') != subject.events_fs:
+        raise ValueError('EDA and events sampled at different rates')
 
-    code = re.search(fname_pattern, data_file).group(1)
-
-    # downsample events
-    event_collection.downsample(80)  # 25 * 8 * 5 * 2
-
-    # downsample eda
-    eda = ss.decimate(eda, 8)
-    eda = ss.decimate(eda, 5)
-    eda = ss.decimate(eda, 2)
+    # downsample eda (memory-mapped, read in chunks by 'polyphase') & events
+    with profiling.stage('downsample', code) as s:
+        s.array('eda_raw', subject.channel('eda'))
+        eda, event_collection = downsample(
+            subject.channel('eda'), subject.events(), subject.fs('eda'),
+            PARAMS['fs'], method=PARAMS['downsampling'])
+        s.array('eda', eda)
 
     # fix events
-    if re.search(fname_pattern, data_file).group(1) == 'RAZVAJ':
+    if code == 'RAZVAJ':
         # see notebook for rationale
         # no more marker problems affect the analysis
         if event_collection.all_events()[1].value == 1:
@@ -199,69 +194,290 @@ for data_file in data_files:
         if event_collection.events_between_events(13, 14)[1].value == 2:
             event_collection.events_between_events(13, 14)[1].value = 7
 
-    # extract SCLs and trials for all three stages of the experiment
-
-    levels_rest, _ = process_phase(
-        eda, event_collection, 11, 12, 1, fs)
-    levels_ofl, trials_ofl = process_phase(
-        eda, event_collection, 13, 14, 6, fs)
-    levels_de, trials_de = process_phase(
-        eda, event_collection, 15, 16, 3, fs)
-
-    # gather skin conductance levels
-    levels = np.array(levels_rest + levels_ofl + levels_de)
-    all_levels.append(levels)
-
-    # score trials
-    scores_ofl = score_trials(trials_ofl, 'obs')
-    scores_de = score_trials(trials_de, 'direct')
-
-    # plot trials
-    plot_trials(8, 6, trials_ofl,
-                fname=os.path.join(fig_directory, code + '_trials_OFL.png'))
-    plot_trials(6, 4, trials_de,
-                fname=os.path.join(fig_directory, code + '_trials_DE.png'))
-
-    # gather & save trial scores
-    scores = scores_ofl + scores_de
-    for score in scores:
-        score['code'] = code
-    save_scores(scores, code)
-
-    # do not run all subjects - for development
-    if fuse is not None:
-        fuse -= 1
-        if fuse == 0:
-            break
-
-
-# SCL - stack all subjects and make relative to first column
-scl = np.stack(all_levels)
-baseline = scl[:, 0]
-scl_rel = scl - baseline[:, np.newaxis]
-
-# --- SCL plot ---
-fig = plt.figure()
-ax = fig.gca()
-# plot individual lines
-for i in range(scl_rel.shape[0]):
-    ax.plot(scl_rel[i, :],
-            marker='o', linestyle='solid', color='black', alpha=0.2)
-
-# plot the mean
-ax.plot(np.mean(scl_rel, axis=0), linewidth=4.)
-
-# boxes with names of phases
-smart_annotate(ax, first=0, last=0, text='RS', color=plt.cm.Pastel2(7))
-smart_annotate(ax, first=1, last=6, text='Observational Fear Learning',
-               color=plt.cm.Pastel2(6))
-smart_annotate(ax, first=7, last=9, text='Direct Expression',
-               color=plt.cm.Pastel2(5))
-
-# ticks & labels
-ax.set_xticks([])
-ax.set_xlabel('Time (blocks)')
-ax.set_ylabel('Relative SCL (µS)')
-# ax.set_ylim(-1.54, 7.05)  # to match the old plot
-plt.show()
-# --- end of SCL plot ---
+    return eda, event_collection
+
+
+def init_worker(params, report_dir):
+    # worker processes may be started without the parent's state
+    PARAMS.update(params)
+    profiling.init_worker(report_dir)
+
+
+def process_shared_phase(eda_file, *args):
+    """process_phase, for signal memory-mapped from a shared .npy file"""
+    return process_phase(np.load(eda_file, mmap_mode='r'), *args)
+
+
+def process_subjects(subjects, fs, jobs=1, pipeline=True):
+    """Extract SCLs and trials for all phases of the experiment
+
+    Arguments:
+    # subjects -- iterable of (code, subject container file) tuples
+    # fs -- sampling frequency after downsampling
+    # jobs -- number of worker processes
+    # pipeline -- submit phases of all subjects before waiting for results;
+      otherwise a subject is finished before the next one is taken from
+      subjects (e.g. subjects claimed one at a time from a WorkQueue)
+
+    With more than one job, phases are processed concurrently, on one pool
+    of processes for all subjects. The downsampled signal of each subject is
+    then placed in shared memory once and mapped by the workers, rather than
+    pickled for every phase.
+
+    Yields, for each subject in order, a list of (levels, trials) tuples in
+    order of PHASES, so results do not depend on the number of jobs.
+    """
+
+    if jobs == 1:
+        for subject in subjects:
+            eda, event_collection = prepare_subject(*subject)
+            yield [process_phase(eda, event_collection, *phase, fs,
+                                 code=subject[0])
+                   for phase in PHASES]
+        return
+
+    pending = []
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                jobs, initializer=init_worker,
+                initargs=(PARAMS, profiling.report_directory())) as executor:
+            try:
+                for subject in subjects:
+                    eda, event_collection = prepare_subject(*subject)
+                    eda_file = share_array(eda)
+                    pending.append((eda_file, [
+                        executor.submit(process_shared_phase, eda_file,
+                                        event_collection, *phase, fs,
+                                        subject[0])
+                        for phase in PHASES]))
+                    if not pipeline:
+                        eda_file, futures = pending.pop()
+                        try:
+                            phases = [future.result() for future in futures]
+                        finally:
+                            os.remove(eda_file)
+                        yield phases
+
+                for eda_file, futures in pending:
+                    yield [future.result() for future in futures]
+                    os.remove(eda_file)
+            finally:
+                # after an error or when not all results were used
+                for eda_file, futures in pending:
+                    for future in futures:
+                        future.cancel()
+    finally:
+        for eda_file, futures in pending:
+            if os.path.exists(eda_file):
+                os.remove(eda_file)
+
+
+# potential TODO: plot entire OFL / DE signal
+
+if __name__ == '__main__':
+    # optionally stop calculations after n subjects (useful for testing)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stop_after', help='process at most this many '
+                        'subjects', type=int)
+    parser.add_argument('--jobs', help='number of phases processed in '
+                        'parallel', type=int, default=1)
+    parser.add_argument('--force', help='ignore cached results',
+                        action='store_true')
+    parser.add_argument('--only', help='process only this subject, ignoring '
+                        'cached results (can be repeated)', action='append',
+                        metavar='CODE')
+    parser.add_argument('--window', help='decompose EDA in overlapping '
+                        'windows of this many seconds (default: whole phase '
+                        'at once), see cvxEDA.cvxEDA_windowed', type=float)
+    parser.add_argument('--overlap', help='overlap of windows in seconds, at '
+                        'most half of --window', type=float, default=120.)
+    parser.add_argument('--backend', help='solver used by cvxEDA (see '
+                        'benchmarks/cvxeda_backends.py)',
+                        choices=sorted(cvxEDA.BACKENDS), default='cvxopt')
+    parser.add_argument('--downsampling', help='decimate (as published) or '
+                        'polyphase (faster, amplitudes about 3.9%% higher)',
+                        choices=METHODS, default='decimate')
+    parser.add_argument('--no-figures', help='only save trial fragments, '
+                        'render figures later with render_figures.py',
+                        action='store_true')
+    parser.add_argument('--render_jobs', help='number of processes '
+                        'rendering figures', type=int, default=1)
+    parser.add_argument('--worker', help='claim subjects through leases in '
+                        'out/work, so that any number of workers (on hosts '
+                        'sharing the directory) can run at once',
+                        action='store_true')
+    parser.add_argument('--ttl', help='seconds after which the lease of an '
+                        'unresponsive worker expires', type=float,
+                        default=60.)
+    parser.add_argument('--report', help='record time & memory use of '
+                        'processing stages in out/reports (see '
+                        'ecutils/profiling.py)',
+                        action='store_true')
+    parser.add_argument('--summary', help='print a summary of the report '
+                        '(implies --report)', action='store_true')
+    args = parser.parse_args()
+
+    if args.report or args.summary:
+        profiling.enable('eda')
+
+    if args.window is not None:
+        if not 0 < args.overlap <= args.window / 2:
+            parser.error('--overlap must be positive and at most half of '
+                         '--window')
+        PARAMS['cvxeda_window'] = {'window': args.window,
+                                   'overlap': args.overlap}
+    PARAMS['cvxeda_backend'] = args.backend
+    PARAMS['downsampling'] = args.downsampling
+
+    # constants
+    fs = PARAMS['fs']
+
+    # data files
+    data_files = subject_files(os.path.join('out', 'raw_data'))
+
+    # output directories for trial fragments & figures
+    frag_directory = os.path.join(FRAGMENT_DIR, 'eda')
+    fig_directory = os.path.join('out', 'figures', 'eda')
+
+    # figures are drawn in other processes, scoring does not wait for them
+    renderer = None if args.no_figures else RenderQueue(args.render_jobs)
+
+    fuse = args.stop_after  # stop after this many subjects - for testing
+    cache = ResultCache('eda')
+    store = ScoreStore('eda')
+    stored = store.codes()
+
+    # find subjects to process; stamp is None unless up to date
+    subjects = []
+    for code, subject_file in data_files.items():
+        if args.only is not None and code not in args.only:
+            continue
+
+        # skip subjects processed before with identical inputs & parameters
+        key = cache_key([subject_file], PARAMS)
+        stamp = cache.lookup(code, key) if code in stored else None
+        if stamp is not None and not (args.force or args.only):
+            print(code, 'up to date')
+            subjects.append((code, subject_file, key, stamp))
+            continue
+        subjects.append((code, subject_file, key, None))
+
+        # do not run all subjects - for development
+        if fuse is not None:
+            fuse -= 1
+            if fuse == 0:
+                break
+
+    todo = [s for s in subjects if s[3] is None]
+    if args.worker:
+        # subjects are claimed one at a time (their phases are still
+        # processed on --jobs processes), other workers take the rest; the
+        # next subject is claimed once the previous one is complete
+        queue = WorkQueue('eda', ttl=args.ttl)
+        waiting = {s[0]: s for s in todo}
+        claimed, to_process = itertools.tee(
+            waiting[code] for code in queue.claim(
+                list(waiting), {code: s[2] for code, s in waiting.items()}))
+        # (process_subjects first, so that its pool is shut down at the end)
+        results = ((s, phases) for phases, s in zip(process_subjects(
+            (s[:2] for s in to_process), fs, args.jobs, pipeline=False),
+            claimed))
+    else:
+        results = zip(todo, process_subjects([s[:2] for s in todo], fs,
+                                             args.jobs))
+
+    all_levels = {code: np.array(stamp['extra']['levels'])
+                  for code, _, _, stamp in subjects if stamp is not None}
+    for (code, subject_file, key, _), phases in results:
+        # SCLs and trials for all three stages of the experiment
+        [(levels_rest, _), (levels_ofl, trials_ofl),
+         (levels_de, trials_de)] = phases
+
+        # gather skin conductance levels
+        levels = np.array(levels_rest + levels_ofl + levels_de)
+        all_levels[code] = levels
+
+        # score trials
+        with profiling.stage('score', code):
+            scores_ofl = score_trials(trials_ofl, 'obs')
+            scores_de = score_trials(trials_de, 'direct')
+
+        # save trials for plotting & queue the figures
+        with profiling.stage('fragments', code):
+            frag_ofl = save_fragments(
+                os.path.join(frag_directory, code + '_trials_OFL.npz'),
+                'eda_trials', nrows=8, ncols=6, **trials_ofl.fragments())
+            frag_de = save_fragments(
+                os.path.join(frag_directory, code + '_trials_DE.npz'),
+                'eda_trials', nrows=6, ncols=4, **trials_de.fragments())
+        if renderer is not None:
+            renderer.submit(frag_ofl, fig_directory)
+            renderer.submit(frag_de, fig_directory)
+
+        # decomposed phases, for scoring with other windows (sweep_eda.py)
+        with profiling.stage('decompositions', code):
+            decomposition = save_trial_sets(
+                os.path.join(DECOMPOSITION_DIR, 'eda', code + '.npz'),
+                obs=trials_ofl, direct=trials_de)
+
+        # gather & save trial scores
+        scores = scores_ofl + scores_de
+        for score in scores:
+            score['code'] = code
+        with profiling.stage('save_scores', code):
+            save_scores(scores, code, store)
+
+        cache.store(code, key,
+                    [store.manifest_file, frag_ofl, frag_de, decomposition],
+                    extra={'levels': levels.tolist()})
+        if args.worker:
+            queue.complete(code, key)
+
+    # levels of subjects processed by other workers
+    for code, subject_file, key, _ in subjects:
+        stamp = cache.lookup(code, key)
+        if code not in all_levels and stamp is not None:
+            all_levels[code] = np.array(stamp['extra']['levels'])
+
+    # one segment per table, for fast reading
+    store.compact()
+
+    if renderer is not None:
+        renderer.close()
+
+    if profiling.enabled():
+        records = profiling.report()
+        if args.summary:
+            profiling.print_summary(records)
+
+    # SCL - stack all subjects and make relative to first column
+    scl = np.stack([all_levels[s[0]] for s in subjects
+                    if s[0] in all_levels])
+    baseline = scl[:, 0]
+    scl_rel = scl - baseline[:, np.newaxis]
+
+    # --- SCL plot ---
+    fig = plt.figure()
+    ax = fig.gca()
+    # plot individual lines
+    for i in range(scl_rel.shape[0]):
+        ax.plot(scl_rel[i, :],
+                marker='o', linestyle='solid', color='black', alpha=0.2)
+
+    # plot the mean
+    ax.plot(np.mean(scl_rel, axis=0), linewidth=4.)
+
+    # boxes with names of phases
+    smart_annotate(ax, first=0, last=0, text='RS', color=plt.cm.Pastel2(7))
+    smart_annotate(ax, first=1, last=6, text='Observational Fear Learning',
+                   color=plt.cm.Pastel2(6))
+    smart_annotate(ax, first=7, last=9, text='Direct Expression',
+                   color=plt.cm.Pastel2(5))
+
+    # ticks & labels
+    ax.set_xticks([])
+    ax.set_xlabel('Time (blocks)')
+    ax.set_ylabel('Relative SCL (µS)')
+    # ax.set_ylim(-1.54, 7.05)  # to match the old plot
+    plt.show()
+    # --- end of SCL plot ---
@@ -1,159 +1,213 @@
-import glob
-import matplotlib.pyplot as plt
+import argparse
 import numpy as np
 import os
 import pandas
-import re
 
-from ecutils.eventhandler import EventCollection
-from ecutils.emg import preprocess_emg
+from ecutils.container import SubjectFile, subject_files
+from ecutils.emg import (epochs, preprocess_emg_local, startle_amplitude,
+                         FILTER_PARAMS)
+from ecutils.figures import FRAGMENT_DIR, RenderQueue, save_fragments
 from ecutils.fix_assignment import fix_assignment
-
-
-def count_events(list_of_events, values):
-    result = []
-    for v in values:
-        result.append(sum(e.value == v for e in list_of_events))
-    return result
-
-
-def score_trials(list_of_events, x_raw, x_prep, subject_code, stim_prefix):
-    """ Given a list of events, score CS+ / CS- / fix startle trials
+from ecutils import profiling
+from ecutils.cache import ResultCache, cache_key
+from ecutils.leases import WorkQueue
+from ecutils.scores import ScoreStore
+
+# everything that influences results, apart from input files
+# (increase version when the processing code changes)
+PARAMS = {
+    'version': 2,
+    'filter': FILTER_PARAMS,
+    'filter_padding': 1000,  # samples filtered on each side of probe windows
+    'baseline': 100,  # samples before the probe
+    'peak_window': [40, 240],  # samples after the probe
+    }
+
+
+# probe markers, in order of trial type index used for fragments
+PROBES = [4, 5, 6]  # fix, CS+, CS-
+PROBE_NAMES = ['fix', 'CS+', 'CS-']
+SCORE_COLUMNS = ('code', 'stimulus', 'trial', 'amplitude')
+
+
+def score_trials(events, x_raw, x_prep, subject_code, stim_prefix):
+    """ Given an EventCollection, score CS+ / CS- / fix startle trials
     Assumes fs = 2000 Hz
+
+    All probe windows are gathered into one (trials x samples) array and
+    scored at once. Returns a dict of columns (SCORE_COLUMNS) and fragments
+    for plotting, an array with dimensions: signal type, trial type, trial
+    number, samples.
     """
-    table_contents = []
-    max_trials = max(count_events(list_of_events, [4, 5, 6]))
-    fragments = np.zeros((2, 3, max_trials, 400))
-    # dimensions: signal type, trial type, trial number, samples
-
-    # figure out what trial are we dealing with
-    counter_plus, counter_minus, counter_fix = 0, 0, 0
-    for event in list_of_events:
-        if event.value == 5:
-            stimulus = '{} CS+'.format(stim_prefix)
-            counter_plus += 1
-            trial = counter_plus
-            t_type = 1
-        elif event.value == 6:
-            stimulus = '{} CS-'.format(stim_prefix)
-            counter_minus += 1
-            trial = counter_minus
-            t_type = 2
-        elif event.value == 4:
-            stimulus = '{} fix'.format(stim_prefix)
-            counter_fix += 1
-            trial = counter_fix
-            t_type = 0
-        else:
-            continue
 
-        # calculate the amplitude
-        baseline = np.mean(x_prep[event.sample - 100: event.sample])
-        peak = np.max(x_prep[event.sample + 40: event.sample + 240])
-
-        result = peak - baseline if peak > baseline else 0
-
-        # store the signal fragment for plotting (longer fragment than above)
-        frag_raw = x_raw[event.sample - 100: event.sample + 300]
-        frag_prep = x_prep[event.sample - 100: event.sample + 300]
-        # using trial minus one as index because trials start from 1
-        fragments[0, t_type, trial - 1, :] = frag_raw
-        fragments[1, t_type, trial - 1, :] = frag_prep
-
-        # save the amplitude (row in data frame)
-        row_content = {
-            'code': subject_code,
-            'stimulus': stimulus,
-            'trial': trial,
-            # 'peak_time': None,
-            'amplitude': result,
+    is_probe = np.isin(events.values, PROBES)
+    samples = events.samples[is_probe]
+    t_type = np.searchsorted(PROBES, events.values[is_probe])
+
+    # trials are numbered from 1, separately for each trial type
+    is_type = t_type[:, np.newaxis] == np.arange(len(PROBES))
+    trial = np.cumsum(is_type, axis=0)[np.arange(len(t_type)), t_type]
+
+    # windows around probes, long enough for scoring & for plotting
+    before = max(PARAMS['baseline'], 100)
+    after = max(PARAMS['peak_window'][1], 300)
+    epochs_prep = epochs(x_prep, samples, before, after)
+    epochs_raw = epochs(x_raw, samples, before, after)
+
+    # calculate the amplitudes
+    amplitude = startle_amplitude(epochs_prep, before, PARAMS['baseline'],
+                                  PARAMS['peak_window'])
+
+    # store the signal fragments for plotting (longer fragment than above)
+    max_trials = is_type.sum(axis=0).max() if len(t_type) else 0
+    fragments = np.zeros((2, len(PROBES), max_trials, 400))
+    # using trial minus one as index because trials start from 1
+    fragments[0, t_type, trial - 1, :] = epochs_raw[:, before-100:before+300]
+    fragments[1, t_type, trial - 1, :] = epochs_prep[:, before-100:before+300]
+
+    stimuli = np.array(['{} {}'.format(stim_prefix, name)
+                        for name in PROBE_NAMES], dtype=object)
+    columns = {
+        'code': np.full(len(t_type), subject_code, dtype=object),
+        'stimulus': stimuli[t_type],
+        'trial': trial,
+        'amplitude': amplitude,
         }
 
-        table_contents.append(row_content)
-
-    return table_contents, fragments
-
-
-def plot_grid(trial_arr, out_folder, subject_code):
-
-    s_before = 100
-    s_after = 300
-    t_axis = np.linspace(-s_before/2, s_after/2, s_before + s_after)
-
-    y_max = 0.20  # uniform for all subjects, should fit most reactions
-
-    n_trials = trial_arr.shape[2]
-    n_rows, n_cols = 3, int(np.ceil(n_trials/3))
-    fig, axs = plt.subplots(n_rows, n_cols, sharex='all', sharey='all',
-                            figsize=(24, 12))
-
-    for c_index, c_name in enumerate(['fix', 'CS+', 'CS-']):
-        for n, ax in enumerate(axs.flat):
-            ax.clear()
-            ax.plot(t_axis, trial_arr[0, c_index, n, :])  # raw
-            ax.plot(t_axis, trial_arr[1, c_index, n, :])  # prep
-
-            ax.set_title(str(n + 1))
-            ax.axvline(0, linestyle='--', color='black')
-            ax.fill_between([20, 120], 0, y_max, alpha=0.3)
-            ax.set_ylim(0, y_max)
-
-        fig.suptitle(c_name)
-        c_nicename = c_name.replace('+', '_plus').replace('-', '_minus')
-
-        fig.savefig(os.path.join(
-            out_folder, '{}_{}'.format(subject_code, c_nicename)))
-
-
-# data files
-data_files = glob.glob('out/raw_data/[A-Z]*_emg.npy')
-fname_pattern = re.compile('([A-Z]+)_emg.npy')
-
-for data_file in data_files:
-    event_file = data_file.replace('_emg.npy', '_events.txt')
-    subject = re.search(fname_pattern, data_file).group(1)
-
-    print(subject)
-
-    event_collection = EventCollection.from_txt(event_file)
-    emg_raw = np.load(data_file)
-    emg_preprocessed = preprocess_emg(emg_raw)
-    emg_rough = preprocess_emg(emg_raw, smooth=False)  # plot this & smoothed
-
-    rows_ofl, frag_ofl = score_trials(
-        list_of_events=event_collection.events_between_events(13, 14),
-        x_raw=emg_rough,
-        x_prep=emg_preprocessed,
-        subject_code=subject,
-        stim_prefix='obs'
-        )
-
-    rows_de, frag_de = score_trials(
-        list_of_events=event_collection.events_between_events(15, 16),
-        x_raw=emg_rough,
-        x_prep=emg_preprocessed,
-        subject_code=subject,
-        stim_prefix='direct'
-        )
-
-    df = pandas.DataFrame(
-        data=rows_ofl + rows_de,
-        columns=('code', 'stimulus', 'trial', 'amplitude')
-        )
-
-    # fix CS+ / CS- labels
-    # for some subjects versions were mismatched between OFL and DE
-    fix_assignment(subject, df)
-
-    trials = np.concatenate([frag_ofl, frag_de], axis=2)
-
-    df_directory = os.path.join('out', 'stat_data', 'emg')
-    if not os.path.exists(df_directory):
-        os.makedirs(df_directory)
-    df_filename = os.path.join(df_directory, subject + '.pickle')
-    df.to_pickle(df_filename)
+    return columns, fragments
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--force', help='ignore cached results',
+                        action='store_true')
+    parser.add_argument('--only', help='process only this subject, ignoring '
+                        'cached results (can be repeated)', action='append',
+                        metavar='CODE')
+    parser.add_argument('--no-figures', help='only save trial fragments, '
+                        'render figures later with render_figures.py',
+                        action='store_true')
+    parser.add_argument('--render_jobs', help='number of processes '
+                        'rendering figures', type=int, default=1)
+    parser.add_argument('--worker', help='claim subjects through leases in '
+                        'out/work, so that any number of workers (on hosts '
+                        'sharing the directory) can run at once',
+                        action='store_true')
+    parser.add_argument('--ttl', help='seconds after which the lease of an '
+                        'unresponsive worker expires', type=float,
+                        default=60.)
+    parser.add_argument('--report', help='record time & memory use of '
+                        'processing stages in out/reports (see '
+                        'ecutils/profiling.py)',
+                        action='store_true')
+    parser.add_argument('--summary', help='print a summary of the report '
+                        '(implies --report)', action='store_true')
+    args = parser.parse_args()
+
+    if args.report or args.summary:
+        profiling.enable('emg')
+
+    # data files
+    data_files = subject_files(os.path.join('out', 'raw_data'))
+    cache = ResultCache('emg')
+    store = ScoreStore('emg')
+    stored = store.codes()
+
+    # figures are drawn in other processes, scoring does not wait for them
+    renderer = None if args.no_figures else RenderQueue(args.render_jobs)
+
+    keys = {}
+    for subject, subject_file in data_files.items():
+        if args.only is not None and subject not in args.only:
+            continue
 
-    fig_directory = os.path.join('out', 'figures', 'emg')
-    if not os.path.exists(fig_directory):
-        os.makedirs(fig_directory)
-    plot_grid(trials, fig_directory, subject)
+        # skip subjects processed before with identical inputs & parameters
+        key = cache_key([subject_file], PARAMS)
+        if (not (args.force or args.only) and subject in stored
+                and cache.lookup(subject, key)):
+            print(subject, 'up to date')
+            continue
+        keys[subject] = key
+
+    if args.worker:
+        # other workers (on any host) process the subjects not claimed here
+        queue = WorkQueue('emg', ttl=args.ttl)
+        subjects = queue.claim(list(keys), keys)
+    else:
+        subjects = list(keys)
+
+    for subject in subjects:
+        subject_file, key = data_files[subject], keys[subject]
+        print(subject)
+
+        container = SubjectFile(subject_file)
+        event_collection = container.events()
+        emg_raw = container.channel('emg')  # memory-mapped
+
+        # only windows around startle probes are scored and plotted, so only
+        # these parts are filtered (and read from disk)
+        probes = event_collection.samples[
+            np.isin(event_collection.values, PROBES)]
+        with profiling.stage('preprocess_emg', subject) as s:
+            s.array('emg_raw', emg_raw)
+            # plot rough & smooth
+            emg_rough, emg_preprocessed = preprocess_emg_local(
+                emg_raw, probes, padding=PARAMS['filter_padding'])
+            s.note(probes=len(probes))
+
+        with profiling.stage('score', subject) as s:
+            scores_ofl, frag_ofl = score_trials(
+                events=event_collection.events_between_events(13, 14),
+                x_raw=emg_rough,
+                x_prep=emg_preprocessed,
+                subject_code=subject,
+                stim_prefix='obs'
+                )
+
+            scores_de, frag_de = score_trials(
+                events=event_collection.events_between_events(15, 16),
+                x_raw=emg_rough,
+                x_prep=emg_preprocessed,
+                subject_code=subject,
+                stim_prefix='direct'
+                )
+
+        df = pandas.DataFrame(
+            data={c: np.concatenate([scores_ofl[c], scores_de[c]])
+                  for c in SCORE_COLUMNS},
+            columns=SCORE_COLUMNS
+            )
+
+        # fix CS+ / CS- labels
+        # for some subjects versions were mismatched between OFL and DE
+        fix_assignment(subject, df)
+
+        trials = np.concatenate([frag_ofl, frag_de], axis=2)
+
+        # replaces scores of the subject from earlier runs
+        with profiling.stage('save_scores', subject):
+            store.upsert(df)
+
+        # save trials for plotting & queue the figures
+        with profiling.stage('fragments', subject) as s:
+            s.array('fragments', trials)
+            frag_file = save_fragments(
+                os.path.join(FRAGMENT_DIR, 'emg', subject + '.npz'),
+                'emg_grid', trials=trials)
+        if renderer is not None:
+            renderer.submit(frag_file, os.path.join('out', 'figures', 'emg'))
+
+        cache.store(subject, key, [store.manifest_file, frag_file])
+        if args.worker:
+            queue.complete(subject, key)
+
+    # one segment per table, for fast reading
+    store.compact()
+
+    if renderer is not None:
+        renderer.close()
+
+    if profiling.enabled():
+        records = profiling.report()
+        if args.summary:
+            profiling.print_summary(records)
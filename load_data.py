@@ -1,34 +1,192 @@
+import argparse
 import bioread
+import concurrent.futures
 import configparser
-import numpy as np
 import os
+import time
 
-import ecutils.eventhandler
+from ecutils import profiling
+from ecutils.acq import extract_acq
+from ecutils.cache import ResultCache, cache_key
+from ecutils.container import STORAGE, SUFFIX
+from ecutils.leases import WorkQueue
 
-config = configparser.ConfigParser()
-config.read('emocon_config.ini')
-SOURCE_DIR = config['DEFAULT']['SOURCE_DIR']
 OUT_FOLDER = 'out/raw_data'
 
-file_names = os.listdir(SOURCE_DIR)
-file_names = [f for f in file_names if f.endswith('.acq')]
-file_names = [f for f in file_names if not f.startswith('._')]
+# everything that influences the outputs, apart from the acq file itself
+PARAMS = {
+    'channels': {'eda': 'EDA100C', 'emg': 'EMG100C'},  # container: acq names
+    'first_digital_index': 2,
+    'width': 10,
+    'storage': None,  # or 'float32', 'int16', see ecutils.container
+    'compress': False,
+    }
 
-if not(os.path.exists(OUT_FOLDER)):
-    os.makedirs(OUT_FOLDER)
 
-for f_name in file_names:
-    data = bioread.read_file(os.path.join(SOURCE_DIR, f_name))
+def extract_subject(source_dir, f_name):
+    """Extract EDA, EMG and events from a single acq file
+
+    Everything is written to a single subject container (ecutils.container),
+    atomically, so an interrupted run never leaves half-written files.
+    Returns the list of written files.
+    """
+
+    subject_code = os.path.splitext(f_name)[0]
 
     print('Extracting from', f_name)
-    ec = ecutils.eventhandler.EventCollection.from_acq(data)
+    # only EDA, EMG & digital channels are read, in chunks
+    out_file = os.path.join(OUT_FOLDER, subject_code + SUFFIX)
+    source = os.path.join(source_dir, f_name)
+    metadata = {
+        'subject': subject_code,
+        'source_file': f_name,
+        'source_size': os.path.getsize(source),
+        'source_mtime': os.path.getmtime(source),
+        'extracted': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'bioread_version': bioread.__version__,
+        'params': PARAMS,
+        }
+    extract_acq(
+        source,
+        out_file,
+        PARAMS['channels'],
+        first_digital_index=PARAMS['first_digital_index'],
+        width=PARAMS['width'],
+        metadata=metadata,
+        storage=PARAMS['storage'],
+        compress=PARAMS['compress'])
+
+    return [out_file]
+
 
-    eda = data.named_channels['EDA100C'].data
-    emg = data.named_channels['EMG100C'].data
+def run_subject(source_dir, f_name, force=False):
+    """Wrapper for extract_subject which skips files extracted previously
+    (unless force is set) and reports errors instead of raising
 
+    Returns a tuple: (file name, time in seconds, status)
+    """
+
+    t0 = time.perf_counter()
+    cache = ResultCache('raw_data')
     subject_code = os.path.splitext(f_name)[0]
+    try:
+        key = cache_key([os.path.join(source_dir, f_name)], PARAMS)
+        if not force and cache.lookup(subject_code, key) is not None:
+            return f_name, time.perf_counter() - t0, 'cached'
+        with profiling.stage('extract', subject_code) as s:
+            outputs = extract_subject(source_dir, f_name)
+            s.note(output_bytes=sum(os.path.getsize(o) for o in outputs))
+        cache.store(subject_code, key, outputs)
+    except Exception as e:
+        return f_name, time.perf_counter() - t0, 'FAILED: ' + repr(e)
+    return f_name, time.perf_counter() - t0, 'ok'
+
+
+def init_worker(params, report_dir):
+    # worker processes may be started without the parent's state
+    PARAMS.update(params)
+    profiling.init_worker(report_dir)
+
+
+def print_summary(results):
+    failed = [r for r in results if r[2].startswith('FAILED')]
+    cached = [r for r in results if r[2] == 'cached']
+
+    print('\n{:<30} {:>8}  {}'.format('file', 'time (s)', 'status'))
+    for f_name, elapsed, status in sorted(results):
+        print('{:<30} {:>8.1f}  {}'.format(f_name, elapsed, status))
+    print('{} files processed, {} up to date, {} failed'.format(
+        len(results), len(cached), len(failed)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', help='number of files processed in parallel',
+                        type=int, default=1)
+    parser.add_argument('--force', help='ignore cached results',
+                        action='store_true')
+    parser.add_argument('--only', help='process only this subject, ignoring '
+                        'cached results (can be repeated)', action='append',
+                        metavar='CODE')
+    parser.add_argument('--storage', help='store signals in a more compact '
+                        'form (default: as in the acq file, usually float64; '
+                        'see ecutils/container.py for error bounds)',
+                        choices=STORAGE)
+    parser.add_argument('--compress', help='compress stored signals',
+                        action='store_true')
+    parser.add_argument('--worker', help='claim files through leases in '
+                        'out/work, so that any number of workers (on hosts '
+                        'sharing the directories) can run at once; start '
+                        'several workers instead of using --jobs',
+                        action='store_true')
+    parser.add_argument('--ttl', help='seconds after which the lease of an '
+                        'unresponsive worker expires', type=float,
+                        default=60.)
+    parser.add_argument('--report', help='record time & memory use of '
+                        'processing stages in out/reports (see '
+                        'ecutils/profiling.py)',
+                        action='store_true')
+    args = parser.parse_args()
+    if args.worker and args.jobs > 1:
+        parser.error('--worker processes one file at a time')
+    PARAMS['storage'] = args.storage
+    PARAMS['compress'] = args.compress
+
+    config = configparser.ConfigParser()
+    config.read('emocon_config.ini')
+    SOURCE_DIR = config['DEFAULT']['SOURCE_DIR']
+
+    file_names = os.listdir(SOURCE_DIR)
+    file_names = [f for f in file_names if f.endswith('.acq')]
+    file_names = [f for f in file_names if not f.startswith('._')]
+    if args.only is not None:
+        file_names = [f for f in file_names
+                      if os.path.splitext(f)[0] in args.only]
+    force = args.force or args.only is not None
+
+    if not(os.path.exists(OUT_FOLDER)):
+        os.makedirs(OUT_FOLDER)
+
+    if args.report:
+        profiling.enable('raw_data')
+
+    results = []
+    if args.worker:
+        # done markers are keyed by size & time of the acq file, not by its
+        # contents, so that workers do not read all files to compare them
+        names = {os.path.splitext(f)[0]: f for f in file_names}
+        keys = {}
+        for code, f_name in names.items():
+            source = os.path.join(SOURCE_DIR, f_name)
+            keys[code] = cache_key([], {
+                'size': os.path.getsize(source),
+                'mtime': os.path.getmtime(source), 'params': PARAMS})
+        queue = WorkQueue('raw_data', ttl=args.ttl)
+        for code in queue.claim(list(names), keys):
+            result = run_subject(SOURCE_DIR, names[code], force)
+            results.append(result)
+            if not result[2].startswith('FAILED'):
+                queue.complete(code, keys[code])
+    elif args.jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                args.jobs, initializer=init_worker,
+                initargs=(PARAMS, profiling.report_directory())) as executor:
+            futures = {}
+            for f_name in file_names:
+                futures[executor.submit(
+                    run_subject, SOURCE_DIR, f_name, force)] = f_name
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    # worker process died, e.g. killed by the OS
+                    results.append(
+                        (futures[future], float('nan'), 'FAILED: ' + repr(e)))
+    else:
+        for f_name in file_names:
+            results.append(run_subject(SOURCE_DIR, f_name, force))
 
-    np.save(os.path.join(OUT_FOLDER, subject_code + '_eda'), eda)
-    np.save(os.path.join(OUT_FOLDER, subject_code + '_emg'), emg)
+    print_summary(results)
 
-    ec.to_txt(os.path.join(OUT_FOLDER, subject_code + '_events.txt'))
+    if profiling.enabled():
+        profiling.print_summary(profiling.report())
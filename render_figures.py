@@ -0,0 +1,26 @@
+"""Render figures from trial fragments saved by eda_master.py and
+emg_master.py (e.g. after running them with --no-figures)"""
+
+import argparse
+import os
+
+from ecutils.figures import FIGURE_DIR, RenderQueue, fragment_files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', help='render only this subject (can be '
+                        'repeated)', action='append', metavar='CODE')
+    parser.add_argument('--modality', help='render only figures of this '
+                        'modality', choices=['eda', 'emg'], action='append')
+    parser.add_argument('--jobs', help='number of processes rendering '
+                        'figures', type=int, default=1)
+    args = parser.parse_args()
+
+    renderer = RenderQueue(args.jobs)
+    for modality in args.modality or ['eda', 'emg']:
+        fig_directory = os.path.join(FIGURE_DIR, modality)
+        for fragment_file in fragment_files(modality, args.only):
+            renderer.submit(fragment_file, fig_directory)
+
+    for fig_file in sorted(renderer.close()):
+        print(fig_file)
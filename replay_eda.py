@@ -0,0 +1,228 @@
+"""Replay recorded sessions through the online EDA decomposition
+
+EDA of subject containers from out/raw_data is downsampled (as by
+eda_master.py) and fed to ecutils.eda_stream.EDAStream in blocks, at the pace
+of the recording (--speed 1), faster or as fast as possible (--speed 0).
+Trials of the OFL and DE phases are scored as soon as they are ready, with
+eda_master.score_trials and the SMNA summed over the same windows.
+
+For each subject, the processing time of each update, the latency of trial
+scores (from the end of a trial until its scores are available, including
+processing) and the agreement with the offline scores (eda_master.
+process_phase on whole phases, computed here) are summarized.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import time
+
+import numpy as np
+import pandas
+
+import cvxEDA
+import eda_master
+from ecutils.container import subject_files
+from ecutils.eda_stream import EDAStream, TrialStream
+
+PARAMS = eda_master.PARAMS
+
+
+def score(trials, name):
+    """eda_master.score_trials, with SMNA summed over the same windows"""
+
+    rows = eda_master.score_trials(trials, name)
+    smna = {w: trials.score_smna(PARAMS[w]['onset'],
+                                 PARAMS[w]['duration'])[0]
+            for w in ['cs_window', 'us_window']}
+    for row in rows:
+        is_us = 'US' in row['stimulus'].split()
+        row['smna'] = smna['us_window' if is_us else 'cs_window'][row['trial']]
+    return rows
+
+
+def replay(eda, events, stream, trial_stream, block_length, speed=1.,
+           callback=None):
+    """Feed a downsampled signal and its events to the streams, paced by
+    speed (0: no pacing)
+
+    Returns a DataFrame of scores (columns of score, and latency: seconds
+    from the end of the trial until its scores were available) and a dict of
+    timing statistics. callback is called with the rows of each trial as
+    they become ready.
+    """
+
+    fs = stream.fs
+    order = np.argsort(events.samples, kind='stable')
+    samples = np.asarray(events.samples)[order]
+    values = np.asarray(events.values)[order]
+    trial_length = trial_stream.n_samples / fs
+
+    rows, block_times = [], []
+    late = 0
+
+    def add(trials, elapsed):
+        for prefix, number, onset, trial in trials:
+            trial_rows = score(trial, prefix)
+            latency = (stream.n_samples / fs + elapsed
+                       - onset / fs - trial_length)
+            for row in trial_rows:
+                row['trial'] = number
+                row['latency'] = latency
+            rows.extend(trial_rows)
+            if callback is not None:
+                callback(trial_rows)
+
+    begin = time.perf_counter()
+    for start in range(0, len(eda), block_length):
+        stop = min(start + block_length, len(eda))
+        if speed > 0:
+            # wait until the block would have been recorded
+            due = begin + stop / fs / speed
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            elif wait < -block_length / fs / speed:
+                late += 1  # more than a block behind the recording
+
+        first, last = np.searchsorted(samples, [start, stop])
+        t0 = time.perf_counter()
+        trials = trial_stream.feed(stream.feed(eda[start:stop]),
+                                   samples[first:last], values[first:last],
+                                   now=stop)
+        elapsed = time.perf_counter() - t0
+        block_times.append(elapsed)
+        add(trials, elapsed)
+
+    t0 = time.perf_counter()
+    trials = trial_stream.feed(stream.flush()) + trial_stream.flush()
+    add(trials, time.perf_counter() - t0)
+
+    stats = {
+        'seconds': len(eda) / fs,
+        'processing': sum(block_times),
+        'block_max': max(block_times),
+        'solves': len(stream.backend.history),
+        'late_blocks': late,
+        }
+    return pandas.DataFrame(rows), stats
+
+
+def offline_scores(code, eda, events):
+    """Scores of trials from the decomposition of whole phases"""
+
+    rows = []
+    for start, stop, name in [(13, 14, 'obs'), (15, 16, 'direct')]:
+        # cvxopt reports progress with print
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, trials = eda_master.process_phase(
+                eda, events, start, stop, 1, PARAMS['fs'], code)
+        rows.extend(score(trials, name))
+    return pandas.DataFrame(rows)
+
+
+def agreement(online, offline):
+    """Compare online and offline scores of a subject
+
+    Returns a dict: number of rows in both, of rows where only one has an
+    amplitude above threshold, median and largest absolute difference of
+    amplitudes (where both have one) and of SMNA sums.
+    """
+
+    both = online.merge(offline, on=['stimulus', 'trial'],
+                        suffixes=('', '_offline'))
+    has = both.amplitude.notnull()
+    has_offline = both.amplitude_offline.notnull()
+    amplitude = (both.amplitude - both.amplitude_offline)[
+        has & has_offline].abs()
+    smna = (both.smna - both.smna_offline).abs()
+    return {
+        'rows': len(both),
+        'threshold_mismatch': int((has != has_offline).sum()),
+        'amplitude_median': amplitude.median(),
+        'amplitude_max': amplitude.max(),
+        'smna_median': smna.median(),
+        'smna_max': smna.max(),
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', help='replay only this subject (can be '
+                        'repeated)', action='append', metavar='CODE')
+    parser.add_argument('--speed', help='replay speed relative to the '
+                        'recording, 0 for as fast as possible', type=float,
+                        default=1.)
+    parser.add_argument('--block', help='block length (s)', type=float,
+                        default=1.)
+    parser.add_argument('--window', help='length of decomposed windows (s)',
+                        type=float, default=60.)
+    parser.add_argument('--lookahead', help='signal needed after a sample '
+                        'before it is final (s)', type=float, default=10.)
+    parser.add_argument('--hop', help='time between solves (s), a multiple '
+                        'of the tonic knot distance', type=float)
+    parser.add_argument('--backend', help='solver used by cvxEDA',
+                        choices=sorted(cvxEDA.BACKENDS), default='cvxopt')
+    parser.add_argument('--no-warm-start', help='solve each window from '
+                        'scratch', action='store_true')
+    parser.add_argument('--quiet', help='do not print each score',
+                        action='store_true')
+    args = parser.parse_args()
+
+    fs = PARAMS['fs']
+    # the longest scoring window decides when a trial can be scored
+    ready = max(PARAMS[w]['onset'] + PARAMS[w]['duration']
+                for w in ['cs_window', 'us_window'])
+
+    def show(rows):
+        for row in rows:
+            print('{:<16} {:>3}  {:8.4f}  {:8.4f}  ({:.1f} s)'.format(
+                row['stimulus'], row['trial'], row['amplitude'],
+                row['smna'], row['latency']))
+
+    data_files = subject_files(os.path.join('out', 'raw_data'))
+    for code, subject_file in data_files.items():
+        if args.only is not None and code not in args.only:
+            continue
+        print(code)
+
+        eda, events = eda_master.prepare_subject(code, subject_file)
+        if args.backend == 'cvxopt':
+            backend = cvxEDA.CvxoptBackend(
+                options={'reltol': 1e-9, 'show_progress': False})
+        else:
+            backend = cvxEDA.BACKENDS[args.backend]()
+        stream = EDAStream(fs, args.window, args.lookahead, args.hop,
+                           backend=backend,
+                           warm_start=not args.no_warm_start,
+                           **PARAMS['cvxeda'])
+        trial_stream = TrialStream(fs, PARAMS['trial_length'],
+                                   PARAMS['baseline_length'], ready)
+        online, stats = replay(eda, events, stream, trial_stream,
+                               int(round(args.block * fs)), args.speed,
+                               callback=None if args.quiet else show)
+
+        iterations = [h['iterations'] or 0 for h in backend.history]
+        print('{:.0f} s of signal processed in {:.2f} s ({:.0f}x real '
+              'time), {} blocks behind schedule'.format(
+                  stats['seconds'], stats['processing'],
+                  stats['seconds'] / stats['processing'],
+                  stats['late_blocks']))
+        print('{} solves of {} s windows: {:.1f} iterations on average, '
+              'longest update {:.3f} s'.format(
+                  stats['solves'], stream.window / fs, np.mean(iterations),
+                  stats['block_max']))
+        print('samples final after at most {:.0f} s; trial scores {:.1f} s '
+              '(median), {:.1f} s (max) after the end of a trial'.format(
+                  stream.latency / fs, online.latency.median(),
+                  online.latency.max()))
+
+        result = agreement(online, offline_scores(code, eda, events))
+        print('{rows} scores compared with whole-phase decomposition, '
+              '{threshold_mismatch} above threshold in only one of them'
+              .format(**result))
+        print('absolute difference of amplitudes: median '
+              '{amplitude_median:.4f}, max {amplitude_max:.4f}; of SMNA '
+              'sums: median {smna_median:.4f}, max {smna_max:.4f}'
+              .format(**result))
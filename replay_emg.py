@@ -0,0 +1,182 @@
+"""Replay recorded sessions through the online startle scoring
+
+Subject containers from out/raw_data are fed to ecutils.stream.StartleStream
+in blocks, at the pace of the recording (--speed 1), faster (--speed 10) or
+as fast as possible (--speed 0, for throughput measurements). Digital
+channels are not stored in the containers, they are re-encoded from the
+events. Scores are printed as they become ready; for each subject the
+latency, the processing time and the agreement with the offline scores
+(out/scores/emg) are summarized.
+
+Latency of a score is the signal needed after the probe (until the end of
+the block in which the score became ready) plus the time spent processing
+that block.
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas
+
+import emg_master
+from ecutils.container import SubjectFile, subject_files
+from ecutils.eventhandler import marker_channels
+from ecutils.fix_assignment import fix_assignment
+from ecutils.scores import ScoreStore
+from ecutils.stream import StartleStream
+
+
+def blocks(container, block_length):
+    """Consecutive blocks of EMG and digital channels from a container"""
+
+    if container.fs('emg') != container.events_fs:
+        raise ValueError('EMG and events of {} differ in sampling '
+                         'rate'.format(container.file_name))
+    emg = container.channel('emg')
+    events = container.events()
+    order = np.argsort(events.samples, kind='stable')
+    samples = np.asarray(events.samples)[order]
+    values = np.asarray(events.values)[order]
+    for start in range(0, len(emg), block_length):
+        stop = min(start + block_length, len(emg))
+        yield emg[start:stop], marker_channels(samples, values, start, stop)
+
+
+def replay(subject_file, stream, block_length, speed=1., callback=None):
+    """Feed a subject container to stream, paced by speed (0: no pacing)
+
+    Returns a DataFrame of scores (columns of StartleStream.feed and time
+    of the probe, compute, the processing time of the block in which a
+    score became ready, and latency, both in seconds) and a dict of timing
+    statistics. callback is called with each score as it becomes ready.
+    """
+
+    container = SubjectFile(subject_file)
+    fs = container.fs('emg')
+    scores, block_times = [], []
+    late = 0
+
+    begin = time.perf_counter()
+    for emg, digital in blocks(container, block_length):
+        if speed > 0:
+            # wait until the block would have been recorded
+            due = begin + (stream.n_samples + len(emg)) / fs / speed
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            elif wait < -block_length / fs / speed:
+                late += 1  # more than a block behind the recording
+
+        start = time.perf_counter()
+        ready = stream.feed(emg, digital)
+        elapsed = time.perf_counter() - start
+        block_times.append(elapsed)
+        scores.extend(_finish(ready, elapsed, fs, callback))
+
+    scores.extend(_finish(stream.flush(), 0., fs, callback))
+
+    block_times = np.array(block_times)
+    stats = {
+        'seconds': stream.n_samples / fs,
+        'wall': time.perf_counter() - begin,
+        'processing': block_times.sum(),
+        'block_mean': block_times.mean(),
+        'block_max': block_times.max(),
+        'late_blocks': late,
+        }
+    df = pandas.DataFrame(
+        scores, columns=['sample', 'time', 'stimulus', 'trial', 'amplitude',
+                         'ready', 'compute', 'latency'])
+    return df, stats
+
+
+def _finish(scores, compute, fs, callback):
+    for score in scores:
+        score['time'] = score['sample'] / fs
+        score['compute'] = compute
+        score['latency'] = (score['ready'] - score['sample']) / fs + compute
+        if callback is not None:
+            callback(score)
+    return scores
+
+
+def agreement(code, df, offline):
+    """Largest absolute difference to the offline scores of a subject, and
+    the number of probes found in both"""
+
+    online = df[['stimulus', 'trial', 'amplitude']].copy()
+    fix_assignment(code, online)
+    offline = offline.astype({'stimulus': object})
+    both = online.merge(offline, on=['stimulus', 'trial'],
+                        suffixes=('', '_offline'))
+    if len(both) == 0:
+        return np.nan, 0
+    return (np.abs(both.amplitude - both.amplitude_offline).max(),
+            len(both))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', help='replay only this subject (can be '
+                        'repeated)', action='append', metavar='CODE')
+    parser.add_argument('--speed', help='replay speed relative to the '
+                        'recording, 0 for as fast as possible', type=float,
+                        default=1.)
+    parser.add_argument('--block', help='block length (ms)', type=float,
+                        default=50.)
+    parser.add_argument('--causal', help='filter causally (lower latency, '
+                        'amplitudes differ from offline)',
+                        action='store_true')
+    parser.add_argument('--budget', help='latency budget (ms); scores '
+                        'later than that are counted', type=float)
+    parser.add_argument('--quiet', help='do not print each score',
+                        action='store_true')
+    args = parser.parse_args()
+
+    data_files = subject_files(os.path.join('out', 'raw_data'))
+    store = ScoreStore('emg')
+    stored = store.codes()
+
+    def show(score):
+        print('{:>9.2f} s  {:<12} {:>3}  {:8.4f}  ({:.0f} ms)'.format(
+            score['time'], score['stimulus'], score['trial'],
+            score['amplitude'], score['latency'] * 1000))
+
+    for subject, subject_file in data_files.items():
+        if args.only is not None and subject not in args.only:
+            continue
+        print(subject)
+
+        stream = StartleStream(
+            baseline=emg_master.PARAMS['baseline'],
+            peak_window=emg_master.PARAMS['peak_window'],
+            padding=emg_master.PARAMS['filter_padding'],
+            causal=args.causal,
+            probes=dict(zip(emg_master.PROBES, emg_master.PROBE_NAMES)))
+        fs = SubjectFile(subject_file).fs('emg')
+        block_length = int(round(args.block / 1000 * fs))
+        df, stats = replay(subject_file, stream, block_length, args.speed,
+                           callback=None if args.quiet else show)
+
+        print('{} probes, {:.0f} s of signal processed in {:.2f} s '
+              '({:.0f}x real time), {} blocks behind schedule'.format(
+                  len(df), stats['seconds'], stats['processing'],
+                  stats['seconds'] / stats['processing'],
+                  stats['late_blocks']))
+        print('block processing: mean {:.2f} ms, max {:.2f} ms'.format(
+            stats['block_mean'] * 1000, stats['block_max'] * 1000))
+        if len(df):
+            print('latency: median {:.0f} ms, max {:.0f} ms (signal needed '
+                  'after a probe: {:.0f} ms)'.format(
+                      df.latency.median() * 1000, df.latency.max() * 1000,
+                      stream.latency / fs * 1000))
+        if args.budget is not None:
+            print('{} scores over the budget of {:.0f} ms'.format(
+                (df.latency * 1000 > args.budget).sum(), args.budget))
+        if subject in stored:
+            diff, n = agreement(subject, df, store.read(
+                ['stimulus', 'trial', 'amplitude'], codes=[subject]))
+            print('{} probes scored offline, largest difference '
+                  '{:.2e}'.format(n, diff))
@@ -0,0 +1,129 @@
+"""Resampling statistics on the summary tables of wrangle_table.py
+
+For each phase (obs, direct) of out/stat_data/{eda,emg}_summary.csv (mean
+normalized amplitude of each subject and stimulus, with contingency_known),
+the CS+ - CS- difference of each subject is tested:
+# in all subjects, in those who knew the contingency and in those who did
+  not: sign-flip test of the mean difference, bootstrap interval of it
+# between subjects who knew the contingency and those who did not:
+  permutation of the group labels, bootstrap interval (groups resampled
+  separately) of the difference of group means
+
+See ecutils/bootstrap.py. Results are written to
+out/stat_data/{eda,emg}_tests.csv and printed.
+"""
+
+import argparse
+import itertools
+import os
+import time
+
+import pandas
+
+from ecutils.bootstrap import bootstrap_ci, permutation_test, sign_flip_test
+
+PHASES = ['obs', 'direct']
+
+
+def cs_differences(summary):
+    """CS+ - CS- of each subject, a column for each phase"""
+
+    return pandas.DataFrame({
+        phase: summary[phase + ' CS+'] - summary[phase + ' CS-']
+        for phase in PHASES if phase + ' CS+' in summary.columns})
+
+
+def contingency_groups(summary):
+    """Boolean masks of subjects who knew the contingency, and who did not
+    (subjects without a contingency rating are in neither)"""
+
+    known = summary['contingency_known'].map(
+        {True: True, False: False, 'True': True, 'False': False})
+    return {'known': known.eq(True).values,
+            'unknown': known.eq(False).values}
+
+
+def test_table(summary, n_resamples=10000, confidence=.95, seed=0,
+               **kwargs):
+    """Tests of CS+ vs CS- and of contingency known vs unknown
+
+    Each test and interval is resampled with its own seed, (seed, number in
+    the table). Other keyword arguments (chunk, jobs) are passed to
+    ecutils.bootstrap.resample. Returns a DataFrame with a row per test:
+    contrast, group, test, n (subjects), estimate (mean), ci_low, ci_high
+    and p.
+    """
+
+    differences = cs_differences(summary)
+    groups = contingency_groups(summary)
+    numbers = itertools.count()
+    rows = []
+    for phase, d in differences.items():
+        contrast = '{} CS+ - CS-'.format(phase)
+        for group, mask in [('all', slice(None)), ('known', groups['known']),
+                            ('unknown', groups['unknown'])]:
+            values = d.values[mask]
+            n = int(values.size - pandas.isnull(values).sum())
+            if n == 0:
+                continue
+            estimate, p = sign_flip_test(
+                values, n_resamples, seed=(seed, next(numbers)), **kwargs)
+            low, high = bootstrap_ci(
+                values, None, n_resamples, confidence,
+                seed=(seed, next(numbers)), **kwargs)
+            rows.append((contrast, group, 'sign flip', n, estimate, low,
+                         high, p))
+
+        known = d.values[groups['known']]
+        unknown = d.values[groups['unknown']]
+        n = int(pandas.notnull(known).sum() + pandas.notnull(unknown).sum())
+        if pandas.notnull(known).any() and pandas.notnull(unknown).any():
+            estimate, p = permutation_test(
+                known, unknown, n_resamples, seed=(seed, next(numbers)),
+                **kwargs)
+            low, high = bootstrap_ci(
+                known, unknown, n_resamples, confidence,
+                seed=(seed, next(numbers)), **kwargs)
+            rows.append((contrast, 'known - unknown', 'permutation', n,
+                         estimate, low, high, p))
+
+    return pandas.DataFrame(rows, columns=['contrast', 'group', 'test', 'n',
+                                           'estimate', 'ci_low', 'ci_high',
+                                           'p'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resamples', help='number of resamples of each '
+                        'test', type=int, default=100000)
+    parser.add_argument('--confidence', help='level of bootstrap intervals',
+                        type=float, default=.95)
+    parser.add_argument('--seed', help='seed of the resamples (results do '
+                        'not depend on --jobs)', type=int, default=0)
+    parser.add_argument('--chunk', help='resamples generated at once (memory '
+                        'use: chunk x subjects x 8 bytes)', type=int,
+                        default=10000)
+    parser.add_argument('--jobs', help='number of processes', type=int,
+                        default=1)
+    args = parser.parse_args()
+
+    pandas.set_option('display.width', 120)
+    for modality in ['eda', 'emg']:
+        file_name = os.path.join('out', 'stat_data',
+                                 modality + '_summary.csv')
+        if not os.path.exists(file_name):
+            print(file_name, 'not found, run wrangle_table.py first')
+            continue
+        summary = pandas.read_csv(file_name, index_col=0)
+
+        t0 = time.perf_counter()
+        table = test_table(summary, args.resamples, args.confidence,
+                           seed=args.seed, chunk=args.chunk, jobs=args.jobs)
+        elapsed = time.perf_counter() - t0
+
+        print('{}: {} subjects, {} tests with {} resamples in {:.2f} s'
+              .format(modality.upper(), len(summary), len(table),
+                      args.resamples, elapsed))
+        print(table.to_string(index=False, float_format='{:.4f}'.format))
+        table.to_csv(os.path.join('out', 'stat_data', modality + '_tests.csv'),
+                     index=False)
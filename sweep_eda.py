@@ -0,0 +1,241 @@
+"""Score EDA trials with other scoring windows, without solving cvxEDA again
+
+eda_master.py stores the decomposed OFL and DE phases of each subject in
+out/decompositions/eda (see ecutils.eda.save_trial_sets). sweep() scores the
+trials of all subjects for a grid of parameter sets: onset, duration and
+baseline length of the CS and US windows (cs_window and us_window in
+eda_master.PARAMS) and the amplitude threshold. Trials of a phase are
+stacked into one matrix (trials of all subjects x samples around the onset),
+so each distinct baseline or response window is reduced once, for all
+trials and for all parameter sets which share it.
+
+The result is a tidy table with a row per parameter set and score (the
+scores of eda_master.py, with CS+ / CS- labels fixed): the number of the
+parameter set, the parameters, code, stimulus, trial and amplitude (NaN
+below threshold).
+"""
+
+import argparse
+import glob
+import itertools
+import os
+import time
+import warnings
+
+import numpy as np
+import pandas
+
+import eda_master
+from ecutils.eda import DECOMPOSITION_DIR, THRESHOLD, load_trial_sets
+from ecutils.fix_assignment import fix_assignment
+
+# parameters of a set: scoring window, parameter of TrialSet.score_eir
+WINDOWS = {'cs': 'cs_window', 'us': 'us_window'}
+WINDOW_PARAMS = ['onset', 'duration', 'baseline_length']
+PARAMETERS = ['{}_{}'.format(w, p) for w in WINDOWS
+              for p in WINDOW_PARAMS] + ['threshold']
+
+
+def load_decompositions(codes=None,
+                        directory=os.path.join(DECOMPOSITION_DIR, 'eda')):
+    """Dict of code: dict of phase name ('obs', 'direct'): TrialSet"""
+
+    decompositions = {}
+    for file_name in sorted(glob.glob(os.path.join(directory, '*.npz'))):
+        code = os.path.splitext(os.path.basename(file_name))[0]
+        if codes is None or code in codes:
+            decompositions[code] = load_trial_sets(file_name)
+    return decompositions
+
+
+def parameter_grid(**axes):
+    """All combinations of parameter values, as a DataFrame
+
+    Keyword arguments are names of PARAMETERS (e.g. cs_onset=[0, .5, 1]),
+    with a value or a list of values; parameters which are not given keep
+    the values used by eda_master.py.
+    """
+
+    unknown = set(axes) - set(PARAMETERS)
+    if unknown:
+        raise KeyError('No such parameters: {}'.format(sorted(unknown)))
+
+    values = []
+    for name in PARAMETERS:
+        if name in axes:
+            value = axes[name]
+        elif name == 'threshold':
+            value = THRESHOLD
+        else:
+            window, param = name.split('_', 1)
+            value = eda_master.PARAMS[WINDOWS[window]][param]
+        values.append(np.atleast_1d(value).astype(float).tolist())
+    return pandas.DataFrame(list(itertools.product(*values)),
+                            columns=PARAMETERS)
+
+
+def window_samples(onset, duration, baseline_length, fs, n_bl_samples):
+    """Baseline and response windows, as (start, stop, reversed) with
+    samples relative to trial onsets, as taken by TrialSet.score_eir"""
+
+    if onset == 0:
+        # reversed samples before onset (summed in the same order)
+        bl_end_smp = int(baseline_length * fs)
+        if bl_end_smp > n_bl_samples:
+            raise ValueError('Baseline too long')
+        baseline = (1 - bl_end_smp, 1, True)
+    else:
+        bl_start_smp = int((onset - baseline_length) * fs)
+        if bl_start_smp < 0:
+            raise ValueError('For start > 0, baseline is too long')
+        baseline = (bl_start_smp, int(onset * fs), False)
+    response = (int(onset * fs), int((onset + duration) * fs), False)
+    return baseline, response
+
+
+class _Phase:
+    def __init__(self, name, trial_sets):
+        """Trials of a phase of all subjects, and the rows they are scored
+        in (score_rows)"""
+
+        first = next(iter(trial_sets.values()))
+        self.fs = first.fs
+        self.n_bl_samples = first.n_bl_samples
+        self.trial_sets = trial_sets
+        self.min_onset = min(t.onsets.min() for t in trial_sets.values()
+                             if len(t))
+
+        labels, offset = [], 0
+        for code, trials in trial_sets.items():
+            if (trials.fs, trials.n_bl_samples, trials.n_samples) != (
+                    self.fs, self.n_bl_samples, first.n_samples):
+                raise ValueError('Trials of {} differ in sampling rate or '
+                                 'length'.format(code))
+            rows = pandas.DataFrame(eda_master.score_rows(trials, name),
+                                    columns=['stimulus', 'trial', 'window'])
+            rows['code'] = code
+            rows['row'] = rows['trial'] + offset
+            fix_assignment(code, rows)
+            labels.append(rows)
+            offset += len(trials)
+        self.labels = pandas.concat(labels, ignore_index=True)
+        self.matrix = None
+        self._reduced = {}
+
+    def stack(self, start, stop):
+        """Phasic signal of all trials, samples start ... stop-1"""
+
+        self.start = start
+        self.matrix = np.concatenate(
+            [t.windows(t.signal, start, stop)
+             for t in self.trial_sets.values()])
+
+    def reduce(self, func, window):
+        """func (e.g. np.nanmax) of each trial over a window (start, stop,
+        reversed), computed once for each window"""
+
+        if (func, window) not in self._reduced:
+            start, stop, reverse = window
+            samples = self.matrix[:, start - self.start:stop - self.start]
+            with warnings.catch_warnings():
+                # all-NaN windows (beyond the signal) give NaN, as score_eir
+                warnings.simplefilter('ignore', RuntimeWarning)
+                self._reduced[func, window] = func(
+                    samples[:, ::-1] if reverse else samples, axis=1)
+        return self._reduced[func, window]
+
+
+def sweep(decompositions, grid):
+    """Score all trials with each parameter set
+
+    Arguments:
+    # decompositions -- dict of code: dict of phase name: TrialSet
+      (load_decompositions)
+    # grid -- DataFrame of parameter sets, columns PARAMETERS
+      (parameter_grid)
+
+    Returns a DataFrame with columns set (row of grid), PARAMETERS, code,
+    stimulus, trial and amplitude.
+    """
+
+    names = sorted({n for d in decompositions.values() for n in d},
+                   key=['obs', 'direct'].index)
+    phases = [_Phase(name, {code: d[name]
+                            for code, d in decompositions.items()
+                            if name in d})
+              for name in names]
+
+    # windows of each parameter set, and the samples needed for all of them
+    windows = []
+    for phase in phases:
+        windows.append([{
+            w: window_samples(*params[['{}_{}'.format(w, p)
+                                       for p in WINDOW_PARAMS]],
+                              phase.fs, phase.n_bl_samples)
+            for w in WINDOWS} for _, params in grid.iterrows()])
+        ranges = [r[:2] for s in windows[-1] for b_r in s.values()
+                  for r in b_r]
+        # baselines before onset must be within the phase, see score_eir
+        if (phase.min_onset < phase.n_bl_samples
+                and (grid[['cs_onset', 'us_onset']] == 0).values.any()):
+            raise ValueError('Baseline too long')
+        phase.stack(min(r[0] for r in ranges), max(r[1] for r in ranges))
+
+    amplitudes = []
+    for i, threshold in enumerate(grid['threshold']):
+        for phase, phase_windows in zip(phases, windows):
+            amplitude = np.empty(len(phase.labels))
+            for w, window in WINDOWS.items():
+                rows = (phase.labels['window'] == window).values
+                baseline, response = phase_windows[i][w]
+                amplitude[rows] = (
+                    phase.reduce(np.nanmax, response)
+                    - phase.reduce(np.nanmean, baseline))[
+                        phase.labels['row'].values[rows]]
+            amplitude[~(amplitude > threshold)] = np.nan
+            amplitudes.append(amplitude)
+
+    labels = pandas.concat([p.labels for p in phases], ignore_index=True)
+    n = len(labels)
+    df = pandas.DataFrame({'set': np.repeat(np.arange(len(grid)), n)})
+    for name in PARAMETERS:
+        df[name] = np.repeat(grid[name].values, n)
+    for name in ['code', 'stimulus']:
+        df[name] = pandas.Categorical(
+            np.tile(labels[name].values, len(grid)))
+    df['trial'] = np.tile(labels['trial'].values, len(grid))
+    df['amplitude'] = np.concatenate(amplitudes) if amplitudes else []
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    for name in PARAMETERS:
+        parser.add_argument('--' + name, help='values of {} (default: as in '
+                            'eda_master.py)'.format(name), type=float,
+                            nargs='+')
+    parser.add_argument('--only', help='score only this subject (can be '
+                        'repeated)', action='append', metavar='CODE')
+    parser.add_argument('--output', help='CSV file for the table',
+                        default=os.path.join('out', 'stat_data',
+                                             'eda_sweep.csv'))
+    args = parser.parse_args()
+
+    grid = parameter_grid(**{name: getattr(args, name) for name in PARAMETERS
+                             if getattr(args, name) is not None})
+
+    t0 = time.perf_counter()
+    decompositions = load_decompositions(args.only)
+    if not decompositions:
+        raise SystemExit('No decompositions found, run eda_master.py first')
+    t1 = time.perf_counter()
+    df = sweep(decompositions, grid)
+    t2 = time.perf_counter()
+    print('{} subjects loaded in {:.2f} s; {} parameter sets x {} scores '
+          'in {:.2f} s'.format(len(decompositions), t1 - t0, len(grid),
+                               len(df) // max(len(grid), 1), t2 - t1))
+
+    directory = os.path.dirname(args.output)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    df.to_csv(args.output, index=False)
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# modules of the repository (ecutils, top-level scripts) are not installed
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+os.environ.setdefault('MPLBACKEND', 'Agg')
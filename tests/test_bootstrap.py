@@ -0,0 +1,39 @@
+import numpy as np
+import pandas
+
+import stat_tests
+from ecutils.bootstrap import _sign_flipped_means, bootstrap_ci, resample
+
+
+def test_resample_independent_of_jobs():
+    d = np.random.RandomState(0).standard_normal(20)
+    one = resample(_sign_flipped_means, (d,), 2500, seed=3, chunk=1000)
+    two = resample(_sign_flipped_means, (d,), 2500, seed=3, chunk=1000,
+                   jobs=2)
+    assert len(one) == 2500 and np.array_equal(one, two)
+    # an int seed is the same as a tuple of one
+    assert np.array_equal(one, resample(_sign_flipped_means, (d,), 2500,
+                                        seed=(3,), chunk=1000))
+
+
+def test_seed_tuples_give_independent_resamples():
+    x = np.random.RandomState(0).standard_normal(20)
+    assert bootstrap_ci(x, seed=(0, 0)) != bootstrap_ci(x, seed=(0, 1))
+    assert bootstrap_ci(x, seed=(0, 1)) == bootstrap_ci(x, seed=(0, 1))
+
+
+def test_tests_of_a_table_use_their_own_seeds():
+    # the same differences in both phases, tested with different resamples
+    rng = np.random.RandomState(0)
+    cs_plus, cs_minus = rng.standard_normal((2, 12))
+    summary = pandas.DataFrame({
+        'obs CS+': cs_plus, 'obs CS-': cs_minus,
+        'direct CS+': cs_plus, 'direct CS-': cs_minus,
+        'contingency_known': [True, False] * 6})
+    table = stat_tests.test_table(summary, 999, seed=5)
+    obs, direct = [table[table.contrast.str.startswith(phase)]
+                   for phase in ['obs', 'direct']]
+    assert np.array_equal(obs.estimate.values, direct.estimate.values)
+    assert not np.array_equal(obs[['ci_low', 'ci_high']].values,
+                              direct[['ci_low', 'ci_high']].values)
+    assert table.equals(stat_tests.test_table(summary, 999, seed=5, jobs=2))
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+import eda_master
+import emg_master
+import synthetic
+from ecutils.container import (CHUNK_LENGTH, STORAGE, SubjectFile, recode,
+                               write_container)
+from ecutils.emg import preprocess_emg_local
+
+N = 2 * CHUNK_LENGTH + 1234  # several compressed chunks
+SCALE, OFFSET = 10 / 32768, .5
+
+
+@pytest.fixture
+def original(tmp_path):
+    rng = np.random.RandomState(0)
+    channels = {
+        'EMG': rng.standard_normal(N),
+        # A/D readings, as extracted from acq files
+        'EDA': rng.randint(-32768, 32768, size=N) * SCALE + OFFSET,
+        }
+    file_name = str(tmp_path / 'original.physio')
+    with write_container(file_name) as writer:
+        for name, data in channels.items():
+            attributes = {'unit': 'V'}
+            if name == 'EDA':
+                attributes.update(raw_scale_factor=SCALE, raw_offset=OFFSET)
+            out = writer.add_channel(name, data.dtype, N, 2000., **attributes)
+            out[:] = data
+        writer.set_events([10, 500, 9000], [13, 5, 14], 2000.)
+        writer.set_metadata({'source': 'test.acq'})
+    return file_name, channels
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('storage', STORAGE)
+def test_round_trip(tmp_path, original, storage, compress):
+    src, channels = original
+    dst = str(tmp_path / 'recoded.physio')
+    recode(src, dst, storage, compress)
+
+    f = SubjectFile(dst)
+    assert f.channel_names == ['EMG', 'EDA']
+    assert f.metadata == {'source': 'test.acq'}
+    assert f.events().samples.tolist() == [10, 500, 9000]
+    assert f.events().values.tolist() == [13, 5, 14]
+    assert f.events_fs == 2000.
+
+    for name, data in channels.items():
+        assert f.fs(name) == 2000.
+        assert f.header['channels'][name]['unit'] == 'V'
+        x = f.channel(name)
+        decoded = np.asarray(x)
+        assert decoded.dtype == data.dtype and len(x) == N
+        # slices across chunk boundaries decode as the whole channel
+        for start, stop in [(0, 10), (CHUNK_LENGTH - 5, CHUNK_LENGTH + 5),
+                            (N - 7, N + 10), (5, 5)]:
+            assert np.array_equal(x[start:stop], decoded[start:stop])
+
+        if storage == 'float64' or (storage == 'int16' and name == 'EDA'):
+            assert np.array_equal(decoded, data)
+        elif storage == 'float32':
+            assert np.all(np.abs(decoded - data) <= np.abs(data) * 2**-24)
+        else:
+            scale = (data.max() - data.min()) / 65534
+            assert np.max(np.abs(decoded - data)) <= scale / 2 * (1 + 1e-9)
+
+
+def emg_amplitudes(file_name):
+    container = SubjectFile(file_name)
+    events = container.events()
+    probes = events.samples[np.isin(events.values, emg_master.PROBES)]
+    x_raw, x_prep = preprocess_emg_local(
+        container.channel('emg'), probes,
+        padding=emg_master.PARAMS['filter_padding'])
+    columns = [
+        emg_master.score_trials(events.events_between_events(start, stop),
+                                x_raw, x_prep, 'SYNAAA', prefix)[0]
+        for start, stop, prefix in [(13, 14, 'obs'), (15, 16, 'direct')]]
+    return np.concatenate([c['amplitude'] for c in columns])
+
+
+def eda_amplitudes(file_name):
+    phases = next(eda_master.process_subjects([('SYNAAA', file_name)],
+                                              eda_master.PARAMS['fs']))
+    [_, (_, trials_ofl), (_, trials_de)] = phases
+    scores = (eda_master.score_trials(trials_ofl, 'obs')
+              + eda_master.score_trials(trials_de, 'direct'))
+    return np.array([s['amplitude'] for s in scores], dtype=float)
+
+
+def test_scores_unchanged_by_storage(tmp_path):
+    # tolerance stated in ecutils/container.py
+    src = synthetic.write_subject(str(tmp_path / 'SYNAAA.physio'), 0, .25)
+    reference = emg_amplitudes(src), eda_amplitudes(src)
+    for storage, compress in [('float32', False), ('int16', True)]:
+        dst = str(tmp_path / '{}.physio'.format(storage))
+        recode(src, dst, storage, compress)
+        for a, b in zip(reference, (emg_amplitudes(dst),
+                                    eda_amplitudes(dst))):
+            # the same trials above the EDA threshold
+            assert np.array_equal(np.isnan(a), np.isnan(b))
+            both = ~np.isnan(a)
+            assert np.abs(a - b)[both].max() <= 1e-3 * np.abs(a[both]).max()
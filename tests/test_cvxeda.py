@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+import cvxEDA
+import synthetic
+
+
+def constant_solve(y, delta, delta_knot=10., **kwargs):
+    ones = np.ones(len(y))
+    return ones, ones, ones, np.zeros(1), np.zeros(2), ones, np.zeros(1)
+
+
+@pytest.mark.parametrize('overlap', [.4, 1., 30., 120., 300.])
+def test_windowed_weights_sum_to_one(monkeypatch, overlap):
+    # with segments solved as constant 1, stitched outputs must be 1
+    monkeypatch.setattr(cvxEDA, 'cvxEDA', constant_solve)
+    r, p, t, l, d, e, obj = cvxEDA.cvxEDA_windowed(
+        np.zeros(25 * 3000), 1 / 25, window=600., overlap=overlap)
+    for x in [r, p, t, e]:
+        assert np.allclose(x, 1., rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('window, overlap', [(600., 0.), (600., -10.),
+                                             (600., 301.), (100., 80.)])
+def test_windowed_rejects_bad_overlap(window, overlap):
+    with pytest.raises(ValueError):
+        cvxEDA.cvxEDA_windowed(np.zeros(25 * 3000), 1 / 25, window=window,
+                               overlap=overlap)
+
+
+def test_windowed_rejects_overlap_longer_than_aligned_step():
+    # 305 s of overlap is half of the window, but the step between segments
+    # is aligned down to 300 s
+    with pytest.raises(ValueError):
+        cvxEDA.cvxEDA_windowed(np.zeros(25 * 3000), 1 / 25, window=610.,
+                               overlap=305.)
+
+
+def eda_signal(seed, minutes=25, fs=25):
+    rng = np.random.RandomState(seed)
+    n = minutes * 60 * fs
+    samples = np.sort(rng.randint(0, n, 60))
+    values = rng.choice([1, 2, 8], 60)
+    y = synthetic.eda_signal(rng, n, samples, values, fs=fs, rate=fs)
+    return (y - y.mean()) / y.std()
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_windowed_within_tolerance_of_full_solve(seed):
+    # bounds stated in the docstring of cvxEDA_windowed
+    y = eda_signal(seed)
+    options = {'reltol': 1e-9, 'show_progress': False}
+    r, p, t, l, d, e, obj = cvxEDA.cvxEDA(y, 1 / 25, options=options)
+    windowed = cvxEDA.cvxEDA_windowed(y, 1 / 25, options=options)
+    assert len(windowed[3]) > 1  # solved in segments
+
+    inner = slice(60 * 25, len(y) - 60 * 25)
+    signal_range = y.max() - y.min()
+    for full, part, bound in [(r, windowed[0], 1e-3), (t, windowed[2], 1e-3),
+                              (e, windowed[5], 5e-4)]:
+        difference = np.abs(full - part)[inner].max() / signal_range
+        assert difference <= bound
+
+    starts = np.arange(inner.start, inner.stop, 5 * 25)
+    sums = [np.add.reduceat(x, starts)[:-1] for x in (p, windowed[1])]
+    assert np.abs(sums[0] - sums[1]).max() <= 1e-3 * sums[0].max()
@@ -0,0 +1,29 @@
+import numpy as np
+
+import eda_master
+import synthetic
+
+
+def test_process_subjects_one_at_a_time(tmp_path):
+    files = synthetic.write_cohort(str(tmp_path), 3, .1)
+    subjects = [(synthetic.subject_code(n), f) for n, f in enumerate(files)]
+    fs = eda_master.PARAMS['fs']
+    expected = list(eda_master.process_subjects(subjects, fs))
+
+    taken = []
+
+    def claim():
+        for subject in subjects:
+            taken.append(subject[0])
+            yield subject
+
+    results = eda_master.process_subjects(claim(), fs, jobs=2,
+                                          pipeline=False)
+    for n, phases in enumerate(results):
+        # the next subject is not taken before this one is finished
+        assert len(taken) == n + 1
+        for (levels, trials), (levels_1, trials_1) in zip(phases,
+                                                           expected[n]):
+            assert np.allclose(levels, levels_1)
+            assert np.allclose(trials.signal, trials_1.signal)
+    assert len(taken) == 3
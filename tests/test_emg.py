@@ -0,0 +1,19 @@
+import numpy as np
+
+from ecutils.emg import epochs, startle_amplitude
+
+
+def test_startle_amplitude_truncated_window_is_nan():
+    x = np.abs(np.random.RandomState(0).standard_normal(1000))
+    windows = epochs(x, [500, 950], 100, 240)
+    amplitude = startle_amplitude(windows, 100, 100, (40, 240))
+    assert np.isfinite(amplitude[0]) and amplitude[0] > 0
+    assert np.isnan(amplitude[1])
+
+
+def test_startle_amplitude_at_least_zero():
+    windows = np.zeros((2, 340))
+    windows[0, :100] = 1.  # baseline above the peak
+    windows[1, 150] = 2.
+    amplitude = startle_amplitude(windows, 100, 100, (40, 240))
+    assert amplitude.tolist() == [0., 2.]
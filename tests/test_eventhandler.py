@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from ecutils.eventhandler import (EventCollection, MarkerDecoder,
+                                  marker_channels)
+
+
+def per_sample_loop(channels, width=10):
+    # marker detection of EventCollection.from_acq before it was vectorised
+    binary_onsets = np.zeros([8, channels.shape[1] - 1], dtype=int)
+    for i in range(8):
+        d = (channels[i] > 2.5).astype(int)
+        binary_onsets[i] = (np.diff(d) > 0).astype(int)
+
+    samples, values = [], []
+    i = 0
+    while i < channels.shape[1] - 1:
+        if np.sum(binary_onsets[:, i]) > 0:
+            vec = np.max(binary_onsets[:, i:i + width], axis=1)
+            samples.append(i)
+            values.append(EventCollection.to_decimal(vec))
+            i += width
+        else:
+            i += 1
+    return samples, values
+
+
+def marker_train(rng, n_events, pulse=20):
+    # random markers 1-255, gaps longer than pulses, some events 1 sample in
+    gaps = rng.randint(pulse + 1, 400, size=n_events)
+    samples = np.cumsum(gaps) - gaps[0]
+    values = rng.randint(1, 256, size=n_events)
+    n = samples[-1] + 2 * pulse
+    return marker_channels(samples, values, 0, n, pulse=pulse)
+
+
+def noise_channels(rng, n):
+    # random levels, with edges on several channels within width samples
+    return np.where(rng.random_sample((8, n)) < .1, 5., 0.)
+
+
+def from_acq(channels):
+    data_obj = SimpleNamespace(channels=[
+        SimpleNamespace(data=c) for c in [None, None] + list(channels)])
+    return EventCollection.from_acq(data_obj)
+
+
+@pytest.mark.parametrize('number', range(5))
+def test_from_acq_equals_per_sample_loop(number):
+    rng = np.random.RandomState([1, number])
+    for channels in [marker_train(rng, 200), noise_channels(rng, 3000)]:
+        ec = from_acq(channels)
+        samples, values = per_sample_loop(channels)
+        assert ec.samples.tolist() == samples
+        assert ec.values.tolist() == values
+
+
+@pytest.mark.parametrize('number', range(5))
+def test_decoder_equals_from_acq_for_any_blocks(number):
+    rng = np.random.RandomState([2, number])
+    for channels in [marker_train(rng, 200), noise_channels(rng, 3000)]:
+        ec = from_acq(channels)
+        n = channels.shape[1]
+        # random splits, including empty and single sample blocks
+        bounds = np.sort(np.concatenate([
+            [0, n], rng.randint(0, n, size=rng.randint(1, 60)),
+            rng.randint(0, n, size=3).repeat(2)]))
+
+        decoder = MarkerDecoder()
+        parts = [decoder.feed(channels[:, a:b])
+                 for a, b in zip(bounds[:-1], bounds[1:])]
+        parts.append(decoder.flush())
+        assert np.concatenate([p[0] for p in parts]).tolist() == \
+            ec.samples.tolist()
+        assert np.concatenate([p[1] for p in parts]).tolist() == \
+            ec.values.tolist()
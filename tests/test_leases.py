@@ -0,0 +1,98 @@
+import concurrent.futures
+import os
+import time
+
+from ecutils.leases import Lease, WorkQueue
+
+
+def crash(lease, age):
+    # stop heartbeats, as if the process was killed, and backdate the lease
+    lease._stop.set()
+    lease._thread.join()
+    t = time.time() - age
+    os.utime(lease.file_name, (t, t))
+
+
+def hold(file_name):
+    lease = Lease.acquire(file_name, ttl=60.)
+    if lease is None:
+        return False
+    time.sleep(1.)  # until all processes tried
+    lease.release()
+    return True
+
+
+def test_only_one_process_acquires(tmp_path):
+    file_name = str(tmp_path / 'subject.lease')
+    with concurrent.futures.ProcessPoolExecutor(4) as executor:
+        acquired = list(executor.map(hold, [file_name] * 8))
+    assert acquired.count(True) == 1
+    assert not os.path.exists(file_name)
+
+
+def test_held_lease_is_exclusive(tmp_path):
+    file_name = str(tmp_path / 'subject.lease')
+    first = Lease.acquire(file_name, ttl=60.)
+    assert first is not None and first.is_held()
+    assert Lease.acquire(file_name, ttl=60.) is None
+
+    first.release()
+    assert not os.path.exists(file_name)
+    second = Lease.acquire(file_name, ttl=60.)
+    assert second is not None and second.broken is None
+    second.release()
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    file_name = str(tmp_path / 'subject.lease')
+    first = Lease.acquire(file_name, ttl=10.)
+    crash(first, 5.)
+    assert Lease.acquire(file_name, ttl=10.) is None  # not expired yet
+
+    crash(first, 11.)
+    second = Lease.acquire(file_name, ttl=10.)
+    assert second is not None and second.broken == first.owner
+    assert second.is_held() and not first.is_held()
+
+    # the former owner does not remove the lease of the new one
+    first.release()
+    assert second.is_held()
+    second.release()
+
+
+def test_heartbeat_keeps_lease(tmp_path):
+    file_name = str(tmp_path / 'subject.lease')
+    first = Lease.acquire(file_name, ttl=.4)
+    time.sleep(1.)
+    assert Lease.acquire(file_name, ttl=.4) is None
+    assert not first.lost
+    first.release()
+
+
+def test_two_workers_on_one_directory(tmp_path, capsys):
+    directory = str(tmp_path / 'work')
+    one = WorkQueue('emg', directory, ttl=10., poll=.01)
+    two = WorkQueue('emg', directory, ttl=10., poll=.01)
+    codes = ['AAA', 'BBB', 'CCC']
+
+    held = one.acquire('AAA')
+    claimed = []
+    for code in two.claim(codes, wait=False):
+        claimed.append(code)
+        two.complete(code, key='k')
+    assert claimed == ['BBB', 'CCC']
+    assert two.status(codes, {c: 'k' for c in codes}) == {
+        'AAA': 'leased', 'BBB': 'done', 'CCC': 'done'}
+
+    # the worker holding AAA dies; the other one waits and takes over
+    crash(held, 11.)
+    assert one.status(['AAA']) == {'AAA': 'expired'}
+    claimed = []
+    for code in two.claim(codes, {c: 'k' for c in codes}):
+        claimed.append(code)
+        two.complete(code, key='k')
+    assert claimed == ['AAA']
+    assert 'AAA: took over the expired lease of ' + held.owner in \
+        capsys.readouterr().out
+    assert all(one.is_done(c, 'k') for c in codes)
+    assert os.listdir(os.path.join(directory, 'emg', 'leases')) == []
@@ -0,0 +1,73 @@
+import concurrent.futures
+import multiprocessing
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from ecutils import profiling
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MB = 2**20
+
+
+def allocate(megabytes):
+    # touched, so that it is resident
+    x = np.ones(megabytes * MB // 8)
+    del x
+
+
+@pytest.mark.skipif(not (profiling.reset_peak_rss()
+                         and profiling.peak_rss_since_reset() is not None),
+                    reason='peak resident memory can not be reset')
+def test_peak_rss_of_each_stage(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, '_directory', str(tmp_path))
+    allocate(200)  # process peak, before the stages
+    with profiling.stage('outer', 'A'):
+        with profiling.stage('large', 'A'):
+            allocate(100)
+        with profiling.stage('small', 'A'):
+            allocate(10)
+        allocate(50)
+
+    records = {r['stage']: r for r in profiling.report(str(tmp_path))}
+    assert records['large']['peak_rss_change'] > 90 * MB
+    assert 5 * MB < records['small']['peak_rss_change'] < 40 * MB
+    # transient peaks do not remain in the memory at the end
+    assert records['large']['rss_change'] < 20 * MB
+    # the enclosing stage includes the peaks of the stages within it
+    assert records['outer']['peak_rss'] >= records['large']['peak_rss']
+    assert records['outer']['peak_rss_change'] > 90 * MB
+
+
+def run_stage(name):
+    with profiling.stage(name, 'A'):
+        pass
+    return os.getpid()
+
+
+def test_workers_record_into_the_report_of_their_parent(tmp_path,
+                                                        monkeypatch):
+    monkeypatch.setattr(profiling, '_directory', str(tmp_path))
+    with concurrent.futures.ProcessPoolExecutor(
+            2, mp_context=multiprocessing.get_context('spawn'),
+            initializer=profiling.init_worker,
+            initargs=(profiling.report_directory(),)) as executor:
+        pids = set(executor.map(run_stage, ['one', 'two']))
+    records = profiling.report(str(tmp_path))
+    assert sorted(r['stage'] for r in records) == ['one', 'two']
+    assert {r['pid'] for r in records} == pids
+
+
+def test_not_enabled_by_the_environment(tmp_path):
+    # a report directory left in the environment by an earlier version
+    env = dict(os.environ, PHYSIO_REPORT_DIR=str(tmp_path),
+               PYTHONPATH=ROOT)
+    enabled = subprocess.run(
+        [sys.executable, '-c', 'from ecutils import profiling; '
+         'print(profiling.enabled())'], env=env, cwd=str(tmp_path),
+        stdout=subprocess.PIPE, check=True).stdout
+    assert enabled.strip() == b'False'
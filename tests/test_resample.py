@@ -0,0 +1,40 @@
+import numpy as np
+import scipy.signal as ss
+
+from ecutils.eventhandler import EventCollection
+from ecutils.resample import decimate_steps, downsample
+
+
+def eda(n=2000 * 120, seed=0):
+    rng = np.random.RandomState(seed)
+    return 5 + np.cumsum(rng.normal(0, 1e-3, n)) + rng.normal(0, 1e-2, n)
+
+
+def test_default_matches_chained_decimate():
+    # the original analysis: ss.decimate by 8, 5 and 2
+    x = eda()
+    expected = ss.decimate(ss.decimate(ss.decimate(x, 8), 5), 2)
+    out, _ = downsample(x, None, 2000, 25)
+    assert out.shape == expected.shape
+    assert np.array_equal(out, expected)
+
+
+def test_decimate_steps():
+    assert decimate_steps(80) == [8, 5, 2]
+    assert decimate_steps(1) == []
+
+
+def test_polyphase_matches_resample_poly_for_any_chunk_size():
+    x = eda(2000 * 30)
+    expected = ss.resample_poly(x, 1, 80)
+    for chunk_size in [1000, 12345, 10 ** 7]:
+        out, _ = downsample(x, None, 2000, 25, chunk_size=chunk_size,
+                            method='polyphase')
+        assert np.allclose(out, expected, rtol=0, atol=1e-12)
+
+
+def test_events_moved_to_output_rate():
+    events = EventCollection([0, 80, 1000, 4040], [11, 1, 2, 12])
+    _, out = downsample(eda(8000), events, 2000, 25)
+    assert out.samples.tolist() == [0, 1, 12, 50]
+    assert out.values.tolist() == [11, 1, 2, 12]
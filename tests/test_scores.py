@@ -0,0 +1,37 @@
+import threading
+
+import numpy as np
+import pandas
+
+from ecutils.scores import ScoreStore
+
+
+def scores(code, n=20):
+    return pandas.DataFrame({'code': code, 'stimulus': 'obs CS+',
+                             'trial': np.arange(n),
+                             'amplitude': np.random.rand(n)})
+
+
+def test_read_during_compaction(tmp_path):
+    store = ScoreStore('emg', directory=str(tmp_path))
+    store.upsert(scores('AAA'))
+    errors = []
+
+    def rescore():
+        try:
+            for _ in range(100):
+                store.upsert(scores('AAA'))
+                store.upsert(scores('BBB'))
+                store.compact()
+        except Exception as error:
+            errors.append(error)
+
+    writer = threading.Thread(target=rescore)
+    writer.start()
+    reads = 0
+    while writer.is_alive():
+        df = ScoreStore('emg', directory=str(tmp_path)).read()
+        assert set(df.groupby('code', observed=True).size()) == {20}
+        reads += 1
+    writer.join()
+    assert not errors and reads > 0
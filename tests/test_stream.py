@@ -0,0 +1,28 @@
+import numpy as np
+
+from ecutils.eventhandler import marker_channels
+from ecutils.stream import StartleStream
+
+
+def feed_all(stream, emg, digital, block=1000):
+    scores = []
+    for start in range(0, len(emg), block):
+        scores.extend(stream.feed(emg[start:start + block],
+                                  digital[:, start:start + block]))
+    return scores, stream.flush()
+
+
+def test_flush_scores_truncated_window_as_nan():
+    n = 20000
+    emg = np.random.RandomState(0).standard_normal(n)
+    # phase start, a probe with a full window, a probe near the end
+    samples, values = np.array([100, 5000, n - 100]), np.array([13, 5, 6])
+    digital = marker_channels(samples, values, 0, n)
+
+    for causal in [False, True]:
+        fed, flushed = feed_all(StartleStream(causal=causal), emg, digital)
+        scores = {s['stimulus']: s['amplitude'] for s in fed + flushed}
+        assert sorted(scores) == ['obs CS+', 'obs CS-']
+        assert np.isfinite(scores['obs CS+'])
+        assert [s['stimulus'] for s in flushed] == ['obs CS-']
+        assert np.isnan(scores['obs CS-'])
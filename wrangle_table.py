@@ -2,6 +2,8 @@ import configparser
 import os
 import pandas
 
+from ecutils.scores import ScoreStore
+
 config = configparser.ConfigParser()
 config.read('emocon_config.ini')
 BEHAV_DIR = config['DEFAULT']['BEHAV_DIR']
@@ -12,12 +14,11 @@ contingency = pandas.read_csv(os.path.join(BEHAV_DIR, 'contingency.csv'),
 contingency.contingency_known = contingency.contingency_known.astype(bool)
 
 # eda
-data_path = os.path.join('out', 'stat_data', 'eda.pickle')
-df = pandas.read_pickle(data_path)
+df = ScoreStore('eda', 'normalized').read()
 
 df_w = (df
-        .fillna(value=0)
-        .groupby(['code', 'stimulus'])
+        .fillna({'amplitude': 0})
+        .groupby(['code', 'stimulus'], observed=True)
         .amplitude
         .mean()
         .unstack()
@@ -27,11 +28,10 @@ df_w = (df
 df_w.to_csv(os.path.join('out', 'stat_data', 'eda_summary.csv'))
 
 # emg
-data_path = os.path.join('out', 'stat_data', 'emg.pickle')
-emg = pandas.read_pickle(data_path)
+emg = ScoreStore('emg', 'normalized').read()
 
 emg_summary = (emg
-               .groupby(['code', 'stimulus'])
+               .groupby(['code', 'stimulus'], observed=True)
                .amplitude
                .mean()
                .unstack()